@@ -0,0 +1,212 @@
+# app/admission.py
+
+import os
+import time
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from .latency import remaining
+
+# 直近何件分の待ち時間・処理時間から統計を求めるか
+ADMISSION_WINDOW = 500
+# Retry-After の上限（秒）
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+@dataclass(frozen=True)
+class RouteClass:
+    """
+    同時実行数を分けて管理するリクエストの種類。
+    priority が小さいほど優先し、優先度の高い種類の待ちがある間は、低い種類のリクエストを開始しない
+    """
+    name: str
+    priority: int
+    max_concurrency: int
+    # 待たせる件数の上限。超えた分は待たせずに503を返す
+    max_queue: int
+    # 待ち時間の上限（秒）。超えたら503を返す
+    queue_timeout: float
+
+
+# (名前, 優先度, 同時実行数, 待ちの上限, 待ち時間の上限) の既定値。
+# ADMISSION_<名前>_CONCURRENCY / _QUEUE / _QUEUE_TIMEOUT で変更できる
+DEFAULT_ROUTE_CLASSES = [
+    ("interactive", 0, 64, 256, 5.0),
+    ("ai", 1, 4, 16, 2.0),
+]
+
+# OpenAI / Tavily を呼び出す重いエンドポイント（POSTのみ。生成済みプランの採用は軽いので除く）
+AI_PATH_PREFIXES = ("/planner", "/agent", "/masculine-planner")
+AI_EXCLUDED_PREFIXES = ("/planner/plans/",)
+# 接続を保ち続けるストリームは同時実行数に数えない
+BYPASS_SUFFIXES = ("/stream",)
+
+
+class AdmissionRejected(Exception):
+    """混雑しているため、リクエストを受け付けなかった"""
+
+    def __init__(self, route_class: str, reason: str, retry_after: float):
+        self.route_class = route_class
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"{route_class} requests are saturated ({reason}). Please retry later.")
+
+
+def _percentile(samples: deque, ratio: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+class AdmissionPool:
+    """1つの種類のリクエストの同時実行数と待ち行列"""
+
+    def __init__(self, route_class: RouteClass):
+        self.route_class = route_class
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self._wait_seconds: deque[float] = deque(maxlen=ADMISSION_WINDOW)
+        self._service_seconds: deque[float] = deque(maxlen=ADMISSION_WINDOW)
+        self._stats = {"admitted": 0, "shed_queue_full": 0, "shed_timeout": 0, "peak_queue": 0}
+
+    def retry_after(self) -> float:
+        """待っているリクエストが捌けるまでの目安の秒数"""
+        service = sum(self._service_seconds) / len(self._service_seconds) if self._service_seconds else 1.0
+        seconds = service * (len(self.waiters) + 1) / self.route_class.max_concurrency
+        return min(max(1.0, seconds), MAX_RETRY_AFTER_SECONDS)
+
+    def snapshot(self) -> dict:
+        return {
+            "priority": self.route_class.priority,
+            "max_concurrency": self.route_class.max_concurrency,
+            "max_queue": self.route_class.max_queue,
+            "queue_timeout_seconds": self.route_class.queue_timeout,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "saturation": round(self.active / self.route_class.max_concurrency, 3),
+            "queue_wait_p50_seconds": round(_percentile(self._wait_seconds, 0.5), 3),
+            "queue_wait_p99_seconds": round(_percentile(self._wait_seconds, 0.99), 3),
+            "service_p50_seconds": round(_percentile(self._service_seconds, 0.5), 3),
+            "service_p99_seconds": round(_percentile(self._service_seconds, 0.99), 3),
+            **self._stats,
+        }
+
+
+class AdmissionController:
+    """
+    リクエストの種類ごとに同時実行数を制限し、混雑時は優先度の低い種類から503で断る。
+    予定のCRUDのような軽いリクエストが、プラン生成の集中で遅くならないようにする（ワーカープロセスごと）
+    """
+
+    def __init__(self):
+        self._pools: Optional[dict[str, AdmissionPool]] = None
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.getenv("ADMISSION_CONTROL", "1").lower() not in ("0", "false", "off")
+
+    def _configure(self) -> dict[str, AdmissionPool]:
+        if self._pools is None:
+            pools = {}
+            for name, priority, concurrency, queue, queue_timeout in DEFAULT_ROUTE_CLASSES:
+                prefix = f"ADMISSION_{name.upper()}"
+                pools[name] = AdmissionPool(RouteClass(
+                    name=name,
+                    priority=priority,
+                    max_concurrency=max(1, int(os.getenv(f"{prefix}_CONCURRENCY", concurrency))),
+                    max_queue=int(os.getenv(f"{prefix}_QUEUE", queue)),
+                    queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", queue_timeout)),
+                ))
+            self._pools = pools
+        return self._pools
+
+    @staticmethod
+    def classify(method: str, path: str) -> Optional[str]:
+        """リクエストの種類。None の場合は制限しない"""
+        if path.endswith(BYPASS_SUFFIXES):
+            return None
+        if method == "POST" and path.startswith(AI_PATH_PREFIXES) and not path.startswith(AI_EXCLUDED_PREFIXES):
+            return "ai"
+        return "interactive"
+
+    def _can_start(self, pool: AdmissionPool) -> bool:
+        if pool.active >= pool.route_class.max_concurrency:
+            return False
+        return not any(
+            other.waiters for other in self._configure().values()
+            if other.route_class.priority < pool.route_class.priority
+        )
+
+    def _dispatch(self) -> None:
+        """空きができたら、優先度の高い種類から順に待っているリクエストを開始させる"""
+        for pool in sorted(self._configure().values(), key=lambda p: p.route_class.priority):
+            while pool.waiters and pool.active < pool.route_class.max_concurrency:
+                waiter = pool.waiters.popleft()
+                if waiter.done():
+                    continue
+                pool.active += 1
+                waiter.set_result(None)
+            # 優先度の高い種類の待ちが残っている間は、低い種類を開始しない
+            if pool.waiters:
+                return
+
+    async def acquire(self, name: str) -> None:
+        """
+        実行枠を確保する。待ちの上限を超えた場合・待ち時間の上限を過ぎた場合は AdmissionRejected
+        """
+        pool = self._configure()[name]
+        started = time.monotonic()
+        if not pool.waiters and self._can_start(pool):
+            pool.active += 1
+            pool._stats["admitted"] += 1
+            pool._wait_seconds.append(0.0)
+            return
+        if len(pool.waiters) >= pool.route_class.max_queue:
+            pool._stats["shed_queue_full"] += 1
+            raise AdmissionRejected(name, "queue full", pool.retry_after())
+
+        # リクエストの期限が待ち時間の上限より早ければ、期限までしか待たない
+        timeout = pool.route_class.queue_timeout
+        left = remaining()
+        if left is not None:
+            timeout = max(0.0, min(timeout, left))
+        waiter = asyncio.get_running_loop().create_future()
+        pool.waiters.append(waiter)
+        pool._stats["peak_queue"] = max(pool._stats["peak_queue"], len(pool.waiters))
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を割り当てられた直後に打ち切られた場合は、枠を返す
+                self.release(name, 0.0)
+            else:
+                if waiter in pool.waiters:
+                    pool.waiters.remove(waiter)
+                # 優先度の高い待ちが無くなれば、低い種類を開始できる
+                self._dispatch()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            pool._stats["shed_timeout"] += 1
+            raise AdmissionRejected(name, "queue timeout", pool.retry_after()) from None
+        pool._stats["admitted"] += 1
+        pool._wait_seconds.append(time.monotonic() - started)
+
+    def release(self, name: str, service_seconds: float) -> None:
+        pool = self._configure()[name]
+        pool.active -= 1
+        if service_seconds:
+            pool._service_seconds.append(service_seconds)
+        self._dispatch()
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled(),
+            "classes": {name: pool.snapshot() for name, pool in self._configure().items()},
+        }
+
+
+# アプリケーション全体で共有するコントローラー（同時実行数はワーカープロセスごと）
+admission_controller = AdmissionController()
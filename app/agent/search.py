@@ -1,6 +1,5 @@
 import os
 from typing import TypedDict, List, Optional, cast
-from tavily import TavilyClient
 
 class SearchResult(TypedDict):
     url: str
@@ -18,7 +17,8 @@ class SearchResponse(TypedDict):
     response_time: float
 
 def search(query: str) -> SearchResponse:
-    
+    from tavily import TavilyClient
+
     client = TavilyClient(os.getenv("TAVILY_API_KEY"))
     response = client.search(query, limit=5)
     return cast(SearchResponse, response)
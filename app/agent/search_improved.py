@@ -1,7 +1,11 @@
 import os
+import asyncio
 import logging
-from typing import TypedDict, List, Optional, cast
-from tavily import TavilyClient
+from functools import cache
+from typing import TypedDict, List, Optional, Sequence, cast
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +28,114 @@ class SearchError(Exception):
     """検索関連のエラー"""
     pass
 
+class SearchRateLimitError(SearchError):
+    """Tavilyのレート制限・利用上限に達した"""
+
+    def __init__(self, message: str, retry_after: Optional[str] = None):
+        super().__init__(message)
+        # Retry-After ヘッダーの値（そのまま渡す）
+        self.retry_after = retry_after
+
+TAVILY_API_BASE_URL = "https://api.tavily.com"
+# 共有する接続プールの大きさ（同時に送る検索の数の上限）
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_TIMEOUT_SECONDS = 60
+# 利用上限(432)・プランの上限(433)もレート制限として扱う
+RATE_LIMIT_STATUS_CODES = (429, 432, 433)
+
+def _url_key(url: str) -> str:
+    """重複判定用のURL（フラグメント・末尾のスラッシュ・ホスト名の大文字小文字の違いを無視する）"""
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), parts.query, ""))
+
+def merge_responses(responses: Sequence[SearchResponse], limit: Optional[int] = None) -> SearchResponse:
+    """
+    複数のクエリの検索結果を1つにまとめる。
+    同じURLの結果はスコアの高い方を残し、スコアの高い順に並べる（limit を指定した場合はその件数まで）
+    """
+    best: dict[str, SearchResult] = {}
+    for response in responses:
+        for result in response.get("results", []):
+            key = _url_key(result["url"])
+            if key not in best or result.get("score", 0.0) > best[key].get("score", 0.0):
+                best[key] = result
+    results = sorted(best.values(), key=lambda result: result.get("score", 0.0), reverse=True)
+    images = list(dict.fromkeys(image for response in responses for image in response.get("images") or []))
+    return {
+        "query": "\n".join(response.get("query", "") for response in responses),
+        "follow_up_questions": next((r["follow_up_questions"] for r in responses if r.get("follow_up_questions")), None),
+        "answer": next((r["answer"] for r in responses if r.get("answer")), None),
+        "images": images,
+        "results": results[:limit] if limit is not None else results,
+        # 並行して実行するため、最も遅かった検索の時間
+        "response_time": max((response.get("response_time", 0.0) for response in responses), default=0.0),
+    }
+
+class AsyncTavilyClient:
+    """
+    共有の httpx.AsyncClient（接続プール）でTavilyの検索APIを呼び出す非同期クライアント。
+    tavily-python の TavilyClient は同期APIで、呼び出しごとにスレッドを使うため、こちらを使う
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, max_connections: Optional[int] = None):
+        api_key = api_key or os.getenv("TAVILY_API_KEY")
+        max_connections = max_connections or int(os.getenv("TAVILY_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS))
+        self._client = httpx.AsyncClient(
+            base_url=base_url or os.getenv("TAVILY_API_BASE_URL", TAVILY_API_BASE_URL),
+            headers={
+                "Content-Type": "application/json",
+                **({"Authorization": f"Bearer {api_key}"} if api_key else {}),
+            },
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=float(os.getenv("TAVILY_TIMEOUT", DEFAULT_TIMEOUT_SECONDS)),
+        )
+
+    async def search(self, query: str, search_depth: str = "basic", max_results: int = 5) -> SearchResponse:
+        """
+        1つのクエリで検索する
+
+        Raises:
+            SearchRateLimitError: レート制限・利用上限に達した場合
+            SearchError: それ以外の検索実行時のエラー
+        """
+        if not query or not query.strip():
+            raise ValueError("検索クエリは空文字列にできません")
+        try:
+            response = await self._client.post(
+                "/search", json={"query": query.strip(), "search_depth": search_depth, "max_results": max_results}
+            )
+        except httpx.HTTPError as e:
+            raise SearchError(f"検索中にエラーが発生しました: {e!r}") from e
+        if response.status_code in RATE_LIMIT_STATUS_CODES:
+            raise SearchRateLimitError(_error_detail(response), response.headers.get("retry-after"))
+        if response.status_code != 200:
+            raise SearchError(f"検索中にエラーが発生しました ({response.status_code}): {_error_detail(response)}")
+        body = response.json()
+        if not isinstance(body, dict):
+            raise SearchError("APIレスポンスの形式が不正です")
+        body.setdefault("query", query)
+        body.setdefault("results", [])
+        return cast(SearchResponse, body)
+
+    async def search_many(
+        self, queries: Sequence[str], search_depth: str = "basic", max_results: int = 5
+    ) -> SearchResponse:
+        """複数のクエリを並行して検索し、URLで重複を除いてまとめた結果を返す"""
+        responses = await asyncio.gather(*(self.search(query, search_depth, max_results) for query in queries))
+        return merge_responses(responses, limit=max_results)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+def _error_detail(response: httpx.Response) -> str:
+    try:
+        detail = response.json()["detail"]
+    except (ValueError, TypeError, KeyError):
+        return response.text
+    if isinstance(detail, dict):
+        return str(detail.get("error", detail))
+    return str(detail)
+
 def search(query: str, limit: int = 5) -> SearchResponse:
     """
     Web検索を実行する
@@ -52,8 +164,7 @@ def search(query: str, limit: int = 5) -> SearchResponse:
         raise SearchError("TAVILY_API_KEYが設定されていません")
     
     try:
-        client = TavilyClient(api_key)
-        response = client.search(query.strip(), limit=limit)
+        response = _sync_client(api_key).search(query.strip(), max_results=limit)
         
         # レスポンス構造の基本的な検証
         if not isinstance(response, dict):
@@ -71,6 +182,14 @@ def search(query: str, limit: int = 5) -> SearchResponse:
         logger.error(f"検索API エラー: {e}")
         raise SearchError(f"検索中にエラーが発生しました: {e}")
 
+@cache
+def _sync_client(api_key: str):
+    """同期APIのクライアント（APIキーごとに1つを使い回す）"""
+    # tavilyのimportは重いため、実際に検索するまで遅らせる
+    from tavily import TavilyClient
+
+    return TavilyClient(api_key)
+
 def is_search_available() -> bool:
     """
     検索機能が利用可能かチェック
@@ -0,0 +1,188 @@
+# app/cassettes.py
+
+import os
+import gzip
+import json
+import asyncio
+import difflib
+import hashlib
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+
+# 上流API(OpenAI / Tavily)の呼び出しを記録・再生するためのカセット
+# LLM_CASSETTE_MODE:
+#   off    - 何もしない（既定）
+#   record - 実際に呼び出し、リクエストとレスポンスを記録する
+#   replay - 記録済みのレスポンスを返す。記録が無い呼び出しはエラーにする（オフライン用）
+#            リクエストが完全には一致しない場合（学習済みの所要時間などでプロンプトが変わった場合）は、
+#            同じ呼び出し元・同じ入力の記録を使う
+#   shadow - replay と同様に再生し、記録と一致しなかったリクエストの差分をレポートに書き出す。
+#            変更したプロンプトを、記録済みの本番の呼び出しと突き合わせるために使う
+CASSETTE_MODES = ("off", "record", "replay", "shadow")
+DEFAULT_CASSETTE_DIR = "./cassettes"
+SHADOW_REPORT_FILE = "shadow-report.jsonl"
+# レポートに載せる差分の最大行数
+SHADOW_DIFF_MAX_LINES = 200
+
+
+class CassetteMissError(Exception):
+    """replay / shadow モードで、対応する記録が見つからない"""
+
+    def __init__(self, kind: str, fingerprint: str, label: Optional[str] = None):
+        self.kind = kind
+        self.fingerprint = fingerprint
+        self.label = label
+        super().__init__(f"No recorded cassette for {kind} ({label or 'no label'}, {fingerprint[:12]})")
+
+
+def _canonical_json(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def fingerprint(kind: str, request: dict) -> str:
+    """リクエストの内容から決まる記録のキー"""
+    return hashlib.sha256(_canonical_json({"kind": kind, "request": request}).encode("utf-8")).hexdigest()
+
+
+def context_key(context: Any) -> str:
+    """呼び出し元の入力（プロンプトを組み立てる前の値）から決まるキー。replay / shadow モードの突き合わせに使う"""
+    return hashlib.sha256(_canonical_json(context).encode("utf-8")).hexdigest()[:32]
+
+
+class CassetteRecorder:
+    def __init__(self, mode: Optional[str] = None, directory: Optional[str] = None):
+        # 未指定の場合は、呼び出しのたびに環境変数から解決する
+        self._mode = mode
+        self._directory = directory
+
+    @property
+    def mode(self) -> str:
+        mode = (self._mode or os.getenv("LLM_CASSETTE_MODE", "off")).lower()
+        return mode if mode in CASSETTE_MODES else "off"
+
+    @property
+    def directory(self) -> str:
+        return self._directory or os.getenv("LLM_CASSETTE_DIR", DEFAULT_CASSETTE_DIR)
+
+    @property
+    def offline(self) -> bool:
+        """上流APIを実際には呼び出さないモードかどうか（APIキーが無くても動かせる）"""
+        return self.mode in ("replay", "shadow")
+
+    def _cassette_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.directory, kind, key[:2], f"{key}.json.gz")
+
+    def _context_path(self, kind: str, label: str, key: str) -> str:
+        return os.path.join(self.directory, "by-context", kind, label, f"{key}.json")
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _load(self, kind: str, key: str) -> Optional[dict]:
+        try:
+            with gzip.open(self._cassette_path(kind, key), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, kind: str, key: str, cassette: dict, label: Optional[str], ctx_key: Optional[str]) -> None:
+        data = gzip.compress(json.dumps(cassette, ensure_ascii=False, default=str).encode("utf-8"))
+        self._write(self._cassette_path(kind, key), data)
+        if label and ctx_key:
+            # 同じ呼び出し元・同じ入力の最新の記録を指す索引
+            self._write(self._context_path(kind, label, ctx_key), json.dumps({"fingerprint": key}).encode("utf-8"))
+
+    def _load_by_context(self, kind: str, label: str, ctx_key: str) -> Optional[dict]:
+        try:
+            with open(self._context_path(kind, label, ctx_key), encoding="utf-8") as f:
+                return self._load(kind, json.load(f)["fingerprint"])
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def _request_lines(request: dict) -> list[str]:
+        # プロンプトの差分が読めるよう、メッセージの本文は行ごとに展開する
+        lines = []
+        for message in request.get("messages", []):
+            lines.append(f"[{message.get('role')}]")
+            lines.extend(str(message.get("content", "")).splitlines())
+        params = {key: value for key, value in request.items() if key != "messages"}
+        lines.extend(json.dumps(params, sort_keys=True, ensure_ascii=False, indent=1, default=str).splitlines())
+        return lines
+
+    def _report_shadow(self, kind: str, label: str, ctx_key: str, recorded: dict, request: dict, key: str) -> None:
+        recorded_lines = self._request_lines(recorded["request"])
+        new_lines = self._request_lines(request)
+        diff = list(difflib.unified_diff(recorded_lines, new_lines, "recorded", "shadow", lineterm=""))
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "kind": kind,
+            "label": label,
+            "context_key": ctx_key,
+            "recorded_fingerprint": recorded["fingerprint"],
+            "shadow_fingerprint": key,
+            "recorded_request_chars": sum(len(line) for line in recorded_lines),
+            "shadow_request_chars": sum(len(line) for line in new_lines),
+            "diff": diff[:SHADOW_DIFF_MAX_LINES],
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, SHADOW_REPORT_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def call(
+        self,
+        kind: str,
+        request: dict,
+        live_call: Callable[[], Awaitable[Any]],
+        *,
+        encode: Callable[[Any], Any] = lambda response: response,
+        decode: Callable[[Any], Any] = lambda data: data,
+        label: Optional[str] = None,
+        context: Any = None,
+    ) -> Any:
+        """
+        モードに応じて、上流APIの呼び出し(live_call)を記録・再生する。
+        encode / decode はレスポンスとJSONに保存できる値の相互変換。
+        """
+        mode = self.mode
+        if mode == "off":
+            return await live_call()
+
+        key = fingerprint(kind, request)
+        ctx_key = context_key(context) if label and context is not None else None
+
+        if mode == "record":
+            response = await live_call()
+            cassette = {
+                "kind": kind,
+                "fingerprint": key,
+                "label": label,
+                "context_key": ctx_key,
+                "recorded_at": datetime.now().isoformat(),
+                "request": request,
+                "response": encode(response),
+            }
+            try:
+                await asyncio.to_thread(self._save, kind, key, cassette, label, ctx_key)
+            except OSError as e:
+                print(f"Failed to record cassette {key[:12]}: {e}")
+            return response
+
+        cassette = await asyncio.to_thread(self._load, kind, key)
+        if cassette is None and ctx_key:
+            # プロンプトが変わってリクエストが一致しない場合は、同じ入力の記録を使う
+            cassette = await asyncio.to_thread(self._load_by_context, kind, label, ctx_key)
+            if cassette is not None and mode == "shadow":
+                await asyncio.to_thread(self._report_shadow, kind, label, ctx_key, cassette, request, key)
+        if cassette is None:
+            raise CassetteMissError(kind, key, label)
+        return decode(cassette["response"])
+
+
+# アプリケーション全体で共有するレコーダー
+cassette_recorder = CassetteRecorder()
@@ -0,0 +1,183 @@
+# app/change_feed.py
+
+import json
+import asyncio
+from typing import AsyncIterator, Optional, Sequence
+
+from sqlalchemy import select, func
+
+from . import models, schemas
+from .database import AsyncSessionLocal
+
+# 購読者ごとに溜められる通知の上限。溢れた購読者はDBから読み直す
+SUBSCRIBER_QUEUE_SIZE = 256
+# 配信タスクが他のワーカーの変更を拾うためにDBを確認する間隔、兼 keep-alive の間隔（秒）
+POLL_INTERVAL_SECONDS = 2.0
+# 購読開始時に、1回のクエリで読み出す変更の件数
+BACKLOG_BATCH_SIZE = 500
+
+
+def to_change_schema(change: models.EventChange) -> schemas.EventChange:
+    return schemas.EventChange(
+        seq=change.seq,
+        event_id=change.event_id,
+        operation=change.operation,
+        data=json.loads(change.payload),
+        created_at=change.created_at,
+    )
+
+
+async def _load_changes(since: int, limit: int, until: Optional[int] = None) -> Sequence[models.EventChange]:
+    # crud から change_hub を参照するため、ここでは crud を使わずに直接読み出す
+    query = select(models.EventChange).filter(models.EventChange.seq > since)
+    if until is not None:
+        query = query.filter(models.EventChange.seq <= until)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(query.order_by(models.EventChange.seq).limit(limit))
+        return result.scalars().all()
+
+
+async def get_latest_seq() -> int:
+    """変更履歴の最新の通し番号（購読をいまから開始する場合のカーソル）"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(func.max(models.EventChange.seq)))
+        return result.scalar() or 0
+
+
+class _Subscriber:
+    """購読者ごとの通知の待ち行列と、溢れて取りこぼしたかどうかの印"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+
+class ChangeHub:
+    """
+    予定の変更をプロセス内の購読者（WebSocket / SSE接続）に配信するPub/Sub
+
+    変更履歴を読むのはプロセスごとに1つの配信タスクだけで、読んだ変更を購読者の待ち行列に配る。
+    購読者がDBを読むのは、購読開始時（と通知が溢れた時）の再開位置までの履歴だけ。
+    """
+
+    def __init__(self):
+        self._subscribers: set[_Subscriber] = set()
+        # 購読者に配り終えた最新の通し番号。配信タスクが動いていない間は None
+        self._cursor: Optional[int] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def publish(self, change: schemas.EventChange) -> None:
+        """このプロセスでコミットした変更を通知する"""
+        if self._cursor is None:
+            return
+        if change.seq == self._cursor + 1:
+            # 配信済みの直後の変更なら、DBを読まずにそのまま配る
+            self._fan_out(change)
+        elif change.seq > self._cursor and self._wakeup is not None:
+            # 間に他のワーカーの変更などがある場合は、配信タスクに順番どおり読み直させる
+            self._wakeup.set()
+
+    def _fan_out(self, change: schemas.EventChange) -> None:
+        self._cursor = change.seq
+        for subscriber in self._subscribers:
+            if subscriber.overflowed:
+                continue
+            try:
+                subscriber.queue.put_nowait(change)
+            except asyncio.QueueFull:
+                # 読み出しが追いつかない購読者には印を付け、DBから追いかけさせる
+                subscriber.overflowed = True
+
+    def _ensure_polling(self) -> None:
+        if self._poller is None:
+            self._ready = asyncio.Event()
+            self._wakeup = asyncio.Event()
+            self._poller = asyncio.create_task(self._poll_forever())
+
+    def _stop_polling(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+        self._poller = None
+        self._ready = None
+        self._wakeup = None
+        self._cursor = None
+
+    async def _poll_forever(self) -> None:
+        """変更履歴を1回だけ読み、購読者に配る（他のワーカーの変更も定期的に拾う）"""
+        while self._cursor is None:
+            try:
+                self._cursor = await get_latest_seq()
+            except Exception as e:
+                print(f"Failed to read the latest event change: {e}")
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        self._ready.set()
+        wakeup = self._wakeup
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            try:
+                while True:
+                    changes = await _load_changes(since=self._cursor, limit=BACKLOG_BATCH_SIZE)
+                    for change in changes:
+                        # 読み出しの間にプロセス内の通知で配った変更は飛ばす
+                        if change.seq > self._cursor:
+                            self._fan_out(to_change_schema(change))
+                    if len(changes) < BACKLOG_BATCH_SIZE:
+                        break
+            except Exception as e:
+                print(f"Failed to read event changes: {e}")
+
+    async def stream(self, since: int) -> AsyncIterator[Optional[schemas.EventChange]]:
+        """
+        since より後の変更を順に返す。新しい変更が無い間は定期的に None を返す（keep-alive用）。
+        再開位置までの履歴だけをDBから読み出し、その後は配信タスクが配る通知を待つ。
+        """
+        subscriber = _Subscriber()
+        self._subscribers.add(subscriber)
+        self._ensure_polling()
+        cursor = since
+        catching_up = True
+        try:
+            await self._ready.wait()
+            while True:
+                if catching_up:
+                    # 待ち行列を空にしてから配信済みの位置を記録すれば、それより後の変更は必ず待ち行列に届く
+                    while not subscriber.queue.empty():
+                        subscriber.queue.get_nowait()
+                    subscriber.overflowed = False
+                    target = self._cursor
+                    while cursor < target:
+                        backlog = await _load_changes(since=cursor, limit=BACKLOG_BATCH_SIZE, until=target)
+                        if not backlog:
+                            break
+                        for change in backlog:
+                            cursor = change.seq
+                            yield to_change_schema(change)
+                    cursor = max(cursor, target)
+                    catching_up = False
+
+                try:
+                    change = await asyncio.wait_for(subscriber.queue.get(), timeout=POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if subscriber.overflowed:
+                    # 取りこぼしがあるため、最後に返した位置からDBで読み直す
+                    catching_up = True
+                    continue
+                if change.seq > cursor:
+                    cursor = change.seq
+                    yield change
+        finally:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self._stop_polling()
+
+
+# アプリケーション全体で共有するハブ
+change_hub = ChangeHub()
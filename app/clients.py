@@ -0,0 +1,54 @@
+# app/clients.py
+
+import os
+from functools import cache
+from typing import TYPE_CHECKING, Optional
+
+from dotenv import load_dotenv
+
+if TYPE_CHECKING:
+    import openai
+    from .agent.search_improved import AsyncTavilyClient
+
+# openai / httpx のimportは重いため、最初に使われるまで読み込まない
+_openai_client: Optional["openai.AsyncOpenAI"] = None
+_tavily_client: Optional["AsyncTavilyClient"] = None
+
+
+@cache
+def load_environment() -> None:
+    """.envファイルから環境変数を読み込む（プロセスごとに1回だけ）"""
+    load_dotenv()
+
+
+def get_openai_client() -> "openai.AsyncOpenAI":
+    """共有のOpenAIクライアントを返す。初回呼び出し時に生成する"""
+    global _openai_client
+    if _openai_client is None:
+        import openai
+
+        load_environment()
+        _openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _openai_client
+
+
+def get_tavily_client() -> "AsyncTavilyClient":
+    """共有のTavilyクライアント（接続プールを共有する非同期クライアント）を返す。初回呼び出し時に生成する"""
+    global _tavily_client
+    if _tavily_client is None:
+        from .agent.search_improved import AsyncTavilyClient
+
+        load_environment()
+        _tavily_client = AsyncTavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
+    return _tavily_client
+
+
+async def close_clients() -> None:
+    """アプリケーション終了時に、生成済みのクライアントの接続を閉じる"""
+    global _openai_client, _tavily_client
+    if _openai_client is not None:
+        await _openai_client.close()
+    if _tavily_client is not None:
+        await _tavily_client.close()
+    _openai_client = None
+    _tavily_client = None
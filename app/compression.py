@@ -0,0 +1,277 @@
+# app/compression.py
+
+import os
+import time
+import zlib
+from typing import Callable, Optional
+
+try:
+    import brotli
+except ImportError:
+    # `uv sync --extra compression` でインストールしていない場合は、brotli で圧縮しない
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .negotiation import merge_vary
+
+# これより小さいレスポンスは圧縮しない（バイト数）。COMPRESSION_MIN_SIZE で変更できる
+DEFAULT_MINIMUM_SIZE = 1024
+# 圧縮率よりCPU時間を優先した圧縮レベル
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+# 圧縮するレスポンスの種類。Server-Sent Events は届くのが遅れるため圧縮しない
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "text/")
+UNCOMPRESSIBLE_TYPES = ("text/event-stream",)
+
+
+class _GzipEncoder:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdEncoder:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_encodings() -> dict[str, Callable]:
+    """使える圧縮方式（同じ優先度で受け付けられている場合は、先にあるものを選ぶ）"""
+    encoders: dict[str, Callable] = {}
+    if zstandard is not None:
+        encoders["zstd"] = _ZstdEncoder
+    if brotli is not None:
+        encoders["br"] = _BrotliEncoder
+    encoders["gzip"] = _GzipEncoder
+    return encoders
+
+
+def negotiate_encoding(accept_encoding: str, encoders: dict[str, Callable]) -> Optional[str]:
+    """Accept-Encoding のq値が最も高い方式を選ぶ。どれも受け付けられていなければ None"""
+    weights: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if name:
+            weights[name.strip().lower()] = q
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for name in encoders:
+        q = weights.get(name, wildcard)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _with_vary(headers: list[tuple[bytes, bytes]]) -> list[tuple[bytes, bytes]]:
+    """既存の Vary（Accept など）に Accept-Encoding を加えて、1つのヘッダーにまとめる"""
+    existing = ", ".join(value.decode("latin-1") for key, value in headers if key == b"vary")
+    merged = [(key, value) for key, value in headers if key != b"vary"]
+    merged.append((b"vary", merge_vary(existing, "Accept-Encoding").encode("latin-1")))
+    return merged
+
+
+def _is_compressible(headers: list[tuple[bytes, bytes]]) -> bool:
+    content_type = ""
+    for key, value in headers:
+        if key == b"content-encoding":
+            return False
+        if key == b"content-type":
+            content_type = value.decode("latin-1").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(UNCOMPRESSIBLE_TYPES)
+
+
+class CompressionStats:
+    """エンドポイントごとの圧縮前後のバイト数と、圧縮にかかったCPU時間"""
+
+    def __init__(self):
+        self._endpoints: dict[str, dict] = {}
+
+    def record(self, endpoint: str, encoding: str, raw_bytes: int, sent_bytes: int, cpu_seconds: float) -> None:
+        entry = self._endpoints.setdefault(endpoint, {})
+        stats = entry.setdefault(encoding, {"responses": 0, "raw_bytes": 0, "sent_bytes": 0, "cpu_seconds": 0.0})
+        stats["responses"] += 1
+        stats["raw_bytes"] += raw_bytes
+        stats["sent_bytes"] += sent_bytes
+        stats["cpu_seconds"] += cpu_seconds
+
+    def snapshot(self) -> dict:
+        return {
+            "encodings": list(available_encodings()),
+            "minimum_size": minimum_size(),
+            "endpoints": {
+                endpoint: {
+                    encoding: {
+                        **stats,
+                        "cpu_seconds": round(stats["cpu_seconds"], 4),
+                        "ratio": round(stats["sent_bytes"] / stats["raw_bytes"], 3) if stats["raw_bytes"] else None,
+                    }
+                    for encoding, stats in entry.items()
+                }
+                for endpoint, entry in self._endpoints.items()
+            },
+        }
+
+
+def compression_enabled() -> bool:
+    return os.getenv("COMPRESSION", "1").lower() not in ("0", "false", "off")
+
+
+def minimum_size() -> int:
+    return int(os.getenv("COMPRESSION_MIN_SIZE", DEFAULT_MINIMUM_SIZE))
+
+
+class CompressionMiddleware:
+    """
+    Accept-Encoding に応じて、レスポンスを zstd / brotli / gzip で圧縮するASGIミドルウェア。
+    一度に返すレスポンスは最小サイズ以上の場合のみ、分割して返すレスポンスは届いた部分から順に圧縮する。
+    圧縮できる種類のレスポンスには、圧縮しなかった場合も Vary: Accept-Encoding を付ける
+    （キャッシュが、Accept-Encoding の違うクライアントに同じレスポンスを返さないようにする）
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.encoders = available_encodings()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not compression_enabled():
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding, self.encoders) if accept_encoding else None
+        encoder_factory = self.encoders[encoding] if encoding is not None else None
+        await _CompressingResponder(self.app, scope, encoding, encoder_factory)(receive, send)
+
+
+class _CompressingResponder:
+    def __init__(self, app, scope, encoding: Optional[str], encoder_factory: Optional[Callable]):
+        self.app = app
+        self.scope = scope
+        self.encoding = encoding
+        self.encoder_factory = encoder_factory
+        self.start_message: Optional[dict] = None
+        self.encoder = None
+        # None: 圧縮するかまだ決めていない / False: そのまま返す
+        self.compressing: Optional[bool] = None
+        # 圧縮できる種類だが、圧縮せずにそのまま返すレスポンス（統計には identity として記録する）
+        self.identity = False
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_seconds = 0.0
+
+    async def __call__(self, receive, send):
+        self.send = send
+        await self.app(self.scope, receive, self._send)
+
+    def _compress(self, data: bytes, finish: bool) -> bytes:
+        started = time.thread_time()
+        compressed = self.encoder.compress(data)
+        if finish:
+            compressed += self.encoder.finish()
+        self.cpu_seconds += time.thread_time() - started
+        self.raw_bytes += len(data)
+        self.sent_bytes += len(compressed)
+        return compressed
+
+    def _count(self, data: bytes) -> None:
+        self.raw_bytes += len(data)
+        self.sent_bytes += len(data)
+
+    def _start_compressing(self) -> list[tuple[bytes, bytes]]:
+        self.compressing = True
+        self.encoder = self.encoder_factory()
+        headers = [(k, v) for k, v in _with_vary(self.start_message["headers"]) if k != b"content-length"]
+        headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        return headers
+
+    def _record(self) -> None:
+        route = self.scope.get("route")
+        path = getattr(route, "path", None) or "other"
+        compression_stats.record(
+            f"{self.scope['method']} {path}", self.encoding or "identity", self.raw_bytes, self.sent_bytes, self.cpu_seconds
+        )
+
+    async def _send(self, message):
+        if message["type"] == "http.response.start":
+            # 本文の最初の部分を見てから、圧縮するかを決める
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressing is None:
+            if not _is_compressible(self.start_message["headers"]):
+                self.compressing = False
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            if self.encoding is None or (not more_body and len(body) < minimum_size()):
+                # 圧縮しない場合も、Accept-Encoding によって結果が変わることをキャッシュに伝える
+                self.compressing = False
+                self.identity = True
+                await self.send({**self.start_message, "headers": _with_vary(self.start_message["headers"])})
+                self._count(body)
+                await self.send(message)
+                if not more_body:
+                    self._record()
+                return
+            headers = self._start_compressing()
+            compressed = self._compress(body, finish=not more_body)
+            if not more_body:
+                headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+            await self.send({**self.start_message, "headers": headers})
+            await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        elif self.compressing:
+            compressed = self._compress(body, finish=not more_body)
+            await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        else:
+            await self.send(message)
+            if not self.identity:
+                return
+            self._count(body)
+        if not more_body:
+            self._record()
+
+
+# アプリケーション全体で共有する統計
+compression_stats = CompressionStats()
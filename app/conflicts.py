@@ -0,0 +1,52 @@
+# app/conflicts.py
+
+import os
+import heapq
+from typing import Optional, Sequence
+
+from . import models, schemas
+
+# 予定の重複を禁止するかどうかの既定値（allow: 登録を許可する / reject: 409で拒否する）
+DEFAULT_OVERLAP_POLICY = "allow"
+
+
+def is_overlap_enforced(allow_overlap: Optional[bool] = None) -> bool:
+    """リクエストでの指定が無ければ、環境変数 EVENT_OVERLAP_POLICY の設定に従う"""
+    if allow_overlap is not None:
+        return not allow_overlap
+    return os.getenv("EVENT_OVERLAP_POLICY", DEFAULT_OVERLAP_POLICY).lower() == "reject"
+
+
+def find_conflict_groups(events: Sequence[models.Event]) -> list[schemas.EventConflictGroup]:
+    """
+    時間が重なり合う予定のまとまりを O(n log n) で求める。
+    開始時刻順に並べて走査し、実行中の予定の終了時刻をヒープで管理する。
+    終了と開始が同時刻の予定は重なりとみなさない。
+    """
+    groups: list[schemas.EventConflictGroup] = []
+    current: list[models.Event] = []
+    current_end = None
+    max_concurrent = 0
+    active_ends: list = []
+
+    def close_group() -> None:
+        if len(current) > 1:
+            groups.append(schemas.EventConflictGroup(
+                start_time=current[0].start_time,
+                end_time=current_end,
+                max_concurrent=max_concurrent,
+                events=list(current),
+            ))
+
+    for event in sorted(events, key=lambda e: (e.start_time, e.end_time, e.id)):
+        if current and event.start_time >= current_end:
+            close_group()
+            current, active_ends, max_concurrent = [], [], 0
+        while active_ends and active_ends[0] <= event.start_time:
+            heapq.heappop(active_ends)
+        heapq.heappush(active_ends, event.end_time)
+        max_concurrent = max(max_concurrent, len(active_ends))
+        current_end = max(current_end, event.end_time) if current else event.end_time
+        current.append(event)
+    close_group()
+    return groups
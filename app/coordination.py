@@ -0,0 +1,267 @@
+# app/coordination.py
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from typing import AsyncIterator, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows では SQLite 自身のロック(BEGIN IMMEDIATE)のみで排他する
+    fcntl = None
+
+DEFAULT_COORDINATION_DB_PATH = "./coordination.db"
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """プロセス間で排他するファイルロック（fcntl が無い環境では排他しない）"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CoordinationStore:
+    """
+    複数のワーカープロセスで共有する状態（キャッシュ・ロック・カウンター・トークンバケット）。
+    ローカルのSQLiteファイルに保存し、読み書きはファイルロックで直列化する。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._local = threading.local()
+        self._initialized = False
+        # 単一プロセス運用時のシングルフライト用
+        self._local_flights: set[str] = set()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.path is None:
+                self.path = os.getenv("COORDINATION_DB_PATH", DEFAULT_COORDINATION_DB_PATH)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            if not self._initialized:
+                self._create_tables(connection)
+                self._initialized = True
+        return connection
+
+    @staticmethod
+    def _create_tables(connection: sqlite3.Connection) -> None:
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                token TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                capacity REAL NOT NULL,
+                rate REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0
+            );
+            """
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """プロセス間で排他された読み書きトランザクション"""
+        connection = self._connection()
+        with file_lock(f"{self.path}.lock"):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    # --- キャッシュ ---
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at)
+            )
+
+    def delete(self, key: str) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def get_json(self, key: str) -> Optional[dict]:
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def update_json(self, key: str, update, ttl: Optional[float] = None) -> dict:
+        """キーのJSON値を読み出し、update(現在値 or None) の結果で原子的に置き換える"""
+        with self.transaction() as connection:
+            row = connection.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            current = None
+            if row is not None and (row[1] is None or row[1] >= time.time()):
+                current = json.loads(row[0])
+            new_value = update(current)
+            connection.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(new_value, ensure_ascii=False), time.time() + ttl if ttl else None),
+            )
+        return new_value
+
+    def incr(self, key: str, amount: float, ttl: Optional[float] = None) -> float:
+        """数値カウンターを加算し、加算後の値を返す"""
+        return self.update_json(key, lambda current: (current or 0) + amount, ttl=ttl)
+
+    # --- シングルフライト用のロック ---
+
+    def try_lock(self, name: str, ttl: float) -> Optional[str]:
+        """ロックを取得できればトークンを返す。期限切れのロックは奪い取る"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute("SELECT expires_at FROM locks WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] > now:
+                return None
+            connection.execute(
+                "INSERT OR REPLACE INTO locks (name, token, expires_at) VALUES (?, ?, ?)", (name, token, now + ttl)
+            )
+        return token
+
+    def unlock(self, name: str, token: str) -> None:
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM locks WHERE name = ? AND token = ?", (name, token))
+
+    @asynccontextmanager
+    async def single_flight(self, name: str, ttl: float = 300) -> AsyncIterator[bool]:
+        """
+        同じ名前の処理が全プロセスで同時に1つだけ走るようにする。
+        ロックを取得できた場合は True、他で実行中の場合は False を渡す。
+        """
+        if not is_shared_coordination_enabled():
+            if name in self._local_flights:
+                yield False
+                return
+            self._local_flights.add(name)
+            try:
+                yield True
+            finally:
+                self._local_flights.discard(name)
+            return
+
+        token = await asyncio.to_thread(self.try_lock, name, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token is not None:
+                await asyncio.to_thread(self.unlock, name, token)
+
+    # --- 共有トークンバケット ---
+
+    def bucket_try_take(self, requests: list[tuple[str, float, float, float]]) -> float:
+        """
+        複数のバケット (key, amount, per_minute, capacity) から原子的にトークンを取り出す。
+        全て取り出せた場合は0、足りない場合は取り出さずに待ち時間（秒）を返す。
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            states = []
+            wait = 0.0
+            for key, amount, per_minute, capacity in requests:
+                state = self._bucket_state(connection, key, per_minute, capacity, now)
+                states.append((key, amount, state))
+                if now < state["blocked_until"]:
+                    wait = max(wait, state["blocked_until"] - now)
+                    continue
+                needed = min(amount, state["capacity"])
+                if state["tokens"] < needed:
+                    wait = max(wait, (needed - state["tokens"]) / state["rate"])
+            if wait == 0:
+                for key, amount, state in states:
+                    state["tokens"] -= amount
+            for key, _, state in states:
+                self._save_bucket(connection, key, state, now)
+        return wait
+
+    def bucket_update(
+        self, key: str, per_minute: float, *, delta: float = 0, limit: Optional[float] = None,
+        remaining: Optional[float] = None, block_seconds: Optional[float] = None
+    ) -> None:
+        """消費量の補正や、上流のヘッダー・429に基づくバケットの補正を行う"""
+        now = time.time()
+        with self.transaction() as connection:
+            state = self._bucket_state(connection, key, per_minute, per_minute, now)
+            state["tokens"] -= delta
+            if limit:
+                state["capacity"] = limit
+                state["rate"] = limit / 60.0
+            if remaining is not None:
+                state["tokens"] = min(state["tokens"], remaining)
+            if block_seconds:
+                state["tokens"] = min(state["tokens"], 0.0)
+                state["blocked_until"] = max(state["blocked_until"], now + block_seconds)
+            self._save_bucket(connection, key, state, now)
+
+    def bucket_snapshot(self, key: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT tokens, capacity FROM buckets WHERE key = ?", (key,)
+        ).fetchone()
+        return {"tokens": row[0], "capacity": row[1]} if row else None
+
+    @staticmethod
+    def _bucket_state(connection: sqlite3.Connection, key: str, per_minute: float, capacity: float, now: float) -> dict:
+        row = connection.execute(
+            "SELECT tokens, capacity, rate, updated, blocked_until FROM buckets WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return {"tokens": capacity, "capacity": capacity, "rate": per_minute / 60.0, "blocked_until": 0.0}
+        tokens, stored_capacity, rate, updated, blocked_until = row
+        return {
+            "tokens": min(stored_capacity, tokens + (now - updated) * rate),
+            "capacity": stored_capacity,
+            "rate": rate,
+            "blocked_until": blocked_until,
+        }
+
+    @staticmethod
+    def _save_bucket(connection: sqlite3.Connection, key: str, state: dict, now: float) -> None:
+        connection.execute(
+            "INSERT OR REPLACE INTO buckets (key, tokens, capacity, rate, updated, blocked_until) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, state["tokens"], state["capacity"], state["rate"], now, state["blocked_until"]),
+        )
+
+
+def is_shared_coordination_enabled() -> bool:
+    """複数ワーカーで状態を共有するモードかどうか（COORDINATION_BACKEND=sqlite）"""
+    return os.getenv("COORDINATION_BACKEND", "local") == "sqlite"
+
+
+# アプリケーション全体で共有するストア
+coordination_store = CoordinationStore()
@@ -2,9 +2,17 @@
 
 from typing import Sequence
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from . import models, schemas
-from datetime import datetime
+from sqlalchemy import select, func, update, delete, text, case, or_, literal, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from pydantic import ValidationError
+import json
+from . import models, schemas, summaries
+from .database import IS_POSTGRESQL
+from .timezones import local_date, resolve_timezone, timezone_settings, user_timezone, utc_now
+from .change_feed import change_hub, to_change_schema
+from .profile_cache import profile_cache
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
 
 # --- Event CRUD ---
 
@@ -12,14 +20,144 @@ async def get_event(db: AsyncSession, event_id: int) -> models.Event | None:
     result = await db.execute(select(models.Event).filter(models.Event.id == event_id))
     return result.scalars().first()
 
+def _overlaps_period(start: datetime, end: datetime):
+    """予定の期間が [start, end) と重なる条件（終了と開始が同時刻の場合は重なりとみなさない）"""
+    if IS_POSTGRESQL:
+        # tsrange の GiST インデックス(ix_events_time_range_gist)で判定する
+        period = func.tsrange(literal(start, models.UTCDateTime()), literal(end, models.UTCDateTime()))
+        return func.tsrange(models.Event.start_time, models.Event.end_time).op("&&")(period)
+    return (models.Event.start_time < end) & (models.Event.end_time > start)
+
 async def get_events_by_period(db: AsyncSession, start: datetime, end: datetime) -> Sequence[models.Event]:
     result = await db.execute(
         select(models.Event)
-        .filter(models.Event.start_time < end, models.Event.end_time > start)
+        .filter(_overlaps_period(start, end))
         .order_by(models.Event.start_time)
     )
     return result.scalars().all()
 
+async def get_overlapping_events(
+    db: AsyncSession, start: datetime, end: datetime, exclude_id: int | None = None
+) -> Sequence[models.Event]:
+    """指定された期間と時間が重なる予定を取得する（終了と開始が同時刻の場合は重なりとみなさない）"""
+    query = select(models.Event).filter(_overlaps_period(start, end))
+    if exclude_id is not None:
+        query = query.filter(models.Event.id != exclude_id)
+    result = await db.execute(query.order_by(models.Event.start_time))
+    return result.scalars().all()
+
+# trigram トークナイザは3文字以上の語のみ索引を使えるため、それより短い語は LIKE で絞り込む
+# （短い語だけの検索は、期間の指定が無ければ全件を走査する）
+FTS_MIN_TERM_LENGTH = 3
+# 前方一致の範囲検索の上限に使う文字（「京都*」→ "京都" <= title < "京都\U0010ffff"）
+PREFIX_UPPER_BOUND = "\U0010ffff"
+
+def _like_pattern(term: str, prefix: bool = False) -> str:
+    """LIKE / ILIKE の特殊文字（%・_）をエスケープしたパターン（ESCAPE '\\' と組み合わせて使う）"""
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%" if prefix else f"%{escaped}%"
+
+def _parse_search_terms(query: str) -> list[tuple[str, bool]]:
+    """検索語を (語, 前方一致か) のリストにする。「京都*」のように末尾に * を付けた語は前方一致"""
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if term:
+            terms.append((term, prefix))
+    return terms
+
+async def search_events(
+    db: AsyncSession,
+    query: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> Sequence[models.Event]:
+    """
+    タイトル・場所・説明をFTS5索引で全文検索し、関連度順（タイトル > 場所 > 説明の重み付け）に返す。
+    各語は部分一致で、複数の語はAND条件として扱う。末尾に * を付けた語は、タイトルか場所がその語で始まる予定に一致する
+    （タイトル・場所のインデックスの範囲検索を使うため、短い語でも全件を走査しない）。
+    """
+    if IS_POSTGRESQL:
+        return await _search_events_trigram(db, query, start, end, limit, offset)
+    params: dict = {"limit": limit, "offset": offset}
+    match_terms: list[str] = []
+    conditions: list[str] = []
+    for i, (term, prefix) in enumerate(_parse_search_terms(query)):
+        if len(term) >= FTS_MIN_TERM_LENGTH:
+            match_terms.append('"' + term.replace('"', '""') + '"')
+        if prefix:
+            params[f"low_{i}"] = term
+            params[f"high_{i}"] = term + PREFIX_UPPER_BOUND
+            conditions.append(
+                f"((events.title >= :low_{i} AND events.title < :high_{i})"
+                f" OR (events.location >= :low_{i} AND events.location < :high_{i}))"
+            )
+        elif len(term) < FTS_MIN_TERM_LENGTH:
+            params[f"like_{i}"] = _like_pattern(term)
+            conditions.append(
+                f"(events.title LIKE :like_{i} ESCAPE '\\' OR events.location LIKE :like_{i} ESCAPE '\\'"
+                f" OR events.description LIKE :like_{i} ESCAPE '\\')"
+            )
+    if not match_terms and not conditions:
+        return []
+    # 日時は列と同じく UTCDateTime で変換して（タイムゾーン無しのUTCにして）比較する
+    period_params = []
+    if start is not None:
+        conditions.append("events.end_time > :start")
+        period_params.append(bindparam("start", start, type_=models.UTCDateTime()))
+    if end is not None:
+        conditions.append("events.start_time < :end")
+        period_params.append(bindparam("end", end, type_=models.UTCDateTime()))
+
+    if match_terms:
+        params["match"] = " AND ".join(match_terms)
+        sql = (
+            "SELECT events.* FROM events_fts JOIN events ON events.id = events_fts.rowid "
+            "WHERE events_fts MATCH :match"
+            + "".join(f" AND {condition}" for condition in conditions)
+            + " ORDER BY bm25(events_fts, 10.0, 5.0, 1.0), events.start_time"
+        )
+    else:
+        sql = "SELECT events.* FROM events WHERE " + " AND ".join(conditions) + " ORDER BY events.start_time"
+
+    statement = text(sql + " LIMIT :limit OFFSET :offset").bindparams(*period_params, **params)
+    result = await db.execute(select(models.Event).from_statement(statement))
+    return result.scalars().all()
+
+async def _search_events_trigram(
+    db: AsyncSession, query: str, start: datetime | None, end: datetime | None, limit: int, offset: int
+) -> Sequence[models.Event]:
+    """PostgreSQL 用。pg_trgm のGINインデックスを使う ILIKE で絞り込み、一致した列の重みの合計で並べる"""
+    columns = ((models.Event.title, 10), (models.Event.location, 5), (models.Event.description, 1))
+    conditions = []
+    score = literal(0)
+    for term, prefix in _parse_search_terms(query):
+        if prefix:
+            # SQLite と同じく、タイトルか場所がその語で始まる予定
+            matches = [column.ilike(_like_pattern(term, prefix=True), escape="\\") for column, _ in columns[:2]]
+        else:
+            matches = [column.ilike(_like_pattern(term), escape="\\") for column, _ in columns]
+        conditions.append(or_(*matches))
+        for match, (_, weight) in zip(matches, columns):
+            score = score + case((match, weight), else_=0)
+    if not conditions:
+        return []
+    if start is not None:
+        conditions.append(models.Event.end_time > start)
+    if end is not None:
+        conditions.append(models.Event.start_time < end)
+    result = await db.execute(
+        select(models.Event)
+        .filter(*conditions)
+        .order_by(score.desc(), models.Event.start_time)
+        .limit(limit)
+        .offset(offset)
+    )
+    return result.scalars().all()
+
 async def get_recently_updated_events(db: AsyncSession, limit: int = 5) -> Sequence[models.Event]:
     """最近追加された予定を取得する"""
     result = await db.execute(
@@ -29,35 +167,312 @@ async def get_recently_updated_events(db: AsyncSession, limit: int = 5) -> Seque
     )
     return result.scalars().all()
 
-async def create_event(db: AsyncSession, event: schemas.EventCreate) -> models.Event:
+# 変更履歴への書き込みを直列化する、トランザクション単位のアドバイザリロックのキー（PostgreSQLのみ）
+CHANGE_LOG_LOCK_KEY = 0x65766368
+
+async def _lock_change_log(db: AsyncSession) -> None:
+    """
+    変更履歴に追記するトランザクションを、コミットまで1つずつにする。
+    PostgreSQL では seq は挿入時にシーケンスから採番されるため、後の seq が先にコミットされると、
+    読み手（変更フィード・差分同期）がカーソルを進めた後で前の seq が現れ、その変更を取りこぼす。
+    集計の行ロックより先に取ることで、ロックの順序を揃えてデッドロックを避ける。
+    SQLite は書き込みが常に1つずつのため何もしない
+    """
+    if IS_POSTGRESQL:
+        await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK_KEY})
+
+def _append_change(db: AsyncSession, event_id: int, operation: str, data: dict) -> models.EventChange:
+    """予定の変更を、同じトランザクション内で変更履歴に追記する（先に _lock_change_log を呼んでおく）"""
+    change = models.EventChange(
+        event_id=event_id, operation=operation, payload=json.dumps(data, ensure_ascii=False, default=str)
+    )
+    db.add(change)
+    return change
+
+def _publish_change(change: models.EventChange) -> None:
+    """コミット済みの変更を、変更フィードの購読者とプロフィールのキャッシュに通知する"""
+    change_hub.publish(to_change_schema(change))
+    profile_cache.note_event_change()
+
+async def _lock_daily_summaries(db: AsyncSession, days: list[date]) -> dict[date, models.DailySummary]:
+    """
+    日ごとの集計の行を、無ければ作成してから行ロックを取って読み込む。
+    PostgreSQL では複数の書き込みが並行するため、同じ日の集計を同時に更新して差分が失われないようにする。
+    """
+    empty = summaries.DayTotals()
+    insert = postgresql.insert if IS_POSTGRESQL else sqlite.insert
+    await db.execute(
+        insert(models.DailySummary)
+        .values([
+            {
+                "day": day, "event_count": 0, "busy_seconds": 0, "version": 0,
+                "hourly_seconds": json.dumps(empty.hourly_seconds), "locations": "{}", "categories": "{}",
+            }
+            for day in days
+        ])
+        .on_conflict_do_nothing(index_elements=["day"])
+    )
+    # デッドロックを避けるため、常に日付順にロックする
+    result = await db.execute(
+        select(models.DailySummary)
+        .filter(models.DailySummary.day.in_(days))
+        .order_by(models.DailySummary.day)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    return {row.day: row for row in result.scalars().all()}
+
+async def _apply_to_summaries(
+    db: AsyncSession, before: summaries.EventFacts | None, after: summaries.EventFacts | None
+) -> None:
+    """予定の書き込みによる日ごとの集計の差分を、同じトランザクション内で反映する"""
+    if before == after:
+        return
+    deltas: dict[date, list[tuple[summaries.DayTotals, int]]] = {}
+    for facts, sign in ((before, -1), (after, 1)):
+        if facts is None:
+            continue
+        for day, day_totals in summaries.event_totals(facts, user_timezone()).items():
+            deltas.setdefault(day, []).append((day_totals, sign))
+    if not deltas:
+        return
+    rows = await _lock_daily_summaries(db, sorted(deltas))
+    for day, day_deltas in deltas.items():
+        row = rows[day]
+        totals = summaries.DayTotals.from_row(row)
+        for day_totals, sign in day_deltas:
+            totals.add(day_totals, sign)
+        totals.write_to(row)
+        row.version += 1
+
+def _set_local_dates(db_event: models.Event, tz: ZoneInfo | None = None) -> None:
+    """ユーザーのタイムゾーンでの開始・終了の日付を計算する（直前・直後の予定の検索用）"""
+    tz = tz or user_timezone()
+    db_event.local_start_date = local_date(db_event.start_time, tz)
+    db_event.local_end_date = local_date(db_event.end_time, tz)
+
+async def _add_event(db: AsyncSession, event: schemas.EventCreate) -> tuple[models.Event, models.EventChange]:
+    await _lock_change_log(db)
     db_event = models.Event(**event.model_dump())
+    _set_local_dates(db_event)
     db.add(db_event)
+    await db.flush()
+    await _apply_to_summaries(db, None, summaries.EventFacts.of(db_event))
+    change = _append_change(
+        db, db_event.id, "created", schemas.Event.model_validate(db_event).model_dump(mode="json")
+    )
+    return db_event, change
+
+async def _apply_event_update(
+    db: AsyncSession, db_event: models.Event, event_update: schemas.EventUpdate
+) -> models.EventChange | None:
+    await _lock_change_log(db)
+    update_data = event_update.model_dump(exclude_unset=True)
+    before = summaries.EventFacts.of(db_event)
+    changed_fields = {}
+    for key, value in update_data.items():
+        if getattr(db_event, key) != value:
+            changed_fields[key] = value
+        setattr(db_event, key, value)
+    _set_local_dates(db_event)
+    await db.flush()
+    if not changed_fields:
+        return None
+    await _apply_to_summaries(db, before, summaries.EventFacts.of(db_event))
+    # 変更フィードには差分だけを載せる
+    data = schemas.EventUpdate(**changed_fields).model_dump(mode="json", exclude_unset=True)
+    data["updated_at"] = db_event.updated_at.isoformat()
+    return _append_change(db, db_event.id, "updated", data)
+
+async def _remove_event(db: AsyncSession, db_event: models.Event) -> models.EventChange:
+    await _lock_change_log(db)
+    # 予定は物理削除し、変更履歴の deleted を削除の記録（トゥームストーン）として残す
+    change = _append_change(db, db_event.id, "deleted", {})
+    await _apply_to_summaries(db, summaries.EventFacts.of(db_event), None)
+    await db.delete(db_event)
+    await db.flush()
+    return change
+
+async def create_event(db: AsyncSession, event: schemas.EventCreate) -> models.Event:
+    db_event, change = await _add_event(db, event)
     await db.commit()
     await db.refresh(db_event)
+    _publish_change(change)
     return db_event
 
 #
 async def update_event(db: AsyncSession, db_event: models.Event, event_update: schemas.EventUpdate) -> models.Event:
-    update_data = event_update.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_event, key, value)
+    change = await _apply_event_update(db, db_event, event_update)
     await db.commit()
     await db.refresh(db_event)
+    if change is not None:
+        _publish_change(change)
     return db_event
 
 #
 async def delete_event(db: AsyncSession, db_event: models.Event) -> models.Event:
-    await db.delete(db_event)
+    change = await _remove_event(db, db_event)
     await db.commit()
+    _publish_change(change)
     return db_event
 
+async def get_event_changes(db: AsyncSession, since: int, limit: int = 100) -> Sequence[models.EventChange]:
+    """指定された通し番号より後の変更履歴を古い順に取得する"""
+    result = await db.execute(
+        select(models.EventChange)
+        .filter(models.EventChange.seq > since)
+        .order_by(models.EventChange.seq)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+async def get_latest_change_seq(db: AsyncSession) -> int:
+    result = await db.execute(select(func.max(models.EventChange.seq)))
+    return result.scalar() or 0
+
+async def get_events_after_id(db: AsyncSession, after_id: int, limit: int) -> Sequence[models.Event]:
+    """ID順に予定を取得する（差分同期の初回の全件取得用）"""
+    result = await db.execute(
+        select(models.Event).filter(models.Event.id > after_id).order_by(models.Event.id).limit(limit)
+    )
+    return result.scalars().all()
+
+async def get_events_by_ids(db: AsyncSession, event_ids: Sequence[int]) -> Sequence[models.Event]:
+    if not event_ids:
+        return []
+    result = await db.execute(select(models.Event).filter(models.Event.id.in_(event_ids)))
+    return result.scalars().all()
+
+async def apply_event_mutations(
+    db: AsyncSession, mutations: Sequence[schemas.EventMutation], enforce_overlap: bool = False
+) -> list[schemas.EventMutationResult]:
+    """
+    クライアント側の変更をまとめて1つのトランザクションで適用する。
+    base_updated_at がサーバー側の updated_at と一致しない変更は、適用せずに競合として返す。
+    他の予定（同じバッチで先に適用したものを含む）と時間が重なる作成・更新は、重なっている予定を conflicts に入れる。
+    enforce_overlap が True の場合は、そのような変更を適用せずに競合として返す。
+    """
+    results: list[schemas.EventMutationResult] = []
+    changes: list[models.EventChange] = []
+    touched: list[tuple[int, models.Event]] = []
+
+    for mutation in mutations:
+        result = schemas.EventMutationResult(ref=mutation.ref, status="applied", event_id=mutation.event_id)
+        results.append(result)
+
+        if mutation.operation == "create":
+            try:
+                event = schemas.EventCreate.model_validate(
+                    (mutation.event or schemas.EventUpdate()).model_dump(exclude_unset=True)
+                )
+            except ValidationError as e:
+                result.status, result.detail = "rejected", f"Invalid event: {e.errors()[0]['msg']}"
+                continue
+            if event.start_time >= event.end_time:
+                result.status, result.detail = "rejected", "End time must be after start time."
+                continue
+            overlapping = await get_overlapping_events(db, event.start_time, event.end_time)
+            result.conflicts = [schemas.Event.model_validate(e) for e in overlapping]
+            if overlapping and enforce_overlap:
+                result.status, result.detail = "conflict", "Event overlaps with existing events"
+                continue
+            db_event, change = await _add_event(db, event)
+            changes.append(change)
+            result.event_id = db_event.id
+            touched.append((len(results) - 1, db_event))
+            continue
+
+        db_event = await get_event(db, mutation.event_id) if mutation.event_id is not None else None
+        if db_event is None:
+            # 他の端末で削除済みの予定への変更も競合として扱う
+            result.status, result.detail = "conflict", "Event not found"
+            continue
+        if mutation.base_updated_at is not None and db_event.updated_at != mutation.base_updated_at:
+            result.status, result.detail = "conflict", "Event was modified on the server"
+            result.event = schemas.Event.model_validate(db_event)
+            continue
+
+        if mutation.operation == "delete":
+            changes.append(await _remove_event(db, db_event))
+            continue
+
+        event_update = mutation.event or schemas.EventUpdate()
+        start_time = event_update.start_time or db_event.start_time
+        end_time = event_update.end_time or db_event.end_time
+        if start_time >= end_time:
+            result.status, result.detail = "rejected", "End time must be after start time."
+            continue
+        overlapping = await get_overlapping_events(db, start_time, end_time, exclude_id=db_event.id)
+        result.conflicts = [schemas.Event.model_validate(e) for e in overlapping]
+        if overlapping and enforce_overlap:
+            result.status, result.detail = "conflict", "Event overlaps with existing events"
+            continue
+        change = await _apply_event_update(db, db_event, event_update)
+        if change is not None:
+            changes.append(change)
+        touched.append((len(results) - 1, db_event))
+
+    await db.commit()
+    for index, db_event in touched:
+        await db.refresh(db_event)
+        results[index].event = schemas.Event.model_validate(db_event)
+    for change in changes:
+        _publish_change(change)
+    return results
+
+async def get_daily_summaries(db: AsyncSession, start: date, end: date) -> Sequence[models.DailySummary]:
+    """指定した期間（end の日を含む）の日ごとの集計を取得する"""
+    result = await db.execute(
+        select(models.DailySummary)
+        .filter(models.DailySummary.day >= start, models.DailySummary.day <= end)
+        .order_by(models.DailySummary.day)
+    )
+    return result.scalars().all()
+
+async def _rebuild_daily_summaries(db: AsyncSession, tz: ZoneInfo | None = None) -> int:
+    result = await db.execute(select(models.DailySummary))
+    rows = {row.day: row for row in result.scalars().all()}
+    events = await db.stream_scalars(select(models.Event).execution_options(yield_per=1000))
+    merged: dict[date, summaries.DayTotals] = {}
+    tz = tz or user_timezone()
+    async for event in events:
+        summaries.accumulate(merged, event, tz)
+    for day in rows.keys() | merged.keys():
+        row = rows.get(day)
+        if row is None:
+            row = models.DailySummary(day=day, version=0)
+            db.add(row)
+        merged.get(day, summaries.DayTotals()).write_to(row)
+        row.version += 1
+    return len(merged)
+
+async def rebuild_daily_summaries(db: AsyncSession) -> int:
+    """全ての予定から日ごとの集計を作り直す。version は既存の値から引き続き増やす。集計した日数を返す"""
+    days = await _rebuild_daily_summaries(db)
+    await db.commit()
+    return days
+
+async def get_daily_summary_version(db: AsyncSession, day: date) -> int:
+    """その日の集計の version（予定が変わるたびに増える）。予定が一度も無い日は 0"""
+    result = await db.execute(select(models.DailySummary.version).filter(models.DailySummary.day == day))
+    return result.scalar() or 0
+
+async def ensure_daily_summaries(db: AsyncSession) -> None:
+    """集計表を追加する前からある予定を、初回の起動時に集計する"""
+    has_summaries = await db.execute(select(models.DailySummary.day).limit(1))
+    if has_summaries.first() is not None:
+        return
+    has_events = await db.execute(select(models.Event.id).limit(1))
+    if has_events.first() is not None:
+        await rebuild_daily_summaries(db)
+
 async def get_previous_event(db: AsyncSession, target_time: datetime) -> models.Event | None:
-    """指定された時間と同じ日付で、それより前に終了する最も直近のイベントを取得する"""
-    target_date = target_time.date()
+    """指定された時間と同じ日付（ユーザーのタイムゾーン）で、それより前に終了する最も直近のイベントを取得する"""
+    target_date = local_date(target_time)
     result = await db.execute(
         select(models.Event)
         .filter(
-            func.date(models.Event.end_time) == target_date,
+            models.Event.local_end_date == target_date,
             models.Event.end_time <= target_time
         )
         .order_by(models.Event.end_time.desc())
@@ -66,12 +481,12 @@ async def get_previous_event(db: AsyncSession, target_time: datetime) -> models.
     return result.scalars().first()
 
 async def get_next_event(db: AsyncSession, target_time: datetime) -> models.Event | None:
-    """指定された時間と同じ日付で、それより後に開始する最も直近のイベントを取得する"""
-    target_date = target_time.date()
+    """指定された時間と同じ日付（ユーザーのタイムゾーン）で、それより後に開始する最も直近のイベントを取得する"""
+    target_date = local_date(target_time)
     result = await db.execute(
         select(models.Event)
         .filter(
-            func.date(models.Event.start_time) == target_date,
+            models.Event.local_start_date == target_date,
             models.Event.start_time >= target_time
         )
         .order_by(models.Event.start_time.asc())
@@ -79,6 +494,58 @@ async def get_next_event(db: AsyncSession, target_time: datetime) -> models.Even
     )
     return result.scalars().first()
 
+# --- User Settings CRUD ---
+
+async def get_user_timezone_name(db: AsyncSession) -> str | None:
+    result = await db.execute(select(models.UserSettings.timezone).filter(models.UserSettings.id == 1))
+    return result.scalar()
+
+async def set_user_timezone(db: AsyncSession, name: str) -> None:
+    """
+    ユーザーのタイムゾーンを変更し、予定の日付と日ごとの集計を新しいタイムゾーンで計算し直す。
+    他のワーカーは、設定を読み直すまで（最大 SETTINGS_REFRESH_SECONDS 秒）古いタイムゾーンを使う。
+    """
+    settings = await db.get(models.UserSettings, 1)
+    if settings is None:
+        settings = models.UserSettings(id=1, timezone=name)
+        db.add(settings)
+    settings.timezone = name
+    tz = resolve_timezone(name)
+    events = await db.stream_scalars(select(models.Event).execution_options(yield_per=1000))
+    async for event in events:
+        _set_local_dates(event, tz)
+    await _rebuild_daily_summaries(db, tz)
+    await db.commit()
+    timezone_settings.set(name)
+
+async def migrate_legacy_event_times(db: AsyncSession) -> int:
+    """
+    UTCに移行する前の予定（サーバーのローカル時刻で保存され、日付の列が NULL のもの）を、
+    ユーザーのタイムゾーンの時刻とみなしてUTCに変換する。差分同期のクライアントにも伝わるよう変更履歴に残す。
+    """
+    tz = user_timezone()
+    result = await db.execute(select(models.Event).filter(models.Event.local_start_date.is_(None)))
+    legacy_events = result.scalars().all()
+    if legacy_events:
+        await _lock_change_log(db)
+    for db_event in legacy_events:
+        # 読み出し時に付いたUTCを外し、保存されていた値をローカル時刻として解釈し直す
+        for key in ("start_time", "end_time", "created_at", "updated_at"):
+            value = getattr(db_event, key)
+            if value is not None:
+                setattr(db_event, key, value.replace(tzinfo=tz))
+        _set_local_dates(db_event)
+        await db.flush()
+        _append_change(db, db_event.id, "updated", {
+            "start_time": db_event.start_time.isoformat(),
+            "end_time": db_event.end_time.isoformat(),
+            "updated_at": db_event.updated_at.isoformat(),
+        })
+    if legacy_events:
+        await _rebuild_daily_summaries(db)
+    await db.commit()
+    return len(legacy_events)
+
 # --- User Profile CRUD ---
 
 async def create_user_profile(db: AsyncSession, profile: schemas.UserProfileCreate) -> models.UserProfile:
@@ -92,13 +559,156 @@ async def create_user_profile(db: AsyncSession, profile: schemas.UserProfileCrea
 async def get_latest_user_profile(db: AsyncSession) -> models.UserProfile | None:
     """Get the most recent user profile from the database."""
     result = await db.execute(
-        select(models.UserProfile).order_by(models.UserProfile.created_at.desc())
+        select(models.UserProfile)
+        .order_by(models.UserProfile.created_at.desc(), models.UserProfile.id.desc())
+        .limit(1)
     )
     return result.scalars().first()
 
+async def delete_old_user_profiles(db: AsyncSession, keep: int) -> int:
+    """新しい順に keep 件を残して、古いプロフィールを削除する。削除した件数を返す"""
+    newest = (
+        select(models.UserProfile.id)
+        .order_by(models.UserProfile.created_at.desc(), models.UserProfile.id.desc())
+        .limit(keep)
+    )
+    result = await db.execute(
+        delete(models.UserProfile).where(models.UserProfile.id.not_in(newest.scalar_subquery()))
+    )
+    await db.commit()
+    return result.rowcount
+
 async def has_events_updated_since(db: AsyncSession, since: datetime) -> bool:
     """指定された日時以降に更新されたイベントが存在するかどうかをチェックする"""
     result = await db.execute(
         select(models.Event.id).filter(models.Event.updated_at >= since).limit(1)
     )
     return result.scalars().first() is not None
+
+# --- Generated Plan CRUD ---
+
+async def create_generated_plans(db: AsyncSession, plans: Sequence[models.GeneratedPlan]) -> None:
+    db.add_all(plans)
+    await db.commit()
+
+async def get_generated_plan(db: AsyncSession, plan_id: str) -> models.GeneratedPlan | None:
+    """期限内のプランを取得する（期限切れで未削除のものは無いものとして扱う）"""
+    result = await db.execute(
+        select(models.GeneratedPlan)
+        .filter(models.GeneratedPlan.id == plan_id, models.GeneratedPlan.expires_at > utc_now())
+    )
+    return result.scalars().first()
+
+async def accept_generated_plan(
+    db: AsyncSession, plan_id: str, pattern_index: int, events: Sequence[schemas.EventCreate]
+) -> list[models.Event] | None:
+    """
+    プランのパターンを採用済みにし、その予定をまとめて1つのトランザクションで登録する。
+    他のリクエストで先に採用された（または期限が切れた）場合は何も登録せずに None を返す。
+    """
+    result = await db.execute(
+        update(models.GeneratedPlan)
+        .where(
+            models.GeneratedPlan.id == plan_id,
+            models.GeneratedPlan.accepted_at.is_(None),
+            models.GeneratedPlan.expires_at > utc_now(),
+        )
+        .values(accepted_pattern=pattern_index, accepted_at=utc_now())
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        return None
+    added = [await _add_event(db, event) for event in events]
+    await db.commit()
+    for db_event, change in added:
+        await db.refresh(db_event)
+        _publish_change(change)
+    return [db_event for db_event, _ in added]
+
+async def delete_expired_generated_plans(db: AsyncSession) -> int:
+    result = await db.execute(
+        delete(models.GeneratedPlan).where(models.GeneratedPlan.expires_at <= utc_now())
+    )
+    await db.commit()
+    return result.rowcount
+
+# --- Plan Job CRUD ---
+
+async def create_plan_job(db: AsyncSession, job: models.PlanJob) -> models.PlanJob:
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+async def get_plan_job(db: AsyncSession, job_id: str) -> models.PlanJob | None:
+    result = await db.execute(select(models.PlanJob).filter(models.PlanJob.id == job_id))
+    return result.scalars().first()
+
+async def get_active_plan_job_by_hash(db: AsyncSession, request_hash: str) -> models.PlanJob | None:
+    """同じリクエスト内容で、まだ完了していないジョブを取得する"""
+    result = await db.execute(
+        select(models.PlanJob)
+        .filter(
+            models.PlanJob.request_hash == request_hash,
+            models.PlanJob.status.in_(["queued", "running"])
+        )
+        .order_by(models.PlanJob.created_at.desc())
+        .limit(1)
+    )
+    return result.scalars().first()
+
+async def get_unfinished_plan_jobs(db: AsyncSession) -> Sequence[models.PlanJob]:
+    result = await db.execute(
+        select(models.PlanJob)
+        .filter(models.PlanJob.status.in_(["queued", "running"]))
+        .order_by(models.PlanJob.priority.desc(), models.PlanJob.created_at)
+    )
+    return result.scalars().all()
+
+async def claim_plan_job(db: AsyncSession, job_id: str) -> bool:
+    """queued のジョブを running に遷移させる。他のワーカーが先に取得していればFalseを返す"""
+    result = await db.execute(
+        update(models.PlanJob)
+        .where(models.PlanJob.id == job_id, models.PlanJob.status == "queued")
+        .values(status="running", updated_at=utc_now())
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+async def finish_plan_job(
+    db: AsyncSession, job_id: str, result_payload: str | None = None, error: str | None = None
+) -> None:
+    now = utc_now()
+    await db.execute(
+        update(models.PlanJob)
+        .where(models.PlanJob.id == job_id)
+        .values(
+            status="failed" if error is not None else "succeeded",
+            result_payload=result_payload,
+            error=error,
+            updated_at=now,
+            finished_at=now,
+        )
+    )
+    await db.commit()
+
+async def delete_finished_plan_jobs(db: AsyncSession, finished_before: datetime) -> int:
+    """finished_before より前に完了したジョブを削除し、削除した件数を返す"""
+    result = await db.execute(
+        delete(models.PlanJob)
+        .where(models.PlanJob.status.in_(["succeeded", "failed"]), models.PlanJob.finished_at < finished_before)
+    )
+    await db.commit()
+    return result.rowcount
+
+async def requeue_plan_jobs(db: AsyncSession, stale_before: datetime) -> None:
+    """
+    中断された running のジョブを queued に戻す（起動時の復旧用）。
+    他のワーカープロセスが実行中のジョブを奪わないよう、stale_before より前から止まっているものだけを対象にする。
+    """
+    await db.execute(
+        update(models.PlanJob)
+        .where(models.PlanJob.status == "running", models.PlanJob.updated_at < stale_before)
+        .values(status="queued", updated_at=utc_now())
+    )
+    await db.commit()
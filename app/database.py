@@ -1,15 +1,71 @@
+import os
+import asyncio
 from collections.abc import AsyncGenerator
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
 
-# SQLiteデータベースのURL
-# 非同期用のドライバ `aiosqlite` を指定
-SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./calendar.db"
+# データベースのURL。DATABASE_URL で切り替える
+# - 開発（デフォルト）: SQLite（非同期用のドライバ `aiosqlite`）
+# - 本番: PostgreSQL（非同期用のドライバ `asyncpg`。`uv sync --extra postgres` でインストールする）
+#   例: DATABASE_URL=postgresql://user:password@db:5432/calendar
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///./calendar.db"
+
+# PostgreSQL の接続プールの既定値（ワーカープロセスごと）
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT_SECONDS = 30
+DEFAULT_POOL_RECYCLE_SECONDS = 1800
+# 複数のワーカーが同時にスキーマを作成して衝突した場合に、作り直しを試みる回数
+SCHEMA_INIT_ATTEMPTS = 5
+
+
+def resolve_database_url(url: str | None = None) -> str:
+    """DATABASE_URL を非同期ドライバ付きのURLに正規化する（postgres:// などの省略形も受け付ける）"""
+    url = url or os.getenv("DATABASE_URL") or DEFAULT_DATABASE_URL
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
+
+
+SQLALCHEMY_DATABASE_URL = resolve_database_url()
+
+
+def _engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        # 複数ワーカーから同時に書き込む場合に備えて、ロック待ちのタイムアウトを長めにする
+        return {"connect_args": {"check_same_thread": False, "timeout": 30}}
+    # 接続数はワーカー数 × (pool_size + max_overflow) になるため、DBの max_connections に合わせて調整する
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", DEFAULT_MAX_OVERFLOW)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT_SECONDS)),
+        # DB側やロードバランサーで切断された接続を使わないようにする
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", DEFAULT_POOL_RECYCLE_SECONDS)),
+        "pool_pre_ping": True,
+    }
+
 
 # 非同期エンジンを作成
-engine = create_async_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = create_async_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL))
+
+# 方言ごとに処理を分ける箇所（全文検索・期間の検索など）で使う
+DIALECT = engine.dialect.name
+IS_SQLITE = DIALECT == "sqlite"
+IS_POSTGRESQL = DIALECT == "postgresql"
+
+if IS_SQLITE:
+    # WALモードにして、書き込み中でも他のワーカーが読み出せるようにする
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
 
 # 非同期セッションを作成するためのメーカー
 # autoflush=False, autocommit=False は非同期処理で標準的な設定
@@ -24,3 +80,72 @@ Base = declarative_base()
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
         yield session
+
+# テーブル以外のスキーマオブジェクト（FTS5の仮想テーブルやトリガー、方言固有のインデックスなど）
+# (方言, スキーマ上の名前, 作成時に実行するSQLのリスト) の形で models.py から登録する
+extra_schema_objects: list[tuple[str, str, list[str]]] = []
+
+# 既存のテーブル・インデックスなどの名前を取得するSQL
+_EXISTING_NAMES_SQL = {
+    "sqlite": "SELECT name FROM sqlite_master",
+    "postgresql": "SELECT relname FROM pg_class WHERE relnamespace = current_schema()::regnamespace",
+}
+
+def _missing_columns(connection, existing_names: set[str]) -> list:
+    """既存のテーブルに後から追加した列（create_all は既存テーブルに列を追加しない）"""
+    inspector = inspect(connection)
+    missing = []
+    for table in Base.metadata.tables.values():
+        if table.name not in existing_names:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing_columns)
+    return missing
+
+async def init_db() -> None:
+    """
+    テーブルなどが揃っていない場合のみスキーマを作成する（起動時に毎回DDLを発行しないため）。
+    複数のワーカーが同時に起動して作成が衝突した場合は（"already exists" など）、揃うまで確認し直す
+    """
+    if DIALECT not in _EXISTING_NAMES_SQL:
+        raise RuntimeError(f"Unsupported database: {DIALECT} (use SQLite or PostgreSQL)")
+    for attempt in range(SCHEMA_INIT_ATTEMPTS):
+        try:
+            await _create_missing_schema()
+            return
+        except DBAPIError as e:
+            if attempt == SCHEMA_INIT_ATTEMPTS - 1:
+                raise
+            print(f"Schema creation conflicted with another worker, retrying: {e.orig}")
+            await asyncio.sleep(0.2 * (attempt + 1))
+
+async def _create_missing_schema() -> None:
+    async with engine.begin() as conn:
+        result = await conn.execute(text(_EXISTING_NAMES_SQL[DIALECT]))
+        existing_names = set(result.scalars().all())
+        missing_extra = [
+            (name, ddl) for dialect, name, ddl in extra_schema_objects
+            if dialect == DIALECT and name not in existing_names
+        ]
+        # 既存のテーブルに後から追加したインデックス（create_all は既存テーブルのインデックスを作成しない）
+        missing_indexes = [
+            index for table in Base.metadata.tables.values() if table.name in existing_names
+            for index in table.indexes if index.name not in existing_names
+        ]
+        missing_columns = await conn.run_sync(_missing_columns, existing_names)
+        if (
+            set(Base.metadata.tables) <= existing_names
+            and not missing_extra and not missing_indexes and not missing_columns
+        ):
+            return
+        # await conn.run_sync(Base.metadata.drop_all) # 開発中にテーブルをリセットしたい場合
+        await conn.run_sync(Base.metadata.create_all)
+        # 追加する列は NULL を許すものに限る（既存の行の値はアプリケーション側で埋める）
+        for column in missing_columns:
+            column_type = column.type.compile(dialect=conn.dialect)
+            await conn.execute(text(f'ALTER TABLE {column.table.name} ADD COLUMN {column.name} {column_type}'))
+        for index in missing_indexes:
+            await conn.run_sync(index.create, checkfirst=True)
+        for _, statements in missing_extra:
+            for statement in statements:
+                await conn.execute(text(statement))
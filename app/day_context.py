@@ -0,0 +1,137 @@
+# app/day_context.py
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Optional, Sequence
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud
+from .timezones import local_date, local_day_bounds, timezone_settings, to_local
+
+# プロンプトに載せる予定の件数の上限（空き時間より前は直近のものだけ）
+MAX_EARLIER_EVENTS = 3
+MAX_LATER_EVENTS = 8
+# キャッシュしておく日数
+MAX_CACHED_DAYS = 64
+NO_DAY_CONTEXT = "（当日のその他の予定は不明です）"
+
+
+@dataclass(frozen=True)
+class DayEvent:
+    """プロンプトの組み立てに使う予定の項目（セッションの外でも使えるよう値として保持する）"""
+    id: int
+    title: Optional[str]
+    start_time: datetime
+    end_time: datetime
+    location: Optional[str]
+
+    @classmethod
+    def of(cls, event) -> "DayEvent":
+        return cls(event.id, event.title, event.start_time, event.end_time, event.location)
+
+
+def _clock(value: datetime, day: date) -> str:
+    local = to_local(value)
+    # 日をまたぐ予定は日付も付ける
+    return local.strftime("%H:%M") if local.date() == day else local.strftime("%m/%d %H:%M")
+
+
+@dataclass
+class DayContext:
+    """ユーザーのタイムゾーンでの1日の予定（開始時刻順）と、そこから求める前後の予定・移動の流れ"""
+    day: date
+    events: list[DayEvent]
+
+    @classmethod
+    def from_events(cls, day: date, events: Sequence) -> "DayContext":
+        return cls(day, sorted((DayEvent.of(event) for event in events), key=lambda e: (e.start_time, e.end_time)))
+
+    def previous_event(self, target_time: datetime) -> Optional[DayEvent]:
+        """同じ日付で target_time より前に終了する最も直近の予定（crud.get_previous_event と同じ条件）"""
+        candidates = [e for e in self.events if e.end_time <= target_time and local_date(e.end_time) == self.day]
+        return max(candidates, key=lambda e: e.end_time, default=None)
+
+    def next_event(self, target_time: datetime) -> Optional[DayEvent]:
+        """同じ日付で target_time より後に開始する最も直近の予定（crud.get_next_event と同じ条件）"""
+        candidates = [e for e in self.events if e.start_time >= target_time and local_date(e.start_time) == self.day]
+        return min(candidates, key=lambda e: e.start_time, default=None)
+
+    def summary(self, window_start: datetime, window_end: datetime) -> str:
+        """
+        空き時間 [window_start, window_end) の前後の予定と、1日の移動の流れを短くまとめた文。
+        後に控えている予定と重なる・間に合わないプランを避けるため、プロンプトに含める
+        """
+        if not self.events:
+            return "この日は他に予定がありません。"
+        earlier = [e for e in self.events if e.end_time <= window_start]
+        later = [e for e in self.events if e.start_time >= window_end]
+        overlapping = [e for e in self.events if e.start_time < window_end and e.end_time > window_start]
+
+        def line(event: DayEvent) -> str:
+            location = f" @{event.location}" if event.location else ""
+            return f"  - {_clock(event.start_time, self.day)}〜{_clock(event.end_time, self.day)} {event.title or '（無題）'}{location}"
+
+        # 場所が変わるところだけを、空き時間の位置に印を付けてつなぐ
+        trajectory: list[str] = []
+        for event in earlier:
+            if event.location and (not trajectory or trajectory[-1] != event.location):
+                trajectory.append(event.location)
+        trajectory.append("［この空き時間］")
+        for event in later:
+            if event.location and trajectory[-1] != event.location:
+                trajectory.append(event.location)
+
+        lines = [f"- この日の予定: {len(self.events)}件", f"- 移動の流れ: {' → '.join(trajectory)}"]
+        if earlier:
+            lines.append("- この空き時間より前の予定（直近のもの）:")
+            lines.extend(line(event) for event in earlier[-MAX_EARLIER_EVENTS:])
+        if overlapping:
+            lines.append("- この空き時間と重なっている予定（プランと重ならないようにすること）:")
+            lines.extend(line(event) for event in overlapping)
+        if later:
+            lines.append("- この空き時間の後に控えている予定:")
+            lines.extend(line(event) for event in later[:MAX_LATER_EVENTS])
+            if len(later) > MAX_LATER_EVENTS:
+                lines.append(f"  - ほか{len(later) - MAX_LATER_EVENTS}件")
+        return "\n".join(lines)
+
+
+class DayContextBuilder:
+    """
+    1日の予定を1回のクエリ（期間の重なりのインデックスを使う）で取得し、日ごとにキャッシュする。
+    キャッシュは日ごとの集計(DailySummary)の version で検証するため、他のワーカーでの変更も反映される
+    """
+
+    def __init__(self):
+        self._cache: OrderedDict[tuple[str, date], tuple[int, DayContext]] = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0}
+
+    async def get(self, db: AsyncSession, day: date) -> DayContext:
+        key = (timezone_settings.name, day)
+        # 予定より先に version を読む（間に変更があっても、古い version で新しい予定をキャッシュするだけで済む）
+        version = await crud.get_daily_summary_version(db, day)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == version:
+            self._stats["hits"] += 1
+            self._cache.move_to_end(key)
+            return cached[1]
+        self._stats["misses"] += 1
+        start, end = local_day_bounds(day)
+        context = DayContext.from_events(day, await crud.get_events_by_period(db, start=start, end=end))
+        self._cache[key] = (version, context)
+        self._cache.move_to_end(key)
+        while len(self._cache) > MAX_CACHED_DAYS:
+            self._cache.popitem(last=False)
+        return context
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def snapshot(self) -> dict:
+        return {"cached_days": len(self._cache), **self._stats}
+
+
+# アプリケーション全体で共有するビルダー
+day_context_builder = DayContextBuilder()
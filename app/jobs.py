@@ -0,0 +1,242 @@
+# app/jobs.py
+
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, models, schemas, service
+from .database import AsyncSessionLocal
+from .personas import persona_registry
+from .plan_store import plan_store
+from .rate_limit import RateLimitError, upstream_limiter, current_client_id
+from .latency import DeadlineExceeded
+from .timezones import utc_now
+
+# 同時に実行するジョブ数。OpenAIのレート制限に合わせて調整する
+DEFAULT_JOB_CONCURRENCY = 2
+# これより長く running のままのジョブは、停止したワーカーのものとみなして再実行する
+STALE_JOB_MINUTES = 10
+# 完了したジョブを保持する期間（分）。PLAN_JOB_TTL_MINUTES で変更できる
+DEFAULT_JOB_TTL_MINUTES = 24 * 60
+# 保持期間を過ぎたジョブを削除する間隔（秒）
+DEFAULT_JOB_SWEEP_INTERVAL_SECONDS = 600
+
+
+async def run_persona(db: AsyncSession, kind: str, request: schemas.ConveniencePlannerRequest) -> schemas.PlannerResponse:
+    """ジョブの種類（人格の名前または別名）に対応する人格でプランを生成する"""
+    persona = persona_registry.get(kind)
+    if persona is None:
+        raise ValueError(f"Unknown job kind: {kind}")
+    agent_request, day_context = await service.build_planning_request(
+        db, request, default_next_location=persona.default_next_location
+    )
+    return await service.planner_pipeline.run(persona, agent_request, day_context=day_context)
+
+
+def compute_request_hash(kind: str, request: schemas.ConveniencePlannerRequest) -> str:
+    """重複投入を検出するためのリクエストのハッシュ値"""
+    canonical = json.dumps(
+        {"kind": kind, "request": request.model_dump(mode="json")}, sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def public_error_message(error: Exception) -> str:
+    """
+    ジョブの取得者に返すエラーメッセージ。例外の内容（上流APIの応答や内部の情報）はログにだけ出力する
+    """
+    if isinstance(error, RateLimitError):
+        return "Failed to generate plans: the upstream service is busy. Please retry later."
+    if isinstance(error, DeadlineExceeded):
+        return "Failed to generate plans: timed out."
+    if isinstance(error, ValueError):
+        return "Failed to generate plans: invalid request."
+    return "Failed to generate plans."
+
+
+def to_job_schema(job: models.PlanJob) -> schemas.PlanJob:
+    """DBのジョブをAPIレスポンス用に変換する"""
+    result = None
+    if job.result_payload:
+        result = schemas.PlannerResponse.model_validate_json(job.result_payload)
+    return schemas.PlanJob(
+        id=job.id,
+        kind=job.kind,
+        status=job.status,
+        priority=job.priority,
+        result=result,
+        error=job.error,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        finished_at=job.finished_at,
+    )
+
+
+class PlanJobQueue:
+    """
+    優先度付きのプラン生成ジョブキュー。
+    ジョブの状態はSQLiteに永続化し、固定数のワーカータスクで順に処理する。
+    """
+
+    def __init__(self, concurrency: Optional[int] = None):
+        self.concurrency = concurrency
+        self._queue: asyncio.PriorityQueue[tuple[int, int, str]] = asyncio.PriorityQueue()
+        self._sequence = 0
+        self._workers: list[asyncio.Task] = []
+        self._sweeper: Optional[asyncio.Task] = None
+        # ジョブ完了を待っているロングポーリングへの通知と、ジョブごとの待っている数
+        self._finished: Dict[str, asyncio.Event] = {}
+        self._waiting: Counter[str] = Counter()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        if self.concurrency is None:
+            self.concurrency = max(1, int(os.getenv("PLAN_JOB_CONCURRENCY", DEFAULT_JOB_CONCURRENCY)))
+
+        # 前回の停止時に未完了だったジョブを再投入する
+        # 複数ワーカーで同じジョブを読み込んでも、claim_plan_job で実行は1回に限られる
+        async with AsyncSessionLocal() as db:
+            await crud.requeue_plan_jobs(db, stale_before=utc_now() - timedelta(minutes=STALE_JOB_MINUTES))
+            for job in await crud.get_unfinished_plan_jobs(db):
+                self._enqueue(job.id, job.priority)
+
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        tasks = [*self._workers, *([self._sweeper] if self._sweeper is not None else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._sweeper = None
+
+    @staticmethod
+    def ttl() -> timedelta:
+        return timedelta(minutes=float(os.getenv("PLAN_JOB_TTL_MINUTES", DEFAULT_JOB_TTL_MINUTES)))
+
+    async def sweep(self) -> int:
+        """保持期間を過ぎた完了済みのジョブを削除する"""
+        async with AsyncSessionLocal() as db:
+            return await crud.delete_finished_plan_jobs(db, finished_before=utc_now() - self.ttl())
+
+    async def _sweep_forever(self) -> None:
+        interval = float(os.getenv("PLAN_JOB_SWEEP_INTERVAL_SECONDS", DEFAULT_JOB_SWEEP_INTERVAL_SECONDS))
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Failed to delete finished plan jobs: {e}")
+            await asyncio.sleep(interval)
+
+    def _enqueue(self, job_id: str, priority: int) -> None:
+        # 優先度の高い順、同じ優先度なら投入順に処理する
+        self._sequence += 1
+        self._queue.put_nowait((-priority, self._sequence, job_id))
+
+    async def submit(
+        self, db: AsyncSession, kind: str, request: schemas.ConveniencePlannerRequest, priority: int = 0
+    ) -> models.PlanJob:
+        """ジョブを登録してすぐに返す。同じ内容のジョブが実行待ち・実行中であればそれを返す"""
+        if persona_registry.get(kind) is None:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        # 料金上限に達している場合は、ジョブを登録せずに即座に断る
+        await upstream_limiter.check_budget()
+
+        request_hash = compute_request_hash(kind, request)
+        # 同時に投入された場合は、実行待ち・実行中のジョブの一意制約で片方の登録が失敗する
+        for _ in range(2):
+            existing_job = await crud.get_active_plan_job_by_hash(db, request_hash)
+            if existing_job is not None:
+                return existing_job
+            job = models.PlanJob(
+                id=uuid.uuid4().hex,
+                kind=kind,
+                status="queued",
+                priority=priority,
+                request_hash=request_hash,
+                request_payload=request.model_dump_json(),
+                client_id=current_client_id.get(),
+            )
+            try:
+                job = await crud.create_plan_job(db, job)
+            except IntegrityError:
+                # 先に登録されたジョブを返す（読み直す前に完了していれば、もう一度登録する）
+                await db.rollback()
+                continue
+            self._enqueue(job.id, priority)
+            return job
+        raise RuntimeError("Failed to register the plan job.")
+
+    async def wait(self, db: AsyncSession, job_id: str, timeout: float) -> models.PlanJob | None:
+        """ジョブが完了するか、タイムアウトするまで待ってから最新の状態を返す（ロングポーリング用）"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        self._waiting[job_id] += 1
+        try:
+            while True:
+                db.expire_all()
+                job = await crud.get_plan_job(db, job_id)
+                remaining = deadline - loop.time()
+                if job is None or job.status in ("succeeded", "failed") or remaining <= 0:
+                    return job
+                # 他プロセスで処理されたジョブにも追従できるよう、定期的にDBを読み直す
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # 最後に待っていたリクエストが、通知用のイベントを片付ける（他のワーカーで完了したジョブの分も残さない）
+            self._waiting[job_id] -= 1
+            if self._waiting[job_id] <= 0:
+                del self._waiting[job_id]
+                self._finished.pop(job_id, None)
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"Unexpected error in plan job worker: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        async with AsyncSessionLocal() as db:
+            if not await crud.claim_plan_job(db, job_id):
+                return
+            job = await crud.get_plan_job(db, job_id)
+            if job is None:
+                return
+
+            # 投入したクライアントの枠で上流APIを呼び出す
+            current_client_id.set(job.client_id or "anonymous")
+            try:
+                request = schemas.ConveniencePlannerRequest.model_validate_json(job.request_payload)
+                result = await run_persona(db, job.kind, request)
+                result = await plan_store.save_one(db, result, source=job.kind)
+                await crud.finish_plan_job(db, job_id, result_payload=result.model_dump_json())
+            except Exception as e:
+                print(f"Error in plan job {job_id}: {e!r}")
+                await crud.finish_plan_job(db, job_id, error=public_error_message(e))
+
+        # イベントの片付けは、待っている側が行う
+        event = self._finished.get(job_id)
+        if event is not None:
+            event.set()
+
+
+# アプリケーション全体で共有するジョブキュー
+plan_job_queue = PlanJobQueue()
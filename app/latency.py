@@ -0,0 +1,164 @@
+# app/latency.py
+
+import os
+import time
+import asyncio
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# リクエスト全体の期限の既定値（秒）。X-Request-Timeout ヘッダーで短くできる
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 60.0
+MAX_REQUEST_TIMEOUT_SECONDS = 300.0
+
+# ヘッジ（遅い呼び出しの複製）を判断するための設定
+LATENCY_WINDOW = 200            # 直近何回分の所要時間から p95 を求めるか
+HEDGE_MIN_SAMPLES = 20          # これより少ない間は p95 が不安定なのでヘッジしない
+DEFAULT_HEDGE_MAX_RATIO = 0.1   # ヘッジする呼び出しの割合の上限（追加の利用料金を抑える）
+
+# 期限（time.monotonic() の時刻）。None の場合は期限なし（バックグラウンドのジョブなど）
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """リクエストの期限（またはその段階に割り当てた時間）を過ぎた"""
+
+
+def default_request_timeout() -> float:
+    return float(os.getenv("REQUEST_TIMEOUT_SECONDS", DEFAULT_REQUEST_TIMEOUT_SECONDS))
+
+
+def parse_request_timeout(value: Optional[str]) -> float:
+    """X-Request-Timeout ヘッダー（秒）を解釈する。不正な値や未指定の場合は既定値"""
+    timeout = default_request_timeout()
+    if value:
+        try:
+            timeout = min(float(value), timeout)
+        except ValueError:
+            pass
+    return max(0.0, min(timeout, MAX_REQUEST_TIMEOUT_SECONDS))
+
+
+def remaining() -> Optional[float]:
+    """期限までの残り秒数。期限が無ければ None"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@contextmanager
+def deadline_scope(timeout: Optional[float]) -> Iterator[None]:
+    """このブロックの中の期限を設定する。None を渡すと期限なしにする（レスポンス後のバックグラウンド処理用）"""
+    token = request_deadline.set(time.monotonic() + timeout if timeout is not None else None)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+async def within_budget(awaitable: Awaitable[T], share: float = 1.0) -> T:
+    """
+    残り時間のうち share の割合を上限として待つ。超えた場合は DeadlineExceeded。
+    期限が無い場合はそのまま待つ。
+    """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    budget = left * share
+    if budget <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded("Request deadline exceeded")
+    try:
+        return await asyncio.wait_for(awaitable, timeout=budget)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"Stage budget of {budget:.1f}s exceeded") from None
+
+
+class LatencyTracker:
+    """上流APIの呼び出しごとの所要時間を記録し、遅い呼び出しを複製（ヘッジ）する"""
+
+    def __init__(self):
+        self._samples: dict[str, deque] = {}
+        self._calls: dict[str, int] = {}
+        self._hedges: dict[str, int] = {}
+        self._hedge_wins: dict[str, int] = {}
+
+    @staticmethod
+    def max_hedge_ratio() -> float:
+        return float(os.getenv("HEDGE_MAX_RATIO", DEFAULT_HEDGE_MAX_RATIO))
+
+    def record(self, key: str, seconds: float) -> None:
+        self._samples.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def percentile(self, key: str, ratio: float) -> Optional[float]:
+        samples = self._samples.get(key)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+    def _hedge_delay(self, key: str) -> Optional[float]:
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        if self._hedges.get(key, 0) >= self._calls.get(key, 0) * self.max_hedge_ratio():
+            return None
+        return self.percentile(key, 0.95)
+
+    async def hedged(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        call() を実行し、p95 を過ぎても終わらなければ同じ呼び出しをもう1つ送り、先に終わった方の結果を返す。
+        ヘッジは呼び出し全体の HEDGE_MAX_RATIO の割合までに制限する。
+        """
+        self._calls[key] = self._calls.get(key, 0) + 1
+        started = time.monotonic()
+        primary = asyncio.ensure_future(call())
+        delay = self._hedge_delay(key)
+        tasks = [primary]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self._hedges[key] = self._hedges.get(key, 0) + 1
+                    hedge_started = time.monotonic()
+                    tasks.append(asyncio.ensure_future(call()))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next(iter(done))
+                # 失敗した方が先に終わった場合は、もう一方の結果を待つ
+                if winner.exception() is not None and len(tasks) > 1:
+                    tasks.remove(winner)
+                    continue
+                break
+            if winner.exception() is None:
+                if winner is not primary:
+                    self._hedge_wins[key] = self._hedge_wins.get(key, 0) + 1
+                    self.record(key, time.monotonic() - hedge_started)
+                else:
+                    self.record(key, time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def snapshot(self) -> dict:
+        return {
+            key: {
+                "calls": self._calls.get(key, 0),
+                "p50_seconds": round(self.percentile(key, 0.5) or 0, 3),
+                "p95_seconds": round(self.percentile(key, 0.95) or 0, 3),
+                "hedges": self._hedges.get(key, 0),
+                "hedge_wins": self._hedge_wins.get(key, 0),
+            }
+            for key in self._samples
+        }
+
+
+# アプリケーション全体で共有するトラッカー
+latency_tracker = LatencyTracker()
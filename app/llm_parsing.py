@@ -0,0 +1,320 @@
+# app/llm_parsing.py
+
+import re
+import json
+from typing import Any, Optional, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from . import schemas, upstream
+from .profiling import span
+from .rate_limit import RateLimitError
+
+# 追加の問い合わせに載せる、不正だった出力の最大文字数
+FOLLOW_UP_MAX_INVALID_CHARS = 2000
+# 末尾が途切れたJSONを閉じ直すときに試す切り詰め位置の数
+MAX_TRUNCATION_ATTEMPTS = 50
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+_CODE_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class ParseStats:
+    """LLMの出力のパース結果を、呼び出し元（ラベル）ごとに数える"""
+
+    COUNTERS = (
+        "responses", "repaired", "unparseable", "items_valid", "items_dropped",
+        "follow_ups", "follow_up_recovered", "follow_up_failed",
+    )
+
+    def __init__(self):
+        self._stats: dict[str, dict[str, int]] = {}
+
+    def record(self, label: str, counter: str, amount: int = 1) -> None:
+        stats = self._stats.setdefault(label, dict.fromkeys(self.COUNTERS, 0))
+        stats[counter] += amount
+
+    def snapshot(self) -> dict:
+        return {label: dict(stats) for label, stats in self._stats.items()}
+
+
+parse_stats = ParseStats()
+
+
+def _clean(text: str) -> tuple[str, list[int], list[list[str]]]:
+    """
+    文字列の外側にある末尾カンマとPythonのリテラル(True/False/None)を直す。
+    あわせて、値が閉じた直後の位置と、その時点で開いている括弧のスタックを返す（途切れたJSONの修復用）。
+    """
+    out: list[str] = []
+    cut_points: list[int] = []
+    stacks: list[list[str]] = []
+    stack: list[str] = []
+    in_string = False
+    escaped = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            i += 1
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append(char)
+        elif char in "}]":
+            # 閉じ括弧の直前のカンマを取り除く
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(char)
+            cut_points.append(len(out))
+            stacks.append(list(stack))
+            i += 1
+            continue
+        elif char.isascii() and char.isalpha():
+            match = re.match(r"[A-Za-z]+", text[i:])
+            word = match.group(0)
+            out.append(_PYTHON_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        out.append(char)
+        i += 1
+
+    if in_string:
+        # 文字列の途中で途切れている
+        cut_points.append(-1)
+        stacks.append(list(stack))
+    return "".join(out), cut_points, stacks
+
+
+def repair_json(content: Optional[str]) -> Any:
+    """
+    LLMの出力からJSONを取り出す。コードブロック・前後の文章・末尾カンマ・
+    Pythonのリテラル・文字列中の改行・途中で途切れた出力を修復する。修復できなければ ValueError。
+    """
+    if not content or not content.strip():
+        raise ValueError("Empty response")
+    text = _CODE_FENCE.sub("", content.strip())
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise ValueError("No JSON object found")
+    text = text[start:]
+    end = max(text.rfind("}"), text.rfind("]"))
+
+    cleaned, cut_points, stacks = _clean(text)
+    try:
+        return json.loads(cleaned, strict=False)
+    except ValueError:
+        pass
+    if end >= 0:
+        cleaned_tail, _, _ = _clean(text[:end + 1])
+        try:
+            return json.loads(cleaned_tail, strict=False)
+        except ValueError:
+            pass
+
+    # 出力が途中で途切れている場合は、値が閉じた位置で切り詰めて括弧を閉じ直す
+    for cut, stack in list(zip(cut_points, stacks))[::-1][:MAX_TRUNCATION_ATTEMPTS]:
+        prefix = cleaned if cut < 0 else cleaned[:cut]
+        if cut < 0:
+            prefix += '"'
+        candidate = prefix.rstrip().rstrip(",") + "".join(_CLOSERS[opener] for opener in reversed(stack))
+        try:
+            return json.loads(candidate, strict=False)
+        except ValueError:
+            continue
+    raise ValueError("Could not repair JSON response")
+
+
+def _error_summary(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in e['loc'])}: {e['msg']}" for e in error.errors()[:5]
+    )
+
+
+def validate_items(items: Any, model_cls: Type[ModelT]) -> tuple[list[ModelT], list[tuple[Any, str]]]:
+    """リストの要素を1つずつ検証し、(有効な要素, [(不正な要素, 理由)]) を返す"""
+    if not isinstance(items, list):
+        return [], [(items, "not a list")]
+    valid: list[ModelT] = []
+    invalid: list[tuple[Any, str]] = []
+    for item in items:
+        try:
+            valid.append(model_cls.model_validate(item))
+        except ValidationError as e:
+            invalid.append((item, _error_summary(e)))
+    return valid, invalid
+
+
+def _truncate(value: Any) -> str:
+    text = json.dumps(value, ensure_ascii=False) if not isinstance(value, str) else value
+    return text[:FOLLOW_UP_MAX_INVALID_CHARS]
+
+
+async def _follow_up(prompt: str, label: str, cassette_context: Any) -> Optional[str]:
+    parse_stats.record(label, "follow_ups")
+    try:
+        response = await upstream.chat_completion(
+            model="gpt-4o",
+            messages=[{"role": "system", "content": prompt}],
+            response_format={"type": "json_object"},
+            cassette_label=f"{label}.follow_up",
+            cassette_context=cassette_context,
+        )
+    except RateLimitError:
+        raise
+    except Exception as e:
+        print(f"Follow-up request for {label} failed: {e}")
+        return None
+    return response.choices[0].message.content
+
+
+def _plans_follow_up_prompt(
+    missing: int, situation: str, valid: list[schemas.PlanPattern], invalid: list[tuple[Any, str]], parse_error: Optional[str]
+) -> str:
+    existing = "\n".join(f"- {plan.pattern_description}" for plan in valid) or "なし"
+    problems = [f"- 出力をJSONとして読み取れませんでした（{parse_error}）"] if parse_error else []
+    problems += [f"- {reason}\n  出力: {_truncate(item)}" for item, reason in invalid]
+    return f"""
+あなたが先ほど出力した行動プランの一部に不備がありました。不足している {missing} 個のプランだけを出力してください。
+
+# 条件
+{situation}
+
+# 作成済みのプラン（内容を重複させないこと）
+{existing}
+
+# 不備の内容
+{chr(10).join(problems) or "- プランの数が不足しています"}
+
+# 出力形式（JSON）
+start_time / end_time はタイムゾーンのオフセット付きの具体的な日時（例: "2025-01-01T10:00:00+09:00"）にしてください。
+{{"plans": [{{"pattern_description": "プランのテーマ", "events": [{{"title": "...", "start_time": "...", "end_time": "...", "location": "...", "description": "..."}}]}}]}}
+"""
+
+
+async def parse_plans(
+    content: Optional[str],
+    *,
+    label: str,
+    expected: int,
+    situation: str,
+    cassette_context: Any = None,
+) -> list[schemas.PlanPattern]:
+    """
+    {"plans": [...]} 形式の出力を寛容にパースし、有効なプランだけを返す。
+    有効なプランが expected 個に満たない場合は、不足分だけを小さなプロンプトで問い合わせ直す。
+    """
+    parse_stats.record(label, "responses")
+    parse_error = None
+    valid: list[schemas.PlanPattern] = []
+    invalid: list[tuple[Any, str]] = []
+    # JSONの修復とPydanticの検証にかかった時間は、時間のかかったリクエストの内訳に含める
+    with span("llm_parsing"):
+        try:
+            data = repair_json(content)
+            if content is not None and _is_repaired(content):
+                parse_stats.record(label, "repaired")
+            valid, invalid = validate_items(data.get("plans", []) if isinstance(data, dict) else data, schemas.PlanPattern)
+        except ValueError as e:
+            parse_stats.record(label, "unparseable")
+            parse_error = str(e)
+    parse_stats.record(label, "items_valid", len(valid))
+    parse_stats.record(label, "items_dropped", len(invalid))
+
+    missing = expected - len(valid)
+    if missing <= 0:
+        return valid
+
+    prompt = _plans_follow_up_prompt(missing, situation, valid, invalid, parse_error)
+    follow_up_content = await _follow_up(prompt, label, cassette_context)
+    recovered: list[schemas.PlanPattern] = []
+    if follow_up_content is not None:
+        try:
+            data = repair_json(follow_up_content)
+            recovered, _ = validate_items(data.get("plans", []) if isinstance(data, dict) else data, schemas.PlanPattern)
+        except ValueError:
+            pass
+    parse_stats.record(label, "follow_up_recovered" if recovered else "follow_up_failed")
+
+    plans = valid + recovered[:missing]
+    if not plans:
+        raise ValueError("AI Planner returned no valid plans.")
+    return plans
+
+
+async def parse_model(
+    content: Optional[str],
+    model_cls: Type[ModelT],
+    *,
+    label: str,
+    situation: str,
+    cassette_context: Any = None,
+) -> ModelT:
+    """単一のJSONオブジェクトを寛容にパースする。不正な場合は、誤りを伝えて1回だけ問い合わせ直す"""
+    parse_stats.record(label, "responses")
+    with span("llm_parsing"):
+        try:
+            data = repair_json(content)
+            if content is not None and _is_repaired(content):
+                parse_stats.record(label, "repaired")
+            result = model_cls.model_validate(data)
+            parse_stats.record(label, "items_valid")
+            return result
+        except ValueError as e:
+            # ValidationError も ValueError のサブクラス
+            reason = _error_summary(e) if isinstance(e, ValidationError) else f"JSONとして読み取れませんでした（{e}）"
+            parse_stats.record(label, "items_dropped" if isinstance(e, ValidationError) else "unparseable")
+
+    fields = ", ".join(f'"{name}"' for name in model_cls.model_fields)
+    prompt = f"""
+あなたが先ほど出力したJSONに不備がありました。修正したJSONだけを出力してください。
+
+# 条件
+{situation}
+
+# 不備の内容
+{reason}
+
+# 先ほどの出力
+{_truncate(content or "")}
+
+# 出力形式
+{fields} を持つJSONオブジェクト
+"""
+    follow_up_content = await _follow_up(prompt, label, cassette_context)
+    try:
+        result = model_cls.model_validate(repair_json(follow_up_content))
+    except ValueError as e:
+        parse_stats.record(label, "follow_up_failed")
+        raise ValueError(f"Invalid response from AI: {reason}") from e
+    parse_stats.record(label, "follow_up_recovered")
+    return result
+
+
+def _is_repaired(content: str) -> bool:
+    try:
+        json.loads(content)
+        return False
+    except ValueError:
+        return True
@@ -1,19 +1,129 @@
 # app/main.py
 
-from fastapi import FastAPI
+import math
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from .database import engine, Base
-from .routers import events, suggestion, agent, planner, user_profile, masculine_planner
+from fastapi.responses import JSONResponse
+from . import crud
+from .database import init_db, AsyncSessionLocal, engine
+from .clients import load_environment, close_clients
+from .routers import events, suggestion, agent, planner, user_profile, masculine_planner, jobs, admin, settings
+from .jobs import plan_job_queue
+from .plan_store import plan_store
+from .personas import persona_registry
+from .rate_limit import RateLimitError, current_client_id
+from .compression import CompressionMiddleware
+from .profiling import RequestTrace, current_trace, instrument_engine, loop_lag_monitor, slow_request_log
+from .admission import AdmissionRejected, admission_controller
+from .latency import DeadlineExceeded, deadline_scope, parse_request_timeout
+from .timezones import timezone_settings
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # .envの読み込みと、スキーマが無い場合のみテーブル作成
+    load_environment()
+    await init_db()
+    # ユーザーのタイムゾーンを読み込み、UTCで保存する前の予定を変換する（初回のみ）
+    await timezone_settings.refresh(force=True)
+    async with AsyncSessionLocal() as db:
+        migrated = await crud.migrate_legacy_event_times(db)
+        if migrated:
+            print(f"Converted {migrated} events to UTC ({timezone_settings.name}).")
+        # 集計表を追加する前からある予定を集計する（初回のみ）
+        await crud.ensure_daily_summaries(db)
+    # 人格のテンプレートを検証・前処理する（定義の誤りがあれば起動時に失敗させる）
+    persona_registry.compile()
+    # イベントループの遅延の計測を始める
+    await loop_lag_monitor.start()
+    # プラン生成ジョブのワーカーを起動する
+    await plan_job_queue.start()
+    # 期限切れの生成済みプランを定期的に削除する
+    await plan_store.start()
+    yield
+    await plan_store.stop()
+    await plan_job_queue.stop()
+    await loop_lag_monitor.stop()
+    await close_clients()
+
+# 時間のかかったリクエストの内訳に含めるため、SQLの実行時間を記録する
+instrument_engine(engine)
 
 # FastAPIアプリケーションインスタンスを作成
 app = FastAPI(
     title="Calendar API",
     description="A calendar application backend with smart suggestions.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Accept-Encoding に応じてレスポンスを圧縮する（COMPRESSION=0 で無効）
+app.add_middleware(CompressionMiddleware)
+
+# 上流APIのリミッターで公平性を保つため、リクエスト元のクライアントを識別する
+@app.middleware("http")
+async def identify_client(request: Request, call_next):
+    client_id = request.headers.get("X-Client-Id") or (request.client.host if request.client else "anonymous")
+    token = current_client_id.set(client_id)
+    try:
+        return await call_next(request)
+    finally:
+        current_client_id.reset(token)
+
+# 他のワーカーで変更されたユーザーのタイムゾーンを一定間隔で読み直す
+@app.middleware("http")
+async def refresh_timezone_settings(request: Request, call_next):
+    await timezone_settings.refresh()
+    return await call_next(request)
+
+# リクエストの種類ごとに同時実行数を制限し、混雑時はプラン生成などの重いリクエストから503で断る
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    route_class = admission_controller.classify(request.method, request.url.path)
+    if route_class is None or not admission_controller.enabled():
+        return await call_next(request)
+    try:
+        await admission_controller.acquire(route_class)
+    except AdmissionRejected as exc:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": str(exc)},
+            headers={"Retry-After": str(math.ceil(exc.retry_after))},
+        )
+    started = time.monotonic()
+    try:
+        return await call_next(request)
+    finally:
+        admission_controller.release(route_class, time.monotonic() - started)
+
+# リクエスト全体の期限を設定する。上流APIの呼び出しは残り時間に合わせて打ち切られる
+@app.middleware("http")
+async def propagate_deadline(request: Request, call_next):
+    with deadline_scope(parse_request_timeout(request.headers.get("X-Request-Timeout"))):
+        return await call_next(request)
+
+# 時間のかかったリクエストを、DB・上流API・プラン生成の段階ごとの内訳とともに記録する（GET /admin/profiling/slow-requests）
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    trace = RequestTrace()
+    token = current_trace.set(trace)
+    started = time.monotonic()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        current_trace.reset(token)
+        route = request.scope.get("route")
+        slow_request_log.record(
+            request.method, getattr(route, "path", request.url.path), status_code, started, time.monotonic(), trace
+        )
+
 # CORS (Cross-Origin Resource Sharing) の設定
 # フロントエンド (React) からのアクセスを許可するために必要
+# 最後に追加して一番外側に置き、受付制御の503などミドルウェアが返すレスポンスにもヘッダーを付ける
 origins = [
     "http://localhost:3000",  # React開発サーバーのデフォルトポート
     "http://localhost:5173",
@@ -26,8 +136,24 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"], # すべてのHTTPメソッドを許可
     allow_headers=["*"], # すべてのヘッダーを許可
+    # 時間が重なっている予定（routers/events.py）と、混雑・上流の制限で断った場合の再試行までの秒数
+    expose_headers=["X-Event-Conflicts", "Retry-After"],
 )
 
+# 期限内に応答を作れなかった場合は504を返す
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exception_handler(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+# 上流APIの制限・料金上限に達した場合は、待たせずに429を返す
+@app.exception_handler(RateLimitError)
+async def rate_limit_exception_handler(request: Request, exc: RateLimitError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
 # ルーターをアプリケーションに登録
 app.include_router(events.router)
 # app.include_router(suggestion.router)
@@ -36,13 +162,9 @@ app.include_router(agent.router)
 app.include_router(planner.router)
 # app.include_router(user_profile.router)
 app.include_router(masculine_planner.router) # この行を追加
-
-@app.on_event("startup")
-async def startup_event():
-    # アプリケーション起動時にデータベーステーブルを作成する
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all) # 開発中にテーブルをリセットしたい場合
-        await conn.run_sync(Base.metadata.create_all)
+app.include_router(jobs.router)
+app.include_router(admin.router)
+app.include_router(settings.router)
 
 @app.get("/", tags=["Root"])
 async def read_root():
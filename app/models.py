@@ -1,17 +1,136 @@
-from sqlalchemy import Column, Integer, String, DateTime
-from .database import Base
+from sqlalchemy import Column, Integer, String, Date, DateTime, Text, Index, text
+from sqlalchemy.types import TypeDecorator
+from .database import Base, extra_schema_objects
+from .timezones import to_utc, utc_now
 import datetime
 
+class UTCDateTime(TypeDecorator):
+    """
+    日時をUTCに揃えて（タイムゾーン無しの列に）保存し、読み出し時にUTCのタイムゾーンを付ける。
+    タイムゾーンの付いていない日時は、ユーザーのタイムゾーンの時刻とみなす。
+    """
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return to_utc(value).replace(tzinfo=None)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value.replace(tzinfo=datetime.timezone.utc)
+
 class Event(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        # 期間の重なりを調べる範囲検索用。索引で範囲を絞れるのは start_time < 終了 だけで、
+        # end_time > 開始 は絞り込んだ範囲の索引の項目ごとに判定する（表の行は読まない）
+        Index("ix_events_time_range", "start_time", "end_time"),
+        # 同じ日の直前・直後の予定の検索用（日付の一致と時刻の範囲をインデックスだけで判定する）
+        Index("ix_events_local_start", "local_start_date", "start_time"),
+        Index("ix_events_local_end", "local_end_date", "end_time"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, index=True)
-    start_time = Column(DateTime, nullable=False)
-    end_time = Column(DateTime, nullable=False)
-    location = Column(String, nullable=True)
+    start_time = Column(UTCDateTime, nullable=False)
+    end_time = Column(UTCDateTime, nullable=False)
+    # 前方一致の検索（「京都*」）で範囲検索に使う
+    location = Column(String, nullable=True, index=True)
     description = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.now)
+    # ユーザーのタイムゾーンでの開始・終了の日付。タイムゾーンの設定を変えた場合は計算し直す
+    # NULL の行は、UTCに移行する前の（サーバーのローカル時刻で保存された）予定
+    local_start_date = Column(Date, nullable=True)
+    local_end_date = Column(Date, nullable=True)
+    created_at = Column(UTCDateTime, default=utc_now)
+    updated_at = Column(UTCDateTime, default=utc_now, onupdate=utc_now, index=True)
+
+class EventChange(Base):
+    """予定の変更履歴（変更フィードの配信用）。seq は単調増加し、再利用されない"""
+    __tablename__ = "event_changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    event_id = Column(Integer, nullable=False, index=True)
+    operation = Column(String, nullable=False)   # created / updated / deleted
+    payload = Column(Text, nullable=False)       # created: 予定全体, updated: 変更された項目, deleted: なし
+    created_at = Column(UTCDateTime, default=utc_now)
+
+class DailySummary(Base):
+    """
+    ユーザーのタイムゾーンでの1日ごとの予定の集計（統計APIの期間集計用）。予定の書き込みと同じトランザクションで差分を反映する。
+    JSONの列は app/summaries.py の DayTotals の形式。
+    """
+    __tablename__ = "daily_summaries"
+
+    day = Column(Date, primary_key=True)
+    event_count = Column(Integer, nullable=False, default=0)
+    busy_seconds = Column(Integer, nullable=False, default=0)
+    hourly_seconds = Column(Text, nullable=False)   # 0〜23時の時間帯ごとの秒数のリスト
+    locations = Column(Text, nullable=False)        # {場所: [件数, 秒数]}
+    categories = Column(Text, nullable=False)       # {分類: [件数, 秒数]}
+    version = Column(Integer, nullable=False, default=0)  # 集計が変わるたびに増える（日ごとのキャッシュの検証用）
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+# 予定の全文検索用のFTS5仮想テーブル（title / location / description）
+# 日本語は単語区切りが無いため trigram トークナイザで部分一致（前方一致を含む）検索を行う
+# events テーブルをコンテンツとして参照し、トリガーで同期する
+extra_schema_objects.extend([
+    ("sqlite", "events_fts", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+            title, location, description,
+            content='events', content_rowid='id', tokenize='trigram'
+        )
+        """,
+        # 既存の予定を索引に取り込む
+        "INSERT INTO events_fts(events_fts) VALUES('rebuild')",
+    ]),
+    ("sqlite", "events_fts_ai", ["""
+        CREATE TRIGGER IF NOT EXISTS events_fts_ai AFTER INSERT ON events BEGIN
+            INSERT INTO events_fts(rowid, title, location, description)
+            VALUES (new.id, new.title, new.location, new.description);
+        END
+    """]),
+    ("sqlite", "events_fts_ad", ["""
+        CREATE TRIGGER IF NOT EXISTS events_fts_ad AFTER DELETE ON events BEGIN
+            INSERT INTO events_fts(events_fts, rowid, title, location, description)
+            VALUES ('delete', old.id, old.title, old.location, old.description);
+        END
+    """]),
+    ("sqlite", "events_fts_au", ["""
+        CREATE TRIGGER IF NOT EXISTS events_fts_au AFTER UPDATE OF title, location, description ON events BEGIN
+            INSERT INTO events_fts(events_fts, rowid, title, location, description)
+            VALUES ('delete', old.id, old.title, old.location, old.description);
+            INSERT INTO events_fts(rowid, title, location, description)
+            VALUES (new.id, new.title, new.location, new.description);
+        END
+    """]),
+])
+
+# PostgreSQL では、全文検索の代わりに pg_trgm のGINインデックスで部分一致（ILIKE）検索を行い、
+# 期間の重なりは tsrange の GiST インデックスで判定する（tsrange は [開始, 終了) なので、終了と開始が同時刻なら重ならない）
+extra_schema_objects.extend([
+    ("postgresql", "ix_events_search_trgm", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        """
+        CREATE INDEX IF NOT EXISTS ix_events_search_trgm ON events
+        USING gin (title gin_trgm_ops, location gin_trgm_ops, description gin_trgm_ops)
+        """,
+    ]),
+    ("postgresql", "ix_events_time_range_gist", ["""
+        CREATE INDEX IF NOT EXISTS ix_events_time_range_gist ON events USING gist (tsrange(start_time, end_time))
+    """]),
+])
+
+class UserSettings(Base):
+    """ユーザーの設定（1行だけ）"""
+    __tablename__ = "user_settings"
+
+    id = Column(Integer, primary_key=True)
+    timezone = Column(String, nullable=False)   # IANAのタイムゾーン名（例: "Asia/Tokyo"）
     updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
 
 class UserProfile(Base):
@@ -23,3 +142,45 @@ class UserProfile(Base):
     outing_tendency = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.now)
     updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
+    __table_args__ = (
+        # 最新のプロフィールを ORDER BY created_at DESC LIMIT 1 で読むため
+        Index("ix_user_profiles_created_at", "created_at"),
+    )
+
+class GeneratedPlan(Base):
+    """生成したプラン（PlannerResponse）。一定時間だけ保存し、採用されたパターンを予定として登録する"""
+    __tablename__ = "generated_plans"
+
+    id = Column(String, primary_key=True)
+    source = Column(String, nullable=False)                # 生成した人格の名前、または "day-planner"
+    payload = Column(Text, nullable=False)                 # PlannerResponse のJSON
+    accepted_pattern = Column(Integer, nullable=True)      # 採用したプランの番号（0始まり）
+    accepted_at = Column(UTCDateTime, nullable=True)
+    created_at = Column(UTCDateTime, default=utc_now)
+    expires_at = Column(UTCDateTime, nullable=False, index=True)
+
+class PlanJob(Base):
+    """非同期で実行するプラン生成ジョブ"""
+    __tablename__ = "plan_jobs"
+    __table_args__ = (
+        # 同じ内容のジョブを、実行待ち・実行中のものは1件に限る（同時に投入された場合の重複をDBで防ぐ）
+        Index(
+            "ux_plan_jobs_active_request_hash", "request_hash", unique=True,
+            sqlite_where=text("status IN ('queued', 'running')"),
+            postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)                  # 例: "planner", "masculine-planner"
+    status = Column(String, nullable=False, index=True)    # queued / running / succeeded / failed
+    priority = Column(Integer, nullable=False, default=0)
+    request_hash = Column(String, nullable=False, index=True) # 重複投入の検出用
+    request_payload = Column(Text, nullable=False)
+    client_id = Column(String, nullable=True)              # 投入したクライアント（レート制限の公平性に使う）
+    result_payload = Column(Text, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(UTCDateTime, default=utc_now)
+    updated_at = Column(UTCDateTime, default=utc_now, onupdate=utc_now)
+    finished_at = Column(UTCDateTime, nullable=True)
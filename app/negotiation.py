@@ -0,0 +1,84 @@
+# app/negotiation.py
+
+import json
+from typing import Callable, Optional
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+try:
+    import msgpack
+except ImportError:
+    # `uv sync --extra msgpack` でインストールしていない場合は、常にJSONで返す
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+def merge_vary(existing: Optional[str], value: str) -> str:
+    """既存の Vary（CORS の Origin など）を残したまま value を加えた、1つの Vary の値"""
+    values = [part.strip() for part in (existing or "").split(",") if part.strip()]
+    if "*" not in values and value.lower() not in (part.lower() for part in values):
+        values.append(value)
+    return ", ".join(values)
+
+
+def _accept_weights(accept: str) -> dict[str, float]:
+    weights: dict[str, float] = {}
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            weights[media_type.lower()] = q
+    return weights
+
+
+def wants_msgpack(accept: str) -> bool:
+    """Accept でMessagePackがJSON以上の優先度で指定されているか"""
+    if msgpack is None or not accept:
+        return False
+    weights = _accept_weights(accept)
+    msgpack_q = max((weights.get(media_type, 0.0) for media_type in MSGPACK_MEDIA_TYPES), default=0.0)
+    return msgpack_q > 0 and msgpack_q >= weights.get("application/json", 0.0)
+
+
+class MsgPackRoute(APIRoute):
+    """
+    Accept: application/msgpack のリクエストには、レスポンスモデルのJSONをMessagePackにして返すルート。
+    日時はJSONと同じくISO 8601の文字列になる。エラーのレスポンスは常にJSON。
+    キャッシュが別の形式のレスポンスを返さないよう、どちらの形式にも Vary: Accept を付ける
+    """
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request: Request) -> Response:
+            response = await handler(request)
+            if response.media_type != "application/json":
+                return response
+            vary = merge_vary(response.headers.get("vary"), "Accept")
+            body = getattr(response, "body", None)
+            if not wants_msgpack(request.headers.get("accept", "")) or not body:
+                response.headers["vary"] = vary
+                return response
+            headers = {
+                key: value for key, value in response.headers.items()
+                if key not in ("content-length", "content-type")
+            }
+            headers["vary"] = vary
+            return Response(
+                content=msgpack.packb(json.loads(body)),
+                status_code=response.status_code,
+                headers=headers,
+                media_type=MSGPACK_MEDIA_TYPE,
+                background=response.background,
+            )
+
+        return negotiated_handler
@@ -0,0 +1,292 @@
+# app/personas.py
+
+import string
+from dataclasses import dataclass, field
+from typing import Optional
+
+from . import schemas
+
+# テンプレートで使える値
+# 移動判断の前から分かる値
+BASE_FIELDS = frozenset({
+    "origin", "destination", "prev_end_time", "next_start_time", "preferences", "available_minutes",
+})
+# 移動判断の結果から決まる値
+MOBILITY_FIELDS = frozenset({
+    "mobility_reasoning", "mobility_mode", "mobility_minutes", "net_activity_minutes", "search_area",
+})
+# プロンプトでのみ使える値（Web検索の結果、空き時間の前後を含むその日の予定のまとめ）
+PROMPT_FIELDS = frozenset({"search_context", "day_context"})
+
+
+class PromptTemplate:
+    """
+    str.format 形式のテンプレート。
+    起動時に compile() で構文と使っている値を検証し、以降は分解済みの断片をつなぐだけで描画する。
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self._segments: Optional[list[tuple[str, Optional[str]]]] = None
+        self.fields: frozenset[str] = frozenset()
+
+    def compile(self, allowed_fields: frozenset[str]) -> "PromptTemplate":
+        segments = []
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(self.source):
+            if field_name is not None:
+                if format_spec or conversion or field_name not in allowed_fields:
+                    raise ValueError(f"Unsupported template field: {{{field_name}}}")
+            segments.append((literal, field_name))
+        self._segments = segments
+        self.fields = frozenset(name for _, name in segments if name)
+        return self
+
+    def render(self, values: dict[str, str]) -> str:
+        if self._segments is None:
+            raise RuntimeError("Template is not compiled.")
+        return "".join(literal + (values[name] if name else "") for literal, name in self._segments)
+
+
+@dataclass
+class Persona:
+    """プランナーの人格の定義。検索クエリとプロンプトのテンプレートで振る舞いを決める"""
+    name: str
+    description: str
+    query_template: PromptTemplate
+    prompt_template: PromptTemplate
+    needs_mobility: bool
+    # 移動判断の結果、活動時間がほとんど無い場合に使う検索クエリ
+    short_query_template: Optional[PromptTemplate] = None
+    # 移動判断を行わない人格の、レスポンスに載せる固定の移動判断
+    fixed_mobility: Optional[schemas.MobilityResponse] = None
+    # 直後の予定が無い場合の目的地
+    default_next_location: str = "特になし"
+    search_depth: str = "advanced"
+    max_results: int = 7
+    # プロンプトで求めるプランの数（不足している場合は追加で問い合わせる）
+    plan_count: int = 2
+    # 旧エンドポイント・ジョブの種類など、別名で呼び出せるようにする
+    aliases: tuple[str, ...] = field(default_factory=tuple)
+
+    def compile(self) -> None:
+        query_fields = BASE_FIELDS | MOBILITY_FIELDS if self.needs_mobility else BASE_FIELDS
+        self.query_template.compile(query_fields)
+        if self.short_query_template is not None:
+            self.short_query_template.compile(query_fields)
+        self.prompt_template.compile(query_fields | PROMPT_FIELDS)
+        if not self.needs_mobility and self.fixed_mobility is None:
+            raise ValueError(f"Persona {self.name} needs fixed_mobility when needs_mobility is False")
+
+    @property
+    def search_depends_on_mobility(self) -> bool:
+        """検索クエリが移動判断の結果を使うかどうか（使わなければ移動判断と並行して検索できる）"""
+        templates = [self.query_template, self.short_query_template]
+        return any(template is not None and template.fields & MOBILITY_FIELDS for template in templates)
+
+
+class PersonaRegistry:
+    def __init__(self):
+        self._personas: dict[str, Persona] = {}
+        self._aliases: dict[str, str] = {}
+        self._compiled = False
+
+    def register(self, persona: Persona) -> Persona:
+        if persona.name in self._personas or persona.name in self._aliases:
+            raise ValueError(f"Persona {persona.name} is already registered")
+        self._personas[persona.name] = persona
+        for alias in persona.aliases:
+            self._aliases[alias] = persona.name
+        if self._compiled:
+            persona.compile()
+        return persona
+
+    def compile(self) -> None:
+        """全ての人格のテンプレートを検証・前処理する（起動時に呼び出す）"""
+        for persona in self._personas.values():
+            persona.compile()
+        self._compiled = True
+
+    def get(self, name: str) -> Optional[Persona]:
+        persona = self._personas.get(self._aliases.get(name, name))
+        if persona is not None and not self._compiled:
+            self.compile()
+        return persona
+
+    def names(self) -> list[str]:
+        return list(self._personas)
+
+
+# アプリケーション全体で共有するレジストリ
+persona_registry = PersonaRegistry()
+
+persona_registry.register(Persona(
+    name="master",
+    description="ユーザーの好みに合わせて、空き時間を楽しむプランを提案します。",
+    needs_mobility=True,
+    query_template=PromptTemplate("{search_area}で{net_activity_minutes}分で楽しめること"),
+    short_query_template=PromptTemplate("{origin}で15分以内にできること"),
+    prompt_template=PromptTemplate("""
+        あなたは、ユーザーの状況を深く理解し、最高の体験を提案するエキスパート・プランナーです。
+        以下のすべての情報を分析し、ユーザーに2つの異なる魅力的な行動プランを提案してください。
+        各プランは、移動やアクティビティを含む一連の「イベントの集合」として構成してください。
+
+        # ユーザーの基本情報
+        - 出発地: {origin}
+        - 前の予定の終了時刻: {prev_end_time}
+        - 目的地: {destination}
+        - 次の予定の開始時刻: {next_start_time}
+        - ユーザーの好み: 「{preferences}」
+
+        # この日のその他の予定
+        {day_context}
+
+        # あなたが行った移動判断
+        {mobility_reasoning}
+        推奨する移動手段は「{mobility_mode}」で、所要時間は約{mobility_minutes}分です。
+
+        # Web検索から得られた参考情報
+        {search_context}
+
+        # あなたの最終タスク
+        上記の情報を基に、ユーザーの好みを満たす、創造的で具体的な行動プランを2パターン生成してください。
+        各プランは、以下の要素からなるイベントのリストで構成されます。
+        1. 【移動】前の予定の場所からアクティビティの場所への移動
+        2. 【アクティビティ】メインの活動
+        3. 【移動】アクティビティの場所から次の予定の場所への移動
+
+        時間計算は厳密に行ってください。前の予定の終了から次の予定の開始まですべての時間が埋まるように、イベントのstart_timeとend_timeを正確に設定してください。
+        この日の後に控えている予定の場所や時刻も考慮し、それに間に合わなくなる・重なるプランは提案しないでください。
+        必ず、以下のJSON形式で、2つのプランのリストとして出力してください。
+
+        {{
+          "plans": [
+            {{
+              "pattern_description": "プラン1のテーマ（例：静かなカフェで読書プラン）",
+              "events": [
+                {{
+                  "title": "移動：{origin}からアクティビティ場所へ",
+                  "start_time": "{prev_end_time}",
+                  "end_time": "...",
+                  "location": "{origin}",
+                  "description": "移動手段：{mobility_mode}"
+                }},
+                {{
+                  "title": "アクティビティのタイトル",
+                  "start_time": "...",
+                  "end_time": "...",
+                  "location": "アクティビティの具体的な場所",
+                  "description": "アクティビティの具体的な内容"
+                }},
+                {{
+                  "title": "移動：アクティビティ場所から{destination}へ",
+                  "start_time": "...",
+                  "end_time": "{next_start_time}",
+                  "location": "アクティビティの場所",
+                  "description": "移動手段：..."
+                }}
+              ]
+            }},
+            {{
+              "pattern_description": "プラン2のテーマ（例：話題の雑貨屋巡りプラン）",
+              "events": [
+                {{
+                  "title": "移動：...",
+                  "start_time": "...",
+                  "end_time": "...",
+                  "location": "...",
+                  "description": "..."
+                }},
+                {{
+                  "title": "...",
+                  "start_time": "...",
+                  "end_time": "...",
+                  "location": "...",
+                  "description": "..."
+                }},
+                {{
+                  "title": "移動：...",
+                  "start_time": "...",
+                  "end_time": "...",
+                  "location": "...",
+                  "description": "..."
+                }}
+              ]
+            }}
+          ]
+        }}
+        """),
+    aliases=("planner",),
+))
+
+persona_registry.register(Persona(
+    name="masculine",
+    description="トライアスリート向けに、過酷なトレーニングプランを提案します。",
+    needs_mobility=False,
+    # クエリをより具体的に
+    query_template=PromptTemplate(
+        "{origin}と{destination}の間にある、またはその周辺の、ランニングコース、オープンウォータースイミングができる場所、"
+        "登山・トレイルランニングができる山。ジムや公共のトレーニング施設も含む。体を鍛えることができる場所であれば基本的にどこでも良い。"
+    ),
+    prompt_template=PromptTemplate("""
+        あなたは、トライアスロン世界大会優勝を目指すアスリートを指導する、鬼コーチです。
+        これから、選手の空き時間を使った、極限まで追い込むトレーニングプランを2つ立案してください。
+
+        # 選手の状況
+        - 前の予定の終了時刻: {prev_end_time}
+        - 出発地: {origin}
+        - 次の予定の開始時刻: {next_start_time}
+        - 目的地: {destination}
+        - 選手の好み・目標: 「{preferences}」
+
+        # Web検索から得られたトレーニング場所の情報
+        {search_context}
+
+        # 絶対厳守のルール
+        - 移動手段は「走る」「泳ぐ」「山を登る」のいずれか、またはその組み合わせのみとする。絶対に他の移動手段を提案してはならない。
+        - 2地点間の距離が多少遠くても、上記の手段で移動するものとする。
+        - ただし、移動時間は厳密に計算し、前の予定の終了から次の予定の開始までの時間内に収めること。
+        - 上記の手段での移動により、時間内に移動できない場合は、電車やバスなどの公共交通機関を使うことは許可するが、あくまで例外的な措置とする。
+        - プランは常にトレーニングであること。休憩や観光の要素は一切不要。
+        - 時間計算は厳密に行い、前の予定の終了から次の予定の開始まで、1分たりとも無駄にしないこと。
+
+        # あなたの最終タスク
+        上記の全てを考慮し、最も過酷で効果的なトレーニングプランを2パターン生成してください。
+        必ず、以下のJSON形式で、2つのプランのリストとして出力してください。
+
+        {{
+          "plans": [
+            {{
+              "pattern_description": "プラン1のテーマ（例：心肺機能を追い込む峠走プラン）",
+              "events": [
+                {{
+                  "title": "移動(RUN): {origin}からトレーニング場所へ",
+                  "start_time": "...", "end_time": "...", "location": "...", "description": "全力で走る。ペースはキロ4分を目指す。"
+                }},
+                {{
+                  "title": "トレーニング: （例）〇〇山 ヒルクライムインターバル",
+                  "start_time": "...", "end_time": "...", "location": "...", "description": "..."
+                }},
+                {{
+                  "title": "移動(RUN): トレーニング場所から{destination}へ",
+                  "start_time": "...", "end_time": "...", "location": "...", "description": "クールダウンを兼ねてジョグで移動。"
+                }}
+              ]
+            }},
+            {{
+              "pattern_description": "プラン2のテーマ（例：実戦想定ブリックトレーニング）",
+              "events": [ ... ]
+            }}
+          ]
+        }}
+        """),
+    # 移動判断を行わないので、固定の判断結果をレスポンスに載せる
+    fixed_mobility=schemas.MobilityResponse(
+        use_public_transport=False,
+        recommended_mode="己の肉体",
+        reasoning="アスリートに文明の利器は不要。移動は全てトレーニングの一環である。",
+        estimated_time=0, # 時間はプラン内で計算
+        estimated_cost="0円"
+    ),
+    default_next_location="目的地",
+    aliases=("masculine-planner",),
+))
@@ -0,0 +1,362 @@
+# app/plan_index.py
+
+import os
+import json
+import time
+import uuid
+import base64
+import hashlib
+import asyncio
+import operator
+import threading
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:
+    # `uv sync --extra vector` でインストールしていない場合は、純Pythonで類似度を計算する
+    np = None
+
+from . import schemas, upstream
+from .coordination import file_lock
+from .timezones import to_local
+from .travel_time import normalize_place_name
+
+# 生成したプランとその条件のベクトルを保存するファイル（1行1件のJSON。PLAN_INDEX_PATH で変更できる）
+DEFAULT_PLAN_INDEX_PATH = "./plan_index.jsonl"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 256
+
+# これ以上似ている条件で生成済みのプランがあれば、OpenAIに問い合わせずに再利用する（1より大きくすると無効）
+DEFAULT_SIMILARITY_THRESHOLD = 0.93
+# 保存しておくプランの上限。超えた分は最後に使われたのが古いものから削除する
+DEFAULT_MAX_ENTRIES = 2000
+# 削除するときは、上限のこの割合まで減らす（削除のたびにファイルを書き直さないため）
+EVICTION_TARGET_RATIO = 0.9
+# 条件が似ていても、空き時間の長さ・時間帯が大きく違うプランは再利用しない
+MAX_DURATION_RATIO = 1.25
+MAX_HOUR_DIFFERENCE = 2
+
+
+def similarity_threshold() -> float:
+    return float(os.getenv("PLAN_REUSE_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD))
+
+
+def is_plan_reuse_enabled() -> bool:
+    return similarity_threshold() <= 1.0
+
+
+def request_context(req: schemas.MobilityRequest) -> str:
+    """
+    ベクトル化する条件の文。ベクトルはユーザーの好みの近さだけに使い、
+    人格・出発地・目的地・移動手段・時間帯は検索時に条件として絞り込む
+    """
+    return f"ユーザーの好み: {req.user_preferences}"
+
+
+def route_key(req: schemas.MobilityRequest) -> str:
+    """出発地と目的地の表記ゆれを吸収したキー"""
+    return f"{normalize_place_name(req.prev_event_location)}|{normalize_place_name(req.next_event_location)}"
+
+
+def day_context_key(day_context: Optional[str]) -> Optional[str]:
+    """
+    その日の他の予定のまとめ（app/day_context.py）のダイジェスト。
+    前後の予定が変わればプランの前提も変わるため、まとめが同じプランだけを再利用する
+    """
+    if day_context is None:
+        return None
+    return hashlib.sha256(day_context.encode("utf-8")).hexdigest()[:16]
+
+
+def mobility_mode(mobility_decision: schemas.MobilityResponse) -> str:
+    return "transit" if mobility_decision.use_public_transport else "walk"
+
+
+def normalize(vector: list[float]) -> array:
+    """コサイン類似度を内積で求められるよう、長さ1に正規化する"""
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return array("f", (value / norm for value in vector))
+
+
+async def embed_contexts(contexts: list[str], cassette_context: Optional[dict] = None) -> list[array]:
+    vectors = await upstream.embeddings(
+        model=EMBEDDING_MODEL, texts=contexts, dimensions=EMBEDDING_DIMENSIONS,
+        cassette_label="plan_index.embeddings", cassette_context=cassette_context,
+    )
+    return [normalize(vector) for vector in vectors]
+
+
+def _encode_plans(req: schemas.MobilityRequest, plans: list[schemas.PlanPattern]) -> list[dict]:
+    # 時刻は空き時間の開始からの秒数で保存し、再利用するときに新しい空き時間に合わせる
+    origin = req.prev_event_end_time
+    return [
+        {
+            "pattern_description": plan.pattern_description,
+            "events": [
+                {
+                    "title": event.title,
+                    "location": event.location,
+                    "description": event.description,
+                    "start_offset": (event.start_time - origin).total_seconds(),
+                    "end_offset": (event.end_time - origin).total_seconds(),
+                }
+                for event in plan.events
+            ],
+        }
+        for plan in plans
+    ]
+
+
+def retime_plans(entry: dict, req: schemas.MobilityRequest) -> list[schemas.PlanPattern]:
+    """保存済みのプランの時刻を、新しい空き時間の長さに合わせて伸縮する（分単位に丸める）"""
+    start = req.prev_event_end_time
+    end = req.next_event_start_time
+    ratio = (end - start).total_seconds() / (entry["minutes"] * 60)
+
+    def at(offset: float) -> datetime:
+        moved = start + timedelta(minutes=round(offset * ratio / 60))
+        return min(max(moved, start), end)
+
+    return [
+        schemas.PlanPattern(
+            pattern_description=plan["pattern_description"],
+            events=[
+                schemas.EventCreate(
+                    title=event["title"],
+                    start_time=at(event["start_offset"]),
+                    end_time=at(event["end_offset"]),
+                    location=event["location"],
+                    description=event["description"],
+                )
+                for event in plan["events"]
+            ],
+        )
+        for plan in entry["plans"]
+    ]
+
+
+@dataclass
+class PlanMatch:
+    entry: dict
+    score: float
+
+
+class PlanIndex:
+    """
+    生成したプランを、好みの文のベクトルとともに保存するローカルのベクトルインデックス。
+    人格・出発地・目的地（・移動手段）・その日の他の予定が一致し、空き時間の長さ・時間帯が近いプランだけを候補にして、
+    候補とだけ内積を取る。
+    追加はファイルへの追記で行い、他のワーカーが追記した分は検索時に読み込む。
+    上限を超えたら、最後に使われたのが古いものから削除してファイルを書き直す。
+    追記と書き直しはファイルロックで排他する（書き直しの間に他のワーカーが追記した分を失わないため）。
+    ファイルの読み書きと類似度の計算はイベントループの外（スレッド）で行う。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._entries: list[dict] = []
+        self._vectors: list[array] = []
+        self._ids: set[str] = set()
+        # (人格, 出発地|目的地) -> その条件のプランの位置
+        self._by_route: dict[tuple[str, str], list[int]] = {}
+        self._matrix = None
+        self._loaded = False
+        # 読み込み済みのファイルの位置（他のワーカーの追記・書き直しを検知する）
+        self._file_id: Optional[tuple[int, int]] = None
+        self._offset = 0
+        self._stats = {"hits": 0, "misses": 0, "adds": 0, "evictions": 0}
+        # スレッドから読み書きするため、インデックスの状態の更新は1つずつ行う
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def max_entries() -> int:
+        return int(os.getenv("PLAN_INDEX_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+
+    def _lock_path(self) -> str:
+        return f"{self.path}.lock"
+
+    def _reset(self) -> None:
+        self._entries, self._vectors, self._ids, self._by_route = [], [], set(), {}
+        self._matrix = None
+
+    def _sync(self) -> None:
+        if self.path is None:
+            self.path = os.getenv("PLAN_INDEX_PATH", DEFAULT_PLAN_INDEX_PATH)
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._loaded = True
+            return
+        file_id = (stat.st_dev, stat.st_ino)
+        if not self._loaded or file_id != self._file_id or stat.st_size < self._offset:
+            # 初回、または他のワーカーがファイルを書き直した場合は全て読み直す
+            self._reset()
+            self._file_id = file_id
+            self._offset = 0
+        if stat.st_size > self._offset:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                for line in f:
+                    # 書き込み途中の行は、次回読み込む
+                    if not line.endswith(b"\n"):
+                        break
+                    self._offset += len(line)
+                    try:
+                        self._append(json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        print(f"Skipping invalid plan index entry: {e}")
+        self._loaded = True
+
+    def _append(self, record: dict) -> None:
+        if record["id"] in self._ids:
+            return
+        vector = array("f")
+        vector.frombytes(base64.b64decode(record.pop("vector")))
+        record.setdefault("last_used", record["created_at"])
+        self._insert(record, vector)
+
+    def _insert(self, record: dict, vector: array) -> None:
+        # 出発地・目的地を持たない古い形式のプランは、条件で絞り込めないため検索の対象にしない
+        if "route" in record:
+            self._by_route.setdefault((record["persona"], record["route"]), []).append(len(self._entries))
+        self._entries.append(record)
+        self._vectors.append(vector)
+        self._ids.add(record["id"])
+        self._matrix = None
+
+    def _scores(self, query: array, indexes: list[int]) -> list[float]:
+        if np is not None:
+            if self._matrix is None:
+                self._matrix = np.array(self._vectors, dtype=np.float32)
+            return (self._matrix[indexes] @ np.asarray(query, dtype=np.float32)).tolist()
+        return [sum(map(operator.mul, self._vectors[i], query)) for i in indexes]
+
+    async def lookup(
+        self, persona: str, vector: array, req: schemas.MobilityRequest,
+        mobility_decision: Optional[schemas.MobilityResponse] = None, day_context: Optional[str] = None,
+    ) -> Optional[PlanMatch]:
+        """
+        同じ人格・同じ出発地と目的地（移動判断があれば同じ移動手段）・同じその日の他の予定のまとめで、
+        空き時間の長さ・時間帯が近く、好みが十分に似ているプランを探す
+        """
+        return await asyncio.to_thread(self._lookup, persona, vector, req, mobility_decision, day_context_key(day_context))
+
+    def _lookup(
+        self, persona: str, vector: array, req: schemas.MobilityRequest,
+        mobility_decision: Optional[schemas.MobilityResponse], day_key: Optional[str],
+    ) -> Optional[PlanMatch]:
+        minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
+        hour = to_local(req.prev_event_end_time).hour
+        mode = mobility_mode(mobility_decision) if mobility_decision is not None else None
+        threshold = similarity_threshold()
+        with self._lock:
+            self._sync()
+            best: Optional[PlanMatch] = None
+            candidates = []
+            for i in self._by_route.get((persona, route_key(req)), []) if minutes > 0 else []:
+                entry = self._entries[i]
+                if mode is not None and entry["mode"] != mode:
+                    continue
+                if entry.get("day_context") != day_key:
+                    continue
+                if max(minutes, entry["minutes"]) / min(minutes, entry["minutes"]) > MAX_DURATION_RATIO:
+                    continue
+                hour_difference = abs(hour - entry["hour"])
+                if min(hour_difference, 24 - hour_difference) > MAX_HOUR_DIFFERENCE:
+                    continue
+                if len(self._vectors[i]) == len(vector):
+                    candidates.append(i)
+            if candidates:
+                for i, score in zip(candidates, self._scores(vector, candidates)):
+                    if score >= threshold and (best is None or score > best.score):
+                        best = PlanMatch(self._entries[i], score)
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            best.entry["last_used"] = time.time()
+            return best
+
+    async def add(
+        self, persona: str, vector: array, req: schemas.MobilityRequest, context: str, response: schemas.PlannerResponse,
+        day_context: Optional[str] = None,
+    ) -> None:
+        """生成したプランを保存する。保存に失敗しても生成結果には影響させない"""
+        minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
+        if minutes <= 0 or not response.plans:
+            return
+        record = {
+            "id": uuid.uuid4().hex,
+            "persona": persona,
+            "context": context,
+            "route": route_key(req),
+            "mode": mobility_mode(response.mobility_decision),
+            "day_context": day_context_key(day_context),
+            "minutes": minutes,
+            "hour": to_local(req.prev_event_end_time).hour,
+            "mobility_decision": response.mobility_decision.model_dump(mode="json"),
+            "plans": _encode_plans(req, response.plans),
+            "created_at": time.time(),
+            "vector": base64.b64encode(vector.tobytes()).decode("ascii"),
+        }
+        await asyncio.to_thread(self._add, record)
+
+    def _add(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._sync()
+            try:
+                with file_lock(self._lock_path()):
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(line)
+            except OSError as e:
+                print(f"Failed to save plan index entry: {e}")
+            # 自分の追記は次回の読み込みで重複として読み飛ばす
+            self._append(record)
+            self._stats["adds"] += 1
+            if len(self._entries) > self.max_entries():
+                self._evict()
+
+    def _evict(self) -> None:
+        try:
+            with file_lock(self._lock_path()):
+                # 書き直す前に他のワーカーの追記を読み込み、ロックを持っている間は他のワーカーは追記できない
+                self._sync()
+                keep = int(self.max_entries() * EVICTION_TARGET_RATIO)
+                order = sorted(range(len(self._entries)), key=lambda i: self._entries[i]["last_used"], reverse=True)[:keep]
+                order.sort()
+                self._stats["evictions"] += len(self._entries) - len(order)
+                entries = [self._entries[i] for i in order]
+                vectors = [self._vectors[i] for i in order]
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for entry, vector in zip(entries, vectors):
+                        record = {**entry, "vector": base64.b64encode(vector.tobytes()).decode("ascii")}
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, self.path)
+                stat = os.stat(self.path)
+        except OSError as e:
+            print(f"Failed to compact plan index: {e}")
+            return
+        self._reset()
+        for entry, vector in zip(entries, vectors):
+            self._insert(entry, vector)
+        self._file_id = (stat.st_dev, stat.st_ino)
+        self._offset = stat.st_size
+
+    def snapshot(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries(),
+            "threshold": similarity_threshold(),
+            "backend": "numpy" if np is not None else "python",
+            **self._stats,
+        }
+
+
+# アプリケーション全体で共有するインデックス（初回の検索時にファイルから読み込む）
+plan_index = PlanIndex()
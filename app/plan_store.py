@@ -0,0 +1,79 @@
+# app/plan_store.py
+
+import os
+import uuid
+import asyncio
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, models, schemas
+from .database import AsyncSessionLocal
+from .timezones import utc_now
+
+# 生成したプランを採用できる期間（分）。GENERATED_PLAN_TTL_MINUTES で変更できる
+DEFAULT_PLAN_TTL_MINUTES = 24 * 60
+# 期限切れのプランを削除する間隔（秒）
+DEFAULT_SWEEP_INTERVAL_SECONDS = 600
+
+
+class PlanStore:
+    """
+    生成したプランにIDを付けて一定時間保存し、期限切れのものを定期的に削除する。
+    採用（予定としての登録）は crud.accept_generated_plan で行う。
+    """
+
+    def __init__(self):
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def ttl() -> timedelta:
+        return timedelta(minutes=float(os.getenv("GENERATED_PLAN_TTL_MINUTES", DEFAULT_PLAN_TTL_MINUTES)))
+
+    async def save(
+        self, db: AsyncSession, responses: list[schemas.PlannerResponse], source: str
+    ) -> list[schemas.PlannerResponse]:
+        """
+        プランを保存し、plan_id を付けたコピーを返す。
+        実行中の処理を共有した呼び出し元と同じオブジェクトを返さないよう、元のレスポンスは変更しない。
+        """
+        expires_at = utc_now() + self.ttl()
+        saved = [response.model_copy(update={"plan_id": uuid.uuid4().hex}) for response in responses]
+        await crud.create_generated_plans(db, [
+            models.GeneratedPlan(
+                id=response.plan_id, source=source, payload=response.model_dump_json(), expires_at=expires_at
+            )
+            for response in saved
+        ])
+        return saved
+
+    async def save_one(self, db: AsyncSession, response: schemas.PlannerResponse, source: str) -> schemas.PlannerResponse:
+        return (await self.save(db, [response], source))[0]
+
+    async def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def sweep(self) -> int:
+        async with AsyncSessionLocal() as db:
+            return await crud.delete_expired_generated_plans(db)
+
+    async def _sweep_forever(self) -> None:
+        interval = float(os.getenv("PLAN_SWEEP_INTERVAL_SECONDS", DEFAULT_SWEEP_INTERVAL_SECONDS))
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Failed to delete expired plans: {e}")
+            await asyncio.sleep(interval)
+
+
+# アプリケーション全体で共有するストア（期限切れのプランの削除はアプリの起動中だけ行う）
+plan_store = PlanStore()
@@ -0,0 +1,70 @@
+# app/profile_cache.py
+
+import os
+import time
+from datetime import date
+from typing import Optional
+
+from . import schemas
+
+# 他のワーカーでのプロフィールの再生成・予定の変更を反映するまでの最大の秒数
+DEFAULT_PROFILE_CACHE_TTL_SECONDS = 60
+
+
+class ProfileCache:
+    """
+    最新のプロフィールと「今日予定が更新されたか」をプロセス内に保持し、GET /profile/ でDBを読まずに済ませる。
+    このプロセスでの予定の変更（crud._publish_change）とプロフィールの生成で更新し、
+    他のワーカーでの変更は一定時間（PROFILE_CACHE_TTL_SECONDS）後に読み直して反映する。
+    """
+
+    def __init__(self):
+        self._profile: Optional[schemas.UserProfileResponse] = None
+        self._profile_expires = 0.0
+        # 予定が更新されたことが分かっている日（プロフィールの生成日時と同じく、サーバーの日付）
+        self._events_updated_on: Optional[date] = None
+        # DBを確認して、その日にまだ予定が更新されていなかった日
+        self._no_updates_on: Optional[date] = None
+        self._no_updates_expires = 0.0
+
+    @staticmethod
+    def ttl() -> float:
+        return float(os.getenv("PROFILE_CACHE_TTL_SECONDS", DEFAULT_PROFILE_CACHE_TTL_SECONDS))
+
+    def get_profile(self) -> tuple[bool, Optional[schemas.UserProfileResponse]]:
+        """(キャッシュが有効か, プロフィール)。プロフィールがまだ無いこともキャッシュする"""
+        if time.monotonic() >= self._profile_expires:
+            return False, None
+        return True, self._profile
+
+    def set_profile(self, profile: Optional[schemas.UserProfileResponse]) -> None:
+        self._profile = profile
+        self._profile_expires = time.monotonic() + self.ttl()
+
+    def events_updated_on(self, day: date) -> Optional[bool]:
+        """その日に予定が更新されたか。分からなければ None（DBを確認する）"""
+        if self._events_updated_on == day:
+            return True
+        if self._no_updates_on == day and time.monotonic() < self._no_updates_expires:
+            return False
+        return None
+
+    def set_events_updated_on(self, day: date, updated: bool) -> None:
+        if updated:
+            self._events_updated_on = day
+        else:
+            self._no_updates_on = day
+            self._no_updates_expires = time.monotonic() + self.ttl()
+
+    def note_event_change(self) -> None:
+        """予定が変更された（コミット後に呼ぶ）"""
+        self._events_updated_on = date.today()
+
+    def invalidate(self) -> None:
+        self._profile_expires = 0.0
+        self._events_updated_on = None
+        self._no_updates_on = None
+
+
+# アプリケーション全体で共有するキャッシュ
+profile_cache = ProfileCache()
@@ -0,0 +1,221 @@
+# app/profiling.py
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from sqlalchemy import event
+
+# イベントループの遅延を測る間隔（秒）
+DEFAULT_LOOP_LAG_INTERVAL_SECONDS = 0.5
+# これ以上遅れた場合を、ループが止まった（同期処理がブロックした）とみなす（秒）
+LOOP_STALL_THRESHOLD_SECONDS = 0.1
+LOOP_LAG_WINDOW = 600
+# これ以上かかったリクエストを記録する（秒）。SLOW_REQUEST_SECONDS で変更できる
+DEFAULT_SLOW_REQUEST_SECONDS = 2.0
+SLOW_REQUEST_CAPACITY = 50
+# サンプリングプロファイラの設定
+MAX_PROFILE_SECONDS = 60.0
+DEFAULT_PROFILE_INTERVAL_SECONDS = 0.005
+MAX_STACK_DEPTH = 64
+
+
+class RequestTrace:
+    """1つのリクエストの中で、DB・上流API・プラン生成の各段階にかかった時間の合計"""
+
+    def __init__(self):
+        self.spans: dict[str, list] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        entry = self.spans.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_span(name: str, seconds: float) -> None:
+    """実行中のリクエストに段階の所要時間を加える（リクエストの外では何もしない）"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+def instrument_engine(engine) -> None:
+    """SQLの実行時間をリクエストごとに記録する（AsyncEngine の sync_engine にイベントを登録する）"""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_trace.get() is not None:
+            conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("profiling_started")
+        if started:
+            record_span("db", time.perf_counter() - started.pop())
+
+
+class LoopLagMonitor:
+    """一定間隔で眠り、予定より遅れて起きた時間からイベントループの詰まり（同期処理によるブロック）を測る"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        # (起きた時刻 time.monotonic(), 遅れ秒)
+        self._samples: deque[tuple[float, float]] = deque(maxlen=LOOP_LAG_WINDOW)
+        self._stalls = 0
+        self._max_lag = 0.0
+
+    @staticmethod
+    def interval() -> float:
+        return float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", DEFAULT_LOOP_LAG_INTERVAL_SECONDS))
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        interval = self.interval()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - interval)
+            self._samples.append((now, lag))
+            self._max_lag = max(self._max_lag, lag)
+            if lag >= LOOP_STALL_THRESHOLD_SECONDS:
+                self._stalls += 1
+
+    def max_lag_between(self, start: float, end: float) -> float:
+        """その間（time.monotonic() の時刻）に観測した最大の遅れ。測り終えた時点で遅れが分かるので、少し後まで含める"""
+        limit = end + self.interval()
+        return max((lag for at, lag in self._samples if start <= at <= limit), default=0.0)
+
+    def snapshot(self) -> dict:
+        lags = sorted(lag for _, lag in self._samples)
+
+        def percentile(ratio: float) -> float:
+            return round(lags[min(len(lags) - 1, int(len(lags) * ratio))], 4) if lags else 0.0
+
+        return {
+            "running": self._task is not None,
+            "interval_seconds": self.interval(),
+            "samples": len(lags),
+            "lag_p50_seconds": percentile(0.5),
+            "lag_p99_seconds": percentile(0.99),
+            "lag_max_seconds": round(self._max_lag, 4),
+            "stalls": self._stalls,
+            "stall_threshold_seconds": LOOP_STALL_THRESHOLD_SECONDS,
+        }
+
+
+class SlowRequestLog:
+    """時間のかかったリクエストを、段階ごとの内訳とともに直近の一定件数だけ保持する"""
+
+    def __init__(self):
+        self._entries: deque[dict] = deque(maxlen=SLOW_REQUEST_CAPACITY)
+
+    @staticmethod
+    def threshold() -> float:
+        return float(os.getenv("SLOW_REQUEST_SECONDS", DEFAULT_SLOW_REQUEST_SECONDS))
+
+    def record(
+        self, method: str, path: str, status_code: int, started: float, finished: float, trace: RequestTrace
+    ) -> None:
+        duration = finished - started
+        if duration < self.threshold():
+            return
+        self._entries.append({
+            "method": method,
+            "path": path,
+            "status_code": status_code,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "duration_seconds": round(duration, 4),
+            # 並行して実行した段階は、合計がリクエストの時間を超えることがある
+            "spans": {
+                name: {"count": count, "seconds": round(seconds, 4)}
+                for name, (count, seconds) in sorted(trace.spans.items(), key=lambda item: -item[1][1])
+            },
+            "loop_lag_max_seconds": round(loop_lag_monitor.max_lag_between(started, finished), 4),
+        })
+
+    def snapshot(self) -> dict:
+        return {"threshold_seconds": self.threshold(), "requests": list(reversed(self._entries))}
+
+
+class ProfileInProgress(Exception):
+    """別のプロファイルを取得中"""
+
+
+class SamplingProfiler:
+    """
+    指定したスレッド（イベントループのスレッド）のスタックを一定間隔で採取し、
+    flamegraph.pl / speedscope で読める collapsed stack 形式（"関数;関数;関数 回数"）で返す。
+    取得している間だけサンプリング用のスレッドが動く
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self, thread_id: int, seconds: float, interval: float) -> Counter:
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(self._frame_name(frame))
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def profile(self, seconds: float, interval: float = DEFAULT_PROFILE_INTERVAL_SECONDS) -> str:
+        """このイベントループのスレッドを seconds 秒間サンプリングする"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfileInProgress("Another profile is in progress.")
+        try:
+            seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+            stacks = await asyncio.to_thread(self._sample, threading.get_ident(), seconds, interval)
+        finally:
+            self._lock.release()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# アプリケーション全体で共有するモニター・ログ・プロファイラ
+loop_lag_monitor = LoopLagMonitor()
+slow_request_log = SlowRequestLog()
+sampling_profiler = SamplingProfiler()
@@ -0,0 +1,440 @@
+# app/rate_limit.py
+
+import os
+import re
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from datetime import datetime, timedelta
+from typing import Dict, Mapping, Optional, Tuple
+
+from .coordination import coordination_store, is_shared_coordination_enabled
+
+# --- 上流APIの料金設定（USD） ---
+
+# モデルごとの100万トークンあたりの料金 (入力, 出力)
+OPENAI_PRICES_PER_MILLION_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+TAVILY_CREDIT_USD = 0.008
+TAVILY_CREDITS = {"basic": 1, "advanced": 2}
+
+# 料金が不明なモデルはgpt-4o相当として扱う
+DEFAULT_PRICE_MODEL = "gpt-4o"
+
+# 上流ごとのデフォルトの制限値（環境変数で上書き可能）
+DEFAULT_OPENAI_RPM = 500
+DEFAULT_OPENAI_TPM = 30000
+DEFAULT_TAVILY_RPM = 100
+DEFAULT_QUEUE_TIMEOUT_SECONDS = 20.0
+# 応答のトークン数が分からない段階で見込んでおく出力トークン数
+DEFAULT_COMPLETION_TOKENS_ESTIMATE = 1000
+
+# リクエスト元のクライアントID。公平性の制御に使う（ミドルウェアで設定する）
+current_client_id: contextvars.ContextVar[str] = contextvars.ContextVar("current_client_id", default="anonymous")
+
+
+class RateLimitError(Exception):
+    """上流APIの制限によりリクエストを処理できない場合のエラー"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1.0, retry_after)
+
+
+class BudgetExceededError(RateLimitError):
+    """本日の利用料金の上限に達した場合のエラー"""
+
+
+class QueueTimeoutError(RateLimitError):
+    """上流APIの空きを待っている間に期限を過ぎた場合のエラー"""
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """'1s', '6m0s', '20ms' のようなリセットまでの時間を秒に変換する"""
+    if not value:
+        return None
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    matches = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * units[unit] for amount, unit in matches)
+
+
+class TokenBucket:
+    """一定のレートで補充されるトークンバケット。上流のレスポンスヘッダーに合わせて補正される"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.time()
+        # 上流から残量ゼロを通知された場合、リセットまで払い出さない
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount を払い出せるまでの待ち時間（秒）。0なら即時に払い出せる"""
+        now = time.time()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # バケットの容量を超える要求は、満杯になった時点で払い出す
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def adjust(self, delta: float) -> None:
+        """見積もりと実際の消費量の差分を反映する"""
+        self.tokens -= delta
+
+    def adapt(self, limit: Optional[float], remaining: Optional[float], reset_seconds: Optional[float]) -> None:
+        """上流の x-ratelimit-* ヘッダーの値に合わせてバケットを補正する"""
+        now = time.time()
+        self._refill(now)
+        if limit:
+            self.capacity = limit
+            self.rate = limit / 60.0
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+            if remaining <= 0 and reset_seconds:
+                self.blocked_until = max(self.blocked_until, now + reset_seconds)
+
+    def block_for(self, seconds: float) -> None:
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+
+class FairLimiter:
+    """
+    上流API・モデルごとのリミッター。
+    待ち行列はクライアントごとの公平キューイング（仮想時刻順）で処理し、
+    特定のクライアントのバーストが他のクライアントの呼び出しを締め出さないようにする。
+    """
+
+    def __init__(
+        self, name: str, requests_per_minute: float, tokens_per_minute: Optional[float] = None, shared: bool = False
+    ):
+        self.name = name
+        # shared=True の場合、バケットの残量は全ワーカープロセスで共有する
+        self.shared = shared
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._condition = asyncio.Condition()
+        self._waiters: list[tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        self._virtual_time = 0.0
+        self._client_tags: Dict[str, float] = {}
+        self.rejected = 0
+
+    async def _try_take(self, estimated_tokens: float) -> float:
+        """トークンを取り出せれば0、足りなければ取り出さずに待ち時間（秒）を返す"""
+        if self.shared:
+            buckets = [(f"{self.name}:requests", 1, self.requests.capacity, self.requests.capacity)]
+            if self.tokens is not None:
+                buckets.append((f"{self.name}:tokens", estimated_tokens, self.tokens.capacity, self.tokens.capacity))
+            return await asyncio.to_thread(coordination_store.bucket_try_take, buckets)
+
+        wait = self.requests.wait_time(1)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(estimated_tokens))
+        if wait == 0:
+            self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(estimated_tokens)
+        return wait
+
+    async def acquire(self, client_id: str, estimated_tokens: float, deadline: float) -> None:
+        """払い出しの順番が来るまで待つ。deadline（monotonic時刻）を過ぎたら QueueTimeoutError"""
+        async with self._condition:
+            tag = max(self._virtual_time, self._client_tags.get(client_id, 0.0)) + 1.0
+            self._client_tags[client_id] = tag
+            waiter = (tag, next(self._sequence), client_id)
+            heapq.heappush(self._waiters, waiter)
+            try:
+                while True:
+                    wait = await self._try_take(estimated_tokens) if self._waiters[0] is waiter else None
+                    if wait == 0:
+                        heapq.heappop(self._waiters)
+                        self._virtual_time = tag
+                        self._prune_client_tags()
+                        self._condition.notify_all()
+                        return
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self.rejected += 1
+                        raise QueueTimeoutError(
+                            f"{self.name} is rate limited. Please retry later.",
+                            retry_after=wait if wait is not None else remaining,
+                        )
+                    timeout = remaining if wait is None else min(wait, remaining)
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                    self._condition.notify_all()
+                raise
+
+    def _prune_client_tags(self) -> None:
+        # 仮想時刻に追い越されたクライアントの記録は不要になる
+        if len(self._client_tags) > 1000:
+            self._client_tags = {c: t for c, t in self._client_tags.items() if t > self._virtual_time}
+
+    async def observe_headers(self, headers: Mapping[str, str]) -> None:
+        def number(key: str) -> Optional[float]:
+            try:
+                return float(headers[key])
+            except (KeyError, ValueError):
+                return None
+
+        buckets = [("requests", self.requests)]
+        if self.tokens is not None:
+            buckets.append(("tokens", self.tokens))
+        for kind, bucket in buckets:
+            limit = number(f"x-ratelimit-limit-{kind}")
+            remaining = number(f"x-ratelimit-remaining-{kind}")
+            reset_seconds = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            bucket.adapt(limit, remaining, reset_seconds)
+            if self.shared:
+                # 共有ストアの読み書きはファイルロックを待つことがあるため、イベントループの外で行う
+                await asyncio.to_thread(
+                    coordination_store.bucket_update,
+                    f"{self.name}:{kind}", bucket.capacity, limit=limit, remaining=remaining,
+                    block_seconds=reset_seconds if remaining is not None and remaining <= 0 else None,
+                )
+
+    async def adjust_tokens(self, delta: float) -> None:
+        """見積もりと実際のトークン消費量の差分を反映する"""
+        if self.tokens is None:
+            return
+        self.tokens.adjust(delta)
+        if self.shared:
+            await asyncio.to_thread(
+                coordination_store.bucket_update, f"{self.name}:tokens", self.tokens.capacity, delta=delta
+            )
+
+    async def block_for(self, seconds: float) -> None:
+        """上流から429が返った場合、指定時間は払い出しを止める"""
+        self.requests.block_for(seconds)
+        if self.shared:
+            await asyncio.to_thread(
+                coordination_store.bucket_update, f"{self.name}:requests", self.requests.capacity, block_seconds=seconds
+            )
+
+    async def snapshot(self) -> dict:
+        requests_available = self.requests.tokens
+        tokens_available = self.tokens.tokens if self.tokens else None
+        if self.shared:
+            shared_requests = await asyncio.to_thread(coordination_store.bucket_snapshot, f"{self.name}:requests")
+            shared_tokens = await asyncio.to_thread(coordination_store.bucket_snapshot, f"{self.name}:tokens")
+            requests_available = shared_requests["tokens"] if shared_requests else requests_available
+            if shared_tokens:
+                tokens_available = shared_tokens["tokens"]
+        return {
+            "name": self.name,
+            "shared": self.shared,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "requests_available": round(requests_available, 2),
+            "requests_per_minute": self.requests.capacity,
+            "tokens_available": round(tokens_available, 2) if tokens_available is not None else None,
+            "tokens_per_minute": self.tokens.capacity if self.tokens else None,
+        }
+
+
+class DailyCostBudget:
+    """1日あたりの上流APIの利用料金の上限"""
+
+    def __init__(self, limit_usd: Optional[float] = None, shared: bool = False):
+        self.limit_usd = limit_usd
+        # shared=True の場合、利用料金は全ワーカープロセスで合算する
+        self.shared = shared
+        self._day = datetime.now().date()
+        self._spent_usd = 0.0
+
+    def _roll_over(self) -> None:
+        today = datetime.now().date()
+        if today != self._day:
+            self._day = today
+            self._spent_usd = 0.0
+
+    @property
+    def _shared_key(self) -> str:
+        return f"budget:{self._day.isoformat()}"
+
+    async def spent_usd(self) -> float:
+        if self.shared:
+            return await asyncio.to_thread(coordination_store.get_json, self._shared_key) or 0.0
+        return self._spent_usd
+
+    @staticmethod
+    def seconds_until_reset() -> float:
+        now = datetime.now()
+        tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return (tomorrow - now).total_seconds()
+
+    async def check(self) -> None:
+        self._roll_over()
+        if self.limit_usd is not None and await self.spent_usd() >= self.limit_usd:
+            raise BudgetExceededError(
+                "Daily AI usage budget has been exhausted.", retry_after=self.seconds_until_reset()
+            )
+
+    async def charge(self, usd: float) -> None:
+        self._roll_over()
+        if self.shared:
+            await asyncio.to_thread(coordination_store.incr, self._shared_key, usd, ttl=2 * 24 * 3600)
+        else:
+            self._spent_usd += usd
+
+    async def snapshot(self) -> dict:
+        self._roll_over()
+        return {"day": self._day.isoformat(), "spent_usd": round(await self.spent_usd(), 4), "limit_usd": self.limit_usd}
+
+
+def openai_cost_usd(model: str, prompt_tokens: float, completion_tokens: float) -> float:
+    input_price, output_price = OPENAI_PRICES_PER_MILLION_TOKENS.get(
+        model, OPENAI_PRICES_PER_MILLION_TOKENS[DEFAULT_PRICE_MODEL]
+    )
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+class UpstreamSlot:
+    """
+    1回の上流呼び出しに対応する枠。呼び出し後にヘッダーと実際の消費量を報告する。
+    料金は枠を確保した時点で見積もりを計上し、実際の消費量が分かった時点で差額を精算する
+    （ヘッジで負けた呼び出しや期限切れで打ち切った呼び出しも、見積もりの額で計上される）。
+    """
+
+    def __init__(
+        self, registry: "UpstreamRateLimiter", limiter: FairLimiter, model: str, estimated_tokens: float,
+        charged_usd: float = 0.0,
+    ):
+        self._registry = registry
+        self._limiter = limiter
+        self.model = model
+        self.estimated_tokens = estimated_tokens
+        self.charged_usd = charged_usd
+
+    async def _settle(self, usd: float) -> None:
+        """計上済みの額との差額を計上し直す"""
+        delta = usd - self.charged_usd
+        self.charged_usd = usd
+        if delta:
+            await self._registry.budget.charge(delta)
+
+    async def observe_headers(self, headers: Mapping[str, str]) -> None:
+        await self._limiter.observe_headers(headers)
+
+    async def record_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        """OpenAIのトークン消費量を報告し、料金を計上する"""
+        await self._limiter.adjust_tokens(prompt_tokens + completion_tokens - self.estimated_tokens)
+        await self._settle(openai_cost_usd(self.model, prompt_tokens, completion_tokens))
+
+    async def record_credits(self, credits: int) -> None:
+        """Tavilyのクレジット消費量を報告し、料金を計上する"""
+        await self._settle(credits * TAVILY_CREDIT_USD)
+
+    async def upstream_rate_limited(self, retry_after: Optional[float]) -> RateLimitError:
+        """上流から429が返った場合に、リミッターを止めてクライアント向けのエラーを返す（429は課金されない）"""
+        wait = retry_after or 60.0
+        await self._limiter.block_for(wait)
+        await self._settle(0.0)
+        return RateLimitError(f"{self._limiter.name} is rate limited. Please retry later.", retry_after=wait)
+
+
+class UpstreamRateLimiter:
+    """上流API・モデルごとのリミッターと、日次の料金上限をまとめて管理する"""
+
+    def __init__(self):
+        self._limiters: Dict[str, FairLimiter] = {}
+        self.budget = DailyCostBudget()
+        self._configured = False
+
+    def _configure(self) -> None:
+        if self._configured:
+            return
+        budget = os.getenv("DAILY_COST_BUDGET_USD")
+        self.budget.limit_usd = float(budget) if budget else None
+        self.budget.shared = is_shared_coordination_enabled()
+        self._configured = True
+
+    def _limiter(self, upstream: str, model: str) -> FairLimiter:
+        key = f"{upstream}:{model}"
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            shared = is_shared_coordination_enabled()
+            if upstream == "openai":
+                limiter = FairLimiter(
+                    key,
+                    requests_per_minute=float(os.getenv("OPENAI_RPM", DEFAULT_OPENAI_RPM)),
+                    tokens_per_minute=float(os.getenv("OPENAI_TPM", DEFAULT_OPENAI_TPM)),
+                    shared=shared,
+                )
+            else:
+                limiter = FairLimiter(
+                    key, requests_per_minute=float(os.getenv("TAVILY_RPM", DEFAULT_TAVILY_RPM)), shared=shared
+                )
+            self._limiters[key] = limiter
+        return limiter
+
+    async def check_budget(self) -> None:
+        """本日の料金上限に達していれば、即座に BudgetExceededError を送出する"""
+        self._configure()
+        await self.budget.check()
+
+    async def acquire(
+        self, upstream: str, model: str, estimated_tokens: float = 0, estimated_usd: float = 0.0,
+        timeout: Optional[float] = None,
+    ) -> UpstreamSlot:
+        """上流APIを1回呼び出すための枠を確保し、見積もりの料金を計上する"""
+        await self.check_budget()
+        if timeout is None:
+            timeout = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT_SECONDS))
+        limiter = self._limiter(upstream, model)
+        await limiter.acquire(current_client_id.get(), estimated_tokens, deadline=time.monotonic() + timeout)
+        if estimated_usd:
+            await self.budget.charge(estimated_usd)
+        return UpstreamSlot(self, limiter, model, estimated_tokens, charged_usd=estimated_usd)
+
+    async def snapshot(self) -> dict:
+        self._configure()
+        return {
+            "budget": await self.budget.snapshot(),
+            "limiters": [await limiter.snapshot() for limiter in list(self._limiters.values())],
+        }
+
+
+def estimate_prompt_tokens(messages: list[dict]) -> float:
+    """送信前にトークン数を見積もる（日本語は1文字あたり約1トークンとして概算）"""
+    characters = sum(len(str(message.get("content", ""))) for message in messages)
+    return characters + DEFAULT_COMPLETION_TOKENS_ESTIMATE
+
+
+def estimate_chat_cost_usd(model: str, messages: list[dict]) -> float:
+    """送信前に料金を見積もる（出力は DEFAULT_COMPLETION_TOKENS_ESTIMATE トークンと仮定する）"""
+    prompt_tokens = estimate_prompt_tokens(messages) - DEFAULT_COMPLETION_TOKENS_ESTIMATE
+    return openai_cost_usd(model, prompt_tokens, DEFAULT_COMPLETION_TOKENS_ESTIMATE)
+
+
+# アプリケーション全体で共有するリミッター
+upstream_limiter = UpstreamRateLimiter()
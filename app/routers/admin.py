@@ -0,0 +1,103 @@
+# app/routers/admin.py
+
+import os
+import secrets
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import crud
+from ..admission import admission_controller
+from ..compression import compression_stats
+from ..database import get_db
+from ..latency import latency_tracker
+from ..llm_parsing import parse_stats
+from ..plan_index import plan_index
+from ..profiling import (
+    MAX_PROFILE_SECONDS, ProfileInProgress, loop_lag_monitor, sampling_profiler, slow_request_log
+)
+from ..rate_limit import upstream_limiter
+from ..service import planner_pipeline
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """管理用APIへのアクセスを ADMIN_TOKEN を知っているクライアントに限定する"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin API is disabled.")
+    if not secrets.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token.")
+
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"],
+    dependencies=[Depends(require_admin)]
+)
+
+@router.get("/rate-limits")
+async def read_rate_limits():
+    """上流APIごとのリミッターの状態と、本日の利用料金を返します。"""
+    return await upstream_limiter.snapshot()
+
+@router.get("/planner-stats")
+async def read_planner_stats():
+    """人格ごとのプラン生成の回数と、段階ごとの所要時間を返します。"""
+    return planner_pipeline.snapshot()
+
+@router.get("/parse-stats")
+async def read_parse_stats():
+    """LLMの出力の修復・破棄・追加の問い合わせの回数を、呼び出し元ごとに返します。"""
+    return parse_stats.snapshot()
+
+@router.get("/latency")
+async def read_latency():
+    """上流APIの呼び出しごとの所要時間(p50/p95)と、ヘッジした回数を返します。"""
+    return latency_tracker.snapshot()
+
+@router.get("/plan-index")
+async def read_plan_index():
+    """類似プランの再利用に使うインデックスの件数と、再利用できた回数を返します。"""
+    return plan_index.snapshot()
+
+@router.get("/admission")
+async def read_admission():
+    """リクエストの種類ごとの実行中・待ちの件数、待ち時間(p50/p99)と、503で断った回数を返します。"""
+    return admission_controller.snapshot()
+
+@router.get("/compression")
+async def read_compression():
+    """エンドポイント・圧縮方式ごとの圧縮前後のバイト数と、圧縮にかかったCPU時間を返します。"""
+    return compression_stats.snapshot()
+
+@router.get("/profiling/loop-lag")
+async def read_loop_lag():
+    """イベントループの遅延（同期処理によるブロック）の分布と、止まった回数を返します。"""
+    return loop_lag_monitor.snapshot()
+
+@router.get("/profiling/slow-requests")
+async def read_slow_requests():
+    """時間のかかったリクエストを、DB・上流API・プラン生成の段階ごとの内訳とともに新しい順に返します。"""
+    return slow_request_log.snapshot()
+
+@router.get("/profiling/profile", response_class=PlainTextResponse)
+async def download_profile(seconds: float = Query(10.0, gt=0, le=MAX_PROFILE_SECONDS)):
+    """
+    イベントループのスレッドを指定した秒数だけサンプリングし、collapsed stack 形式のファイルとして返します。
+    flamegraph.pl や speedscope でフレームグラフとして表示できます。
+    """
+    try:
+        profile = await sampling_profiler.profile(seconds)
+    except ProfileInProgress as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    filename = f"profile-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.collapsed"
+    return PlainTextResponse(profile, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@router.post("/rebuild-summaries")
+async def rebuild_summaries(db: AsyncSession = Depends(get_db)):
+    """全ての予定から日ごとの集計（統計API用）を作り直します。"""
+    days = await crud.rebuild_daily_summaries(db)
+    return {"days": days}
@@ -2,6 +2,8 @@
 
 from fastapi import APIRouter, HTTPException
 from .. import schemas, service
+from ..latency import DeadlineExceeded
+from ..rate_limit import RateLimitError
 
 router = APIRouter(
     prefix="/agent",
@@ -13,6 +15,9 @@ async def decide_user_mobility(request: schemas.MobilityRequest):
     try:
         decision = await service.MobilityAgent.decide_mobility(request)
         return decision
+    except (RateLimitError, DeadlineExceeded):
+        # 上流の制限・料金上限は429、期限切れは504として、アプリ共通のハンドラで返す
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except ConnectionError as e:
@@ -1,22 +1,57 @@
 # app/routers/events.py
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks
+import json
+from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List
-from datetime import datetime
+from typing import List, Literal, Optional, Sequence
+from datetime import date, datetime
 
-from .. import crud, schemas, models, user_profile
+from .. import crud, schemas, models, summaries, user_profile
+from ..conflicts import find_conflict_groups, is_overlap_enforced
+from ..change_feed import change_hub, get_latest_seq, to_change_schema
 from ..database import get_db
+from ..negotiation import MsgPackRoute
 
 router = APIRouter(
     prefix="/events",
-    tags=["Events"]
+    tags=["Events"],
+    # Accept: application/msgpack の場合はMessagePackで返す
+    route_class=MsgPackRoute
 )
 
+# 登録・変更した予定と時間が重なっている予定のID（カンマ区切り）を返すヘッダー
+CONFLICTS_HEADER = "X-Event-Conflicts"
+
+async def check_overlap(
+    db: AsyncSession, start: datetime, end: datetime, allow_overlap: Optional[bool], exclude_id: Optional[int] = None
+) -> Sequence[models.Event]:
+    """
+    時間が重なる予定を返す。重なりは設定によらず常に調べ、設定は拒否するかどうかだけを決める。
+    重複を禁止している場合は、重なる予定を全て 409 で返す。
+    """
+    conflicts = await crud.get_overlapping_events(db, start=start, end=end, exclude_id=exclude_id)
+    if conflicts and is_overlap_enforced(allow_overlap):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={
+                "message": "Event overlaps with existing events.",
+                "conflicts": [schemas.Event.model_validate(e).model_dump(mode="json") for e in conflicts],
+            },
+        )
+    return conflicts
+
+def report_conflicts(response: Response, conflicts: Sequence[models.Event]) -> None:
+    """重なりを許可して書き込んだ場合も、重なっている予定をヘッダーで知らせる"""
+    if conflicts:
+        response.headers[CONFLICTS_HEADER] = ",".join(str(e.id) for e in conflicts)
+
 @router.post("/", response_model=schemas.Event, status_code=status.HTTP_201_CREATED)
 async def create_new_event(
     event: schemas.EventCreate,
     background_tasks: BackgroundTasks,
+    response: Response,
+    allow_overlap: Optional[bool] = Query(None, description="時間が重なる予定の登録を許可するか（未指定の場合はサーバーの設定に従う）"),
     db: AsyncSession = Depends(get_db)
 ):
     if event.start_time >= event.end_time:
@@ -24,7 +59,9 @@ async def create_new_event(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="End time must be after start time."
         )
+    conflicts = await check_overlap(db, event.start_time, event.end_time, allow_overlap)
     created_event = await crud.create_event(db=db, event=event)
+    report_conflicts(response, conflicts)
 
     # 予定の変更をトリガーに、必要であればプロフィールをバックグラウンドで再生成
     background_tasks.add_task(
@@ -33,9 +70,203 @@ async def create_new_event(
     return created_event
 
 @router.get("/", response_model=List[schemas.Event])
-async def read_events(start: datetime, end: datetime, db: AsyncSession = Depends(get_db)):
+async def read_events(start: schemas.LocalDatetime, end: schemas.LocalDatetime, db: AsyncSession = Depends(get_db)):
     return await crud.get_events_by_period(db, start=start, end=end)
 
+@router.get("/conflicts", response_model=List[schemas.EventConflictGroup])
+async def read_event_conflicts(start: schemas.LocalDatetime, end: schemas.LocalDatetime, db: AsyncSession = Depends(get_db)):
+    """
+    指定した期間内で、時間が重なり合っている予定のまとまりを返します。
+
+    - 重なりが連鎖している予定（AとB、BとCが重なる場合など）は1つのまとまりになります。
+    """
+    events = await crud.get_events_by_period(db, start=start, end=end)
+    return find_conflict_groups(events)
+
+# 統計APIで一度に集計できる最大の日数
+MAX_STATS_DAYS = 731
+
+@router.get("/stats", response_model=schemas.EventStats)
+async def read_event_stats(
+    start: date,
+    end: date = Query(..., description="この日を含む"),
+    granularity: Literal["day", "week", "month"] = Query("day", description="buckets のまとめ方"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    期間内の予定の件数・合計時間と、時間帯・場所・分類ごとの内訳を返します。
+
+    - 予定の書き込み時に更新している日ごとの集計から求めるため、期間の日数分の行だけを読みます。
+    - 日をまたぐ予定は、それぞれの日に1件として数えます。
+    """
+    if end < start:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="End date must not be before start date.")
+    if (end - start).days >= MAX_STATS_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Date range must be at most {MAX_STATS_DAYS} days."
+        )
+    rows = await crud.get_daily_summaries(db, start=start, end=end)
+    return summaries.aggregate(rows, start, end, granularity)
+
+@router.get("/search", response_model=List[schemas.Event])
+async def search_events(
+    q: str = Query(..., min_length=1, description="検索語（空白区切りでAND検索）"),
+    start: Optional[schemas.LocalDatetime] = Query(None, description="この日時より後に終わる予定に絞り込む"),
+    end: Optional[schemas.LocalDatetime] = Query(None, description="この日時より前に始まる予定に絞り込む"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    予定のタイトル・場所・説明を全文検索し、関連度順に返します。
+
+    - 各語は部分一致で検索されます。末尾に `*` を付けた語（例: `京都*`）は、タイトルか場所がその語で始まる予定に一致します。
+    - 2文字以下の語は索引を使えないため、3文字以上の語・前方一致・期間と組み合わせると速く検索できます。
+    - **start** / **end** を指定すると、その期間に重なる予定に絞り込みます。
+    """
+    return await crud.search_events(db, query=q, start=start, end=end, limit=limit, offset=offset)
+
+@router.get("/changes", response_model=schemas.EventChangeBatch)
+async def read_event_changes(
+    since: int = Query(0, ge=0, description="前回のレスポンスの cursor"),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+):
+    """指定したカーソルより後の予定の変更を古い順に返します。"""
+    changes = await crud.get_event_changes(db, since=since, limit=limit)
+    return schemas.EventChangeBatch(
+        changes=[to_change_schema(change) for change in changes],
+        cursor=changes[-1].seq if changes else since,
+    )
+
+async def _resolve_cursor(since: Optional[int], last_event_id: Optional[str] = None) -> int:
+    # カーソルの指定が無ければ、いまから後の変更だけを配信する
+    if since is not None:
+        return since
+    if last_event_id and last_event_id.isdigit():
+        return int(last_event_id)
+    return await get_latest_seq()
+
+@router.get("/changes/stream")
+async def stream_event_changes(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0, description="このカーソルより後の変更から配信を再開します"),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    予定の変更を Server-Sent Events で配信します。
+
+    - 各イベントの `id` が通し番号で、再接続時は `Last-Event-ID` ヘッダーから自動で再開します。
+    """
+    cursor = await _resolve_cursor(since, last_event_id)
+
+    async def event_source():
+        async for change in change_hub.stream(since=cursor):
+            if await request.is_disconnected():
+                break
+            if change is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {change.seq}\nevent: {change.operation}\ndata: {change.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.websocket("/changes/ws")
+async def websocket_event_changes(websocket: WebSocket, since: Optional[int] = None):
+    """予定の変更を WebSocket で配信します。`since` を指定するとそのカーソルから再開します。"""
+    await websocket.accept()
+    cursor = await _resolve_cursor(since)
+    try:
+        async for change in change_hub.stream(since=cursor):
+            if change is None:
+                await websocket.send_text(json.dumps({"type": "keep-alive"}))
+                continue
+            await websocket.send_text(json.dumps({"type": "change", "change": change.model_dump(mode="json")}, ensure_ascii=False))
+    except WebSocketDisconnect:
+        pass
+
+# 差分同期の初回は予定をID順に分割して全件返し、その後は変更履歴の通し番号で差分を返す
+# token の形式: 全件取得の途中 "s<開始時点の通し番号>-<最後に返したID>" / 差分 "<通し番号>"
+def _parse_sync_token(token: Optional[str]) -> tuple[Optional[int], Optional[int]]:
+    if not token:
+        return None, None
+    try:
+        if token.startswith("s"):
+            seq, last_id = token[1:].split("-", 1)
+            return int(seq), int(last_id)
+        return int(token), None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid sync token.")
+
+@router.get("/sync", response_model=schemas.EventSyncResponse)
+async def sync_events(
+    since: Optional[str] = Query(None, description="前回のレスポンスの token。未指定の場合は全件を返します"),
+    limit: int = Query(200, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    前回の同期以降に作成・更新・削除された予定だけを返します。
+
+    - **has_more** が true の間は、返された **token** を since に指定して続けて取得してください。
+    - 同じ予定が何度変更されていても、最新の状態が1件だけ返ります。
+    """
+    seq, last_id = _parse_sync_token(since)
+
+    if seq is None or last_id is not None:
+        # 全件取得。取得中の変更は、開始時点の通し番号からの差分で後から受け取る
+        if seq is None:
+            seq = await crud.get_latest_change_seq(db)
+        events = await crud.get_events_after_id(db, after_id=last_id or 0, limit=limit)
+        has_more = len(events) == limit
+        token = f"s{seq}-{events[-1].id}" if has_more else str(seq)
+        return schemas.EventSyncResponse(upserted=events, deleted=[], token=token, has_more=has_more)
+
+    changes = await crud.get_event_changes(db, since=seq, limit=limit)
+    # 予定ごとに最後の操作だけを残す
+    latest_operations = {change.event_id: change.operation for change in changes}
+    upserted_ids = [event_id for event_id, operation in latest_operations.items() if operation != "deleted"]
+    events = await crud.get_events_by_ids(db, upserted_ids)
+    found_ids = {event.id for event in events}
+    # 後続の変更で削除済みの予定も、削除として返す
+    deleted = [event_id for event_id in latest_operations if event_id not in found_ids]
+    return schemas.EventSyncResponse(
+        upserted=sorted(events, key=lambda event: event.id),
+        deleted=deleted,
+        token=str(changes[-1].seq if changes else seq),
+        has_more=len(changes) == limit,
+    )
+
+@router.post("/sync", response_model=schemas.EventMutationBatchResult)
+async def upload_event_mutations(
+    batch: schemas.EventMutationBatch,
+    background_tasks: BackgroundTasks,
+    allow_overlap: Optional[bool] = Query(None, description="時間が重なる予定の登録を許可するか（未指定の場合はサーバーの設定に従う）"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    オフライン中にクライアントで行った作成・更新・削除をまとめて適用します。
+
+    - 更新・削除に **base_updated_at** を指定すると、サーバー側でその後に変更されていた場合は適用せずに
+      `conflict` とサーバー側の最新の状態を返します。
+    - 他の予定と時間が重なる作成・更新は、`conflicts` に重なっている予定を返します。
+      重複を禁止している場合は適用せずに `conflict` とします。
+    - 適用した変更は、次回の `GET /events/sync` でも返ります。
+    """
+    results = await crud.apply_event_mutations(
+        db, batch.mutations, enforce_overlap=is_overlap_enforced(allow_overlap)
+    )
+
+    if any(result.status == "applied" for result in results):
+        # 予定の変更をトリガーに、必要であればプロフィールをバックグラウンドで再生成
+        background_tasks.add_task(
+            user_profile.UserProfileService.regenerate_profile_if_stale, db=db
+        )
+    return schemas.EventMutationBatchResult(results=results)
+
 @router.get("/{event_id}", response_model=schemas.Event)
 async def read_event(event_id: int, db: AsyncSession = Depends(get_db)):
     db_event = await crud.get_event(db, event_id=event_id)
@@ -48,12 +279,22 @@ async def update_existing_event(
     event_id: int,
     event: schemas.EventUpdate,
     background_tasks: BackgroundTasks,
+    response: Response,
+    allow_overlap: Optional[bool] = Query(None, description="時間が重なる予定への変更を許可するか（未指定の場合はサーバーの設定に従う）"),
     db: AsyncSession = Depends(get_db)
 ):
     db_event = await crud.get_event(db, event_id=event_id)
     if db_event is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Event not found")
+    conflicts = await check_overlap(
+        db,
+        event.start_time or db_event.start_time,
+        event.end_time or db_event.end_time,
+        allow_overlap,
+        exclude_id=event_id,
+    )
     updated_event = await crud.update_event(db=db, db_event=db_event, event_update=event)
+    report_conflicts(response, conflicts)
 
     # 予定の変更をトリガーに、必要であればプロフィールをバックグラウンドで再生成
     background_tasks.add_task(
@@ -0,0 +1,47 @@
+# app/routers/jobs.py
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import schemas, crud
+from ..database import get_db
+from ..jobs import plan_job_queue, to_job_schema
+from ..personas import persona_registry
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["Jobs"]
+)
+
+@router.post("/{kind}", response_model=schemas.PlanJob, status_code=status.HTTP_202_ACCEPTED)
+async def submit_plan_job(
+    kind: str,
+    request: schemas.ConveniencePlannerRequest,
+    priority: int = Query(0, ge=-10, le=10, description="大きいほど優先して処理されます"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    プラン生成をジョブとして登録し、すぐにジョブIDを返します。
+
+    - **kind**: 人格の名前（`GET /planner/personas` を参照）。旧名の `planner` / `masculine-planner` も使えます
+    - 同じ内容のジョブが実行待ち・実行中の場合は、そのジョブを返します。
+    """
+    if persona_registry.get(kind) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown job kind")
+    job = await plan_job_queue.submit(db, kind=kind, request=request, priority=priority)
+    return to_job_schema(job)
+
+@router.get("/{job_id}", response_model=schemas.PlanJob)
+async def read_plan_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="完了を待つ最大秒数（ロングポーリング）"),
+    db: AsyncSession = Depends(get_db)
+):
+    """ジョブの状態と、完了していれば結果を返します。"""
+    if wait > 0:
+        job = await plan_job_queue.wait(db, job_id, timeout=wait)
+    else:
+        job = await crud.get_plan_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return to_job_schema(job)
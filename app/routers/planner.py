@@ -1,14 +1,24 @@
 # app/routers/planner.py を修正
 
-from fastapi import APIRouter, HTTPException, Depends # Dependsを追加
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Query, Response, status # Dependsを追加
 from sqlalchemy.ext.asyncio import AsyncSession       # AsyncSessionを追加
-from .. import schemas, service, crud                # crudを追加
+from .. import schemas, service, crud, models, user_profile   # crudを追加
+from ..conflicts import is_overlap_enforced
 from ..database import get_db           # get_dbを追加
+from ..negotiation import MsgPackRoute
+from ..personas import persona_registry
+from ..plan_store import plan_store
+from .events import check_overlap, report_conflicts
+from ..latency import DeadlineExceeded
+from ..rate_limit import RateLimitError
 from zoneinfo import ZoneInfo # 標準ライブラリ zoneinfo をインポート
 
 router = APIRouter(
     prefix="/planner",
-    tags=["Planner"]
+    tags=["Planner"],
+    # Accept: application/msgpack の場合はMessagePackで返す
+    route_class=MsgPackRoute
 )
 
 # ... 既存の /generate-plans エンドポイント ...
@@ -28,53 +38,138 @@ async def generate_plans_from_free_time(
     db: AsyncSession = Depends(get_db)
 ):
     """空き時間を指定すると、DBから直前・直後の予定を自動で補完してプランを生成します。"""
-    
-    # 1. DBから直前・直後のイベントを取得
-    prev_event_db = await crud.get_previous_event(db, request.free_time_start)
-    next_event_db = await crud.get_next_event(db, request.free_time_end)
-
-    # 2. MasterPlannerAgentへの入力（MobilityRequest）を組み立てる
-    # 直前のイベントが見つからなければ、ユーザーが指定した空き時間の開始時刻をそのまま使う
-    prev_event_end_time = prev_event_db.end_time if prev_event_db else request.free_time_start
-    prev_event_location = prev_event_db.location if prev_event_db else "現在地" # デフォルト値を設定
-
-    # 直後のイベントが見つからなければ、ユーザーが指定した空き時間の終了時刻をそのまま使う
-    next_event_start_time = next_event_db.start_time if next_event_db else request.free_time_end
-    next_event_location = next_event_db.location if next_event_db else "特になし" # デフォルト値を設定
-    
-    print(next_event_start_time)
-    print(prev_event_end_time)
-    # 時間の前後関係が正しいかチェック
-    # タイムゾーンをJSTに統一して、安全な比較を可能にする
-    # JST = ZoneInfo("Asia/Tokyo")
-
-    # タイムゾーン情報がない場合(naive)は、JSTとして扱う(awareにする)
-    # if prev_event_end_time.tzinfo is None:
-    #     prev_event_end_time = prev_event_end_time.replace()
-    
-    # if next_event_start_time.tzinfo is None:
-    #     next_event_start_time = next_event_start_time.replace()
-
-    # これで、aware同士の安全な比較になる
-    # if prev_event_end_time >= next_event_start_time:
-    #     raise HTTPException(
-    #         status_code=400,
-    #         detail="検索されたイベントの時間関係が不正です。直前の予定が直後の予定より後に終了します。"
-    #     )
-
-    # AIエージェントに渡すためのリクエストオブジェクトを作成
-    agent_request = schemas.MobilityRequest(
-        prev_event_end_time=prev_event_end_time,
-        prev_event_location=prev_event_location,
-        next_event_start_time=next_event_start_time,
-        next_event_location=next_event_location,
-        user_preferences=request.user_preferences
-    )
+
+    # 1-2. その日の予定から直前・直後のイベントを補完し、AIエージェントに渡すリクエストと、その日の予定のまとめを組み立てる
+    agent_request, day_context = await service.build_planning_request(db, request, default_next_location="特になし")
 
     # 3. MasterPlannerAgentを呼び出して、最終的なプランを生成
     try:
-        full_plan = await service.MasterPlannerAgent.generate_plans(agent_request)
-        return full_plan
+        full_plan = await service.MasterPlannerAgent.generate_plans(agent_request, day_context=day_context)
+    except (RateLimitError, DeadlineExceeded):
+        # 上流の制限・料金上限は429、期限切れは504として、アプリ共通のハンドラで返す
+        raise
     except Exception as e:
         print(f"Error in planner endpoint: {e}")
-        raise HTTPException(status_code=500, detail="Failed to generate plans.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Failed to generate plans.")
+    # 4. 後から採用できるよう、IDを付けて保存する
+    return await plan_store.save_one(db, full_plan, source="master")
+
+@router.post("/generate-day-plans", response_model=schemas.DayPlannerResponse)
+async def generate_day_plans(
+    request: schemas.DayPlannerRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    指定した日の予定の間の空き時間を全てまとめて計画します。
+
+    - 空き時間ごとに `generate-plans-from-free-time` を呼び出すより、検索とAIの呼び出しが少なく済みます。
+    - **day_start** / **day_end** を指定すると、最初の予定の前・最後の予定の後の空き時間も計画します。
+    """
+    try:
+        day_plans = await service.DayPlannerAgent.generate_day_plans(db, request)
+    except (RateLimitError, DeadlineExceeded):
+        # 上流の制限・料金上限は429、期限切れは504として、アプリ共通のハンドラで返す
+        raise
+    except Exception as e:
+        print(f"Error in day planner endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Failed to generate plans.")
+    # 空き時間ごとのプランを、それぞれ採用できるよう保存する
+    saved = await plan_store.save(db, [slot.plan for slot in day_plans.slots], source="day-planner")
+    return day_plans.model_copy(update={
+        "slots": [slot.model_copy(update={"plan": plan}) for slot, plan in zip(day_plans.slots, saved)]
+    })
+
+@router.get("/plans/{plan_id}", response_model=schemas.PlannerResponse)
+async def read_generated_plan(plan_id: str, db: AsyncSession = Depends(get_db)):
+    """保存したプランを取得します。期限（デフォルト: 24時間）を過ぎたプランは取得できません。"""
+    db_plan = await crud.get_generated_plan(db, plan_id)
+    if db_plan is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Plan not found or expired")
+    return schemas.PlannerResponse.model_validate_json(db_plan.payload)
+
+@router.post("/plans/{plan_id}/accept", response_model=List[schemas.Event], status_code=status.HTTP_201_CREATED)
+async def accept_generated_plan(
+    plan_id: str,
+    request: schemas.PlanAcceptRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    allow_overlap: Optional[bool] = Query(None, description="時間が重なる予定の登録を許可するか（未指定の場合はサーバーの設定に従う）"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    保存したプランのうち **pattern_index** 番目（0始まり）のプランの予定を、まとめて1つのトランザクションで登録します。
+
+    - 1つのプランにつき採用できるのは1回だけです（2回目以降は 409）。
+    - 重複を禁止している場合、既存の予定と時間が重なる予定が含まれていれば何も登録せずに 409 を返します。
+      許可している場合は、重なっている既存の予定のIDを `X-Event-Conflicts` ヘッダーで返します。
+    """
+    db_plan = await crud.get_generated_plan(db, plan_id)
+    if db_plan is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Plan not found or expired")
+    if db_plan.accepted_at is not None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Plan has already been accepted")
+    plans = schemas.PlannerResponse.model_validate_json(db_plan.payload).plans
+    if request.pattern_index >= len(plans):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Pattern index out of range")
+
+    events = sorted(plans[request.pattern_index].events, key=lambda e: e.start_time)
+    if any(event.start_time >= event.end_time for event in events):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Plan contains an event that ends before it starts")
+    conflicts: dict[int, models.Event] = {}
+    for event in events:
+        for conflict in await check_overlap(db, event.start_time, event.end_time, allow_overlap):
+            conflicts[conflict.id] = conflict
+    if is_overlap_enforced(allow_overlap) and any(a.end_time > b.start_time for a, b in zip(events, events[1:])):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Events in the plan overlap each other")
+
+    created_events = await crud.accept_generated_plan(db, plan_id, request.pattern_index, events)
+    if created_events is None:
+        # 確認した後に、他のリクエストで採用された
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Plan has already been accepted")
+    report_conflicts(response, sorted(conflicts.values(), key=lambda e: e.start_time))
+
+    # 予定の変更をトリガーに、必要であればプロフィールをバックグラウンドで再生成（登録した件数によらず1回）
+    background_tasks.add_task(
+        user_profile.UserProfileService.regenerate_profile_if_stale, db=db
+    )
+    return created_events
+
+
+@router.get("/personas", response_model=List[schemas.PersonaInfo])
+async def list_personas():
+    """`/planner/{persona}` で指定できる人格の一覧を返します。"""
+    personas = [persona_registry.get(name) for name in persona_registry.names()]
+    return [
+        schemas.PersonaInfo(name=p.name, description=p.description, aliases=list(p.aliases), needs_mobility=p.needs_mobility)
+        for p in personas
+    ]
+
+# 固定のパスより後に登録する（/planner/generate-day-plans などを人格名として扱わないため）
+@router.post("/{persona}", response_model=schemas.PlannerResponse)
+async def generate_persona_plans(
+    persona: str,
+    request: schemas.ConveniencePlannerRequest,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    指定した人格で、空き時間のプランを生成します。
+
+    - DBから直前・直後の予定を自動で補完します。
+    - 人格の一覧は `GET /planner/personas` で取得できます。
+    """
+    selected = persona_registry.get(persona)
+    if selected is None:
+        raise HTTPException(status_code=404, detail="Unknown persona.")
+
+    agent_request, day_context = await service.build_planning_request(
+        db, request, default_next_location=selected.default_next_location
+    )
+    try:
+        full_plan = await service.planner_pipeline.run(selected, agent_request, day_context=day_context)
+    except (RateLimitError, DeadlineExceeded):
+        # 上流の制限・料金上限は429、期限切れは504として、アプリ共通のハンドラで返す
+        raise
+    except Exception as e:
+        print(f"Error in {selected.name} planner endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Failed to generate plans.")
+    return await plan_store.save_one(db, full_plan, source=selected.name)
@@ -0,0 +1,32 @@
+# app/routers/settings.py
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .. import schemas, crud
+from ..database import get_db
+from ..timezones import resolve_timezone, timezone_settings
+
+router = APIRouter(
+    prefix="/settings",
+    tags=["Settings"],
+)
+
+@router.get("/", response_model=schemas.UserSettings)
+async def read_settings():
+    """ユーザーの設定（タイムゾーン）を取得します。"""
+    return schemas.UserSettings(timezone=timezone_settings.name)
+
+@router.put("/", response_model=schemas.UserSettings)
+async def update_settings(settings: schemas.UserSettings, db: AsyncSession = Depends(get_db)):
+    """
+    ユーザーのタイムゾーンを変更します（例: "Asia/Tokyo", "America/New_York"）。
+    タイムゾーンの付いていない日時の解釈と、日ごとの集計が新しいタイムゾーンに切り替わります。
+    """
+    try:
+        resolve_timezone(settings.timezone)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if settings.timezone != timezone_settings.name:
+        await crud.set_user_timezone(db, settings.timezone)
+    return schemas.UserSettings(timezone=timezone_settings.name)
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime, date, time
+from datetime import date
 
 from .. import schemas, crud
 from ..database import get_db
@@ -18,20 +18,17 @@ async def get_user_profile(db: AsyncSession = Depends(get_db)):
     ユーザープロフィールを取得します。
     プロフィールが古い、かつ本日新しい予定が追加/更新されている場合にのみ、プロフィールを再生成します。
     """
-    latest_profile = await crud.get_latest_user_profile(db)
+    # 最新のプロフィールと今日の予定の更新の有無は、プロセス内のキャッシュから読む（予定の変更で無効化される）
+    latest_profile = await UserProfileService.get_latest_profile(db)
     today = date.today()
 
     # プロフィールが存在し、かつ今日生成されたものであれば、それを返す
     if latest_profile and latest_profile.created_at.date() >= today:
         return latest_profile
 
-    # プロフィールが古いか、存在しない場合
-    # 今日の開始時刻（00:00:00）を取得
-    start_of_today = datetime.combine(today, time.min)
-
     # プロフィールが古い場合は、今日更新された予定があるかチェック
     if latest_profile:
-        events_updated_today = await crud.has_events_updated_since(db, since=start_of_today)
+        events_updated_today = await UserProfileService.events_updated_on(db, today)
         if not events_updated_today:
             # 今日の更新がなければ、古いプロフィールのままでOK
             return latest_profile
@@ -1,22 +1,28 @@
-from pydantic import BaseModel
-from datetime import datetime
-from typing import Optional, List
+from pydantic import AfterValidator, BaseModel, Field
+from datetime import datetime, date, time
+from typing import Annotated, Optional, List, Dict, Any, Literal
+
+from .timezones import localize
+
+# リクエストで受け取る日時。タイムゾーンが付いていなければ、ユーザーのタイムゾーンの時刻とみなす
+# （DBにはUTCで保存し、レスポンスはUTCで返す）
+LocalDatetime = Annotated[datetime, AfterValidator(localize)]
 
 # --- Event Schemas ---
 
 # 予定作成時のリクエストボディ
 class EventCreate(BaseModel):
     title: str
-    start_time: datetime
-    end_time: datetime
+    start_time: LocalDatetime
+    end_time: LocalDatetime
     location: Optional[str] = None
     description: Optional[str] = None
 
 # 予定更新時のリクエストボディ
 class EventUpdate(BaseModel):
     title: Optional[str] = None
-    start_time: Optional[datetime] = None
-    end_time: Optional[datetime] = None
+    start_time: Optional[LocalDatetime] = None
+    end_time: Optional[LocalDatetime] = None
     location: Optional[str] = None
     description: Optional[str] = None
 
@@ -35,6 +41,81 @@ class Event(BaseModel):
         from_attributes = True # ORMモデルをPydanticモデルに変換できるようにする
 
 
+# 予定の変更フィードの1件分
+class EventChange(BaseModel):
+    seq: int                    # 変更の通し番号（再開用のカーソル）
+    event_id: int
+    operation: str              # created / updated / deleted
+    data: Dict[str, Any]        # created: 予定全体, updated: 変更された項目, deleted: 空
+    created_at: datetime
+
+# 変更フィードのポーリング用レスポンス
+class EventChangeBatch(BaseModel):
+    changes: List[EventChange]
+    cursor: int                 # 次回の since に指定する値
+
+# 差分同期のレスポンス（前回の token 以降に作成・更新・削除された予定）
+class EventSyncResponse(BaseModel):
+    upserted: List[Event]       # 作成・更新された予定の最新の状態
+    deleted: List[int]          # 削除された予定のID
+    token: str                  # 次回の since に指定する値
+    has_more: bool              # True の場合は、続けて token で取得する
+
+# クライアント側で行った変更（オフライン中の変更のアップロード用）
+class EventMutation(BaseModel):
+    ref: Optional[str] = None                   # クライアント側の識別子（結果との対応付け用）
+    operation: Literal["create", "update", "delete"]
+    event_id: Optional[int] = None              # update / delete の対象
+    event: Optional[EventUpdate] = None         # create / update の内容
+    base_updated_at: Optional[LocalDatetime] = None  # クライアントが最後に見た updated_at（競合検出用）
+
+class EventMutationBatch(BaseModel):
+    mutations: List[EventMutation] = Field(..., max_length=500)
+
+class EventMutationResult(BaseModel):
+    ref: Optional[str] = None
+    status: Literal["applied", "conflict", "rejected"]
+    event_id: Optional[int] = None
+    event: Optional[Event] = None               # 適用後、または競合時のサーバー側の最新の状態
+    conflicts: List[Event] = []                 # 時間が重なっている予定（重複を禁止している場合は適用しない）
+    detail: Optional[str] = None
+
+class EventMutationBatchResult(BaseModel):
+    results: List[EventMutationResult]
+
+# 時間が重なり合っている予定のまとまり
+class EventConflictGroup(BaseModel):
+    start_time: datetime        # まとまり全体の開始
+    end_time: datetime          # まとまり全体の終了
+    max_concurrent: int         # 同時に重なっている予定の最大数
+    events: List[Event]
+
+# 予定の統計の内訳（場所・分類ごと）
+class EventStatsBreakdown(BaseModel):
+    name: str
+    event_count: int
+    minutes: float
+
+# 予定の統計の、日・週・月ごとのまとまり
+class EventStatsBucket(BaseModel):
+    start: date
+    end: date                   # この日を含む
+    event_count: int
+    busy_minutes: float
+
+# 期間内の予定の統計（日をまたぐ予定は、それぞれの日に1件として数える）
+class EventStats(BaseModel):
+    start: date
+    end: date
+    event_count: int
+    busy_minutes: float
+    hourly_minutes: List[float]                 # 0〜23時の時間帯ごとの予定の合計時間
+    locations: List[EventStatsBreakdown]        # 合計時間の長い順
+    categories: List[EventStatsBreakdown]
+    buckets: List[EventStatsBucket]             # 予定の無い日・週・月は含まない
+    version: int                                # 集計に使った日ごとの version の合計（変われば集計も変わっている）
+
+
 # --- Suggestion Schemas (大幅に強化) ---
 
 # 提案機能で利用する直前・直後の予定情報
@@ -94,12 +175,16 @@ class UserProfileResponse(BaseModel):
     class Config:
         from_attributes = True
 
+# ユーザーの設定
+class UserSettings(BaseModel):
+    timezone: str               # IANAのタイムゾーン名（例: "Asia/Tokyo"）
+
 # 移動判別エージェントへのリクエスト
 class MobilityRequest(BaseModel):
     prev_event_location: str # 前のイベントの場所
     next_event_location: str # 次のイベントの場所
-    prev_event_end_time : datetime #前のイベントの終了時刻
-    next_event_start_time: datetime # 次のイベントの開始時刻
+    prev_event_end_time : LocalDatetime #前のイベントの終了時刻
+    next_event_start_time: LocalDatetime # 次のイベントの開始時刻
     user_preferences: str # 例: 「時間はかかってもいいから安く済ませたい」「歩くのは好き」「とにかく早く着きたい」など
 
 # 移動判別エージェントからのレスポンス
@@ -110,6 +195,13 @@ class MobilityResponse(BaseModel):
     estimated_time: int        # 推定所要時間（分）
     estimated_cost: str        # 推定料金
 
+# ローカルの所要時間推定結果（Web検索の代替）
+class TravelTimeEstimate(BaseModel):
+    distance_km: Optional[float] = None   # 2地点間の直線距離
+    walk_minutes: Optional[int] = None    # 徒歩での推定所要時間（分）
+    transit_minutes: Optional[int] = None # 公共交通機関での推定所要時間（分）
+    learned_samples: int = 0              # 推定に反映した過去の移動判断の件数
+
 # 1つの行動プランは、テーマと「イベントのリスト」で構成される
 class PlanPattern(BaseModel):
     pattern_description: str        # 例: "静かなカフェで読書プラン"
@@ -119,14 +211,60 @@ class PlanPattern(BaseModel):
 class PlannerResponse(BaseModel):
     mobility_decision: MobilityResponse # 移動判断の結果
     plans: List[PlanPattern]            # 提案プランのリスト（2パターン）
+    plan_id: Optional[str] = None       # 保存したプランのID（POST /planner/plans/{plan_id}/accept で採用できる）
+
+# 保存したプランのうち、予定として登録するもの
+class PlanAcceptRequest(BaseModel):
+    pattern_index: int = Field(..., ge=0)   # plans の何番目か（0始まり）
 
 
+# プランナーの人格の情報
+class PersonaInfo(BaseModel):
+    name: str
+    description: str
+    aliases: List[str]
+    needs_mobility: bool
+
 # 新しい便利プランナーエンドポイント用のリクエストスキーマ
 # フロントの囲い込みの、直前直後のイベントの情報を取得するためのスキーマ
 class ConveniencePlannerRequest(BaseModel):
+    free_time_start: LocalDatetime
+    free_time_end: LocalDatetime
+    user_preferences: str
+
+# 1日の空き時間をまとめて計画するリクエスト
+class DayPlannerRequest(BaseModel):
+    date: date                                  # ユーザーのタイムゾーンでの日付
+    user_preferences: str
+    min_gap_minutes: int = Field(30, ge=5)      # これより短い空き時間は計画しない
+    day_start: Optional[time] = None            # 指定すると、最初の予定の前の空き時間も計画する
+    day_end: Optional[time] = None              # 指定すると、最後の予定の後の空き時間も計画する
+
+# 1つの空き時間に対するプラン
+class DayPlanSlot(BaseModel):
     free_time_start: datetime
     free_time_end: datetime
-    user_preferences: str
+    prev_event_id: Optional[int] = None
+    next_event_id: Optional[int] = None
+    plan: PlannerResponse
+
+class DayPlannerResponse(BaseModel):
+    date: date
+    slots: List[DayPlanSlot]
+
+# --- Plan Job Schemas ---
+
+# 非同期プラン生成ジョブの状態
+class PlanJob(BaseModel):
+    id: str
+    kind: str
+    status: str                               # queued / running / succeeded / failed
+    priority: int
+    result: Optional[PlannerResponse] = None  # 成功時のみ
+    error: Optional[str] = None               # 失敗時のみ
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
 
 # # --- Suggestion Schemas ---
 
@@ -3,19 +3,27 @@
 # import httpx
 import os
 import json
-import openai
-from dotenv import load_dotenv
-from tavily import TavilyClient
-from . import schemas
-from datetime import datetime
-
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
-# OpenAIクライアントを非同期で初期化
-# APIキーが.envにあれば自動で読み込まれます
-openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import schemas, crud, upstream
+from .cassettes import cassette_recorder
+from .day_context import NO_DAY_CONTEXT, DayContext, day_context_builder
+from .latency import DeadlineExceeded, within_budget
+from .llm_parsing import parse_model, parse_plans, repair_json, validate_items, parse_stats
+from .personas import Persona, persona_registry
+from .profiling import record_span
+from .plan_index import embed_contexts, is_plan_reuse_enabled, plan_index, request_context, retime_plans
+from .rate_limit import RateLimitError
+from .timezones import format_local, local_date, local_day_bounds, to_local, to_utc, user_timezone
+from .travel_time import travel_estimator
+from array import array
+from datetime import datetime, timedelta
+
+# OpenAI / Tavily のクライアントは app/clients.py で遅延生成し、
+# 呼び出しは app/upstream.py 経由でレート制限を適用して行う
 
 # class SuggestionService:
 #     @staticmethod
@@ -91,7 +99,7 @@ tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 
 #     @staticmethod
 #     async def get_suggestions(req: schemas.SuggestionRequest) -> schemas.SuggestionResponse:
-#         if not openai_client.api_key or not tavily_client.api_key:
+#         if not os.getenv("OPENAI_API_KEY") or not os.getenv("TAVILY_API_KEY"):
 #             raise ValueError("API Key is not set.")
 
 #         # 1. Tavilyで検索クエリを生成し、情報を検索
@@ -133,25 +141,94 @@ tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 #         except Exception as e:
 #             raise ConnectionError(f"OpenAI API call failed: {e}")
 
+async def build_planning_request(
+    db: AsyncSession,
+    request: schemas.ConveniencePlannerRequest,
+    default_prev_location: str = "現在地",
+    default_next_location: str = "特になし",
+) -> tuple[schemas.MobilityRequest, str]:
+    """
+    空き時間の指定から、その日の予定（1回のクエリで取得し、日ごとにキャッシュする）で直前・直後の予定を補完し、
+    エージェント用のリクエストと、プロンプト用のその日の予定のまとめを返す
+    """
+    day = local_date(request.free_time_start)
+    day_context = await day_context_builder.get(db, day)
+    prev_event = day_context.previous_event(request.free_time_start)
+    if local_date(request.free_time_end) == day:
+        next_event = day_context.next_event(request.free_time_end)
+    else:
+        # 空き時間が日をまたぐ場合は、終了する日の予定から探す
+        next_event = await crud.get_next_event(db, request.free_time_end)
+
+    # 直前・直後のイベントが見つからなければ、ユーザーが指定した空き時間をそのまま使う
+    req = schemas.MobilityRequest(
+        prev_event_end_time=prev_event.end_time if prev_event else request.free_time_start,
+        prev_event_location=(prev_event.location if prev_event else None) or default_prev_location,
+        next_event_start_time=next_event.start_time if next_event else request.free_time_end,
+        next_event_location=(next_event.location if next_event else None) or default_next_location,
+        user_preferences=request.user_preferences
+    )
+    return req, day_context.summary(req.prev_event_end_time, req.next_event_start_time)
+
+async def build_mobility_request(
+    db: AsyncSession,
+    request: schemas.ConveniencePlannerRequest,
+    default_prev_location: str = "現在地",
+    default_next_location: str = "特になし",
+) -> schemas.MobilityRequest:
+    """空き時間の指定から、DBの直前・直後の予定を補完してエージェント用のリクエストを組み立てる"""
+    req, _ = await build_planning_request(db, request, default_prev_location, default_next_location)
+    return req
+
+# 複数の空き時間をまとめて計画する際に、同じ検索を1回にまとめるためのキャッシュ
+SearchCache = dict[tuple, asyncio.Future]
+
+async def _shared_search(cache: Optional[SearchCache], key: tuple, search: Callable[[], Awaitable]):
+    """キャッシュが指定されていれば、同じキーの検索を実行中のものも含めて共有する"""
+    if cache is None:
+        return await search()
+    future = cache.get(key)
+    if future is None:
+        future = asyncio.ensure_future(search())
+        # 待っている呼び出し元がいなくなっても、失敗した検索の例外を回収する
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        cache[key] = future
+    # 1つの呼び出し元が期限切れで待つのをやめても、共有している検索は止めない
+    return await asyncio.shield(future)
+
+# 期限内に移動判断ができなかった場合の既定の所要時間（分）
+FALLBACK_TRAVEL_MINUTES = 30
+# 徒歩の方が遅くてもこの差までなら徒歩を選ぶ（分）
+FALLBACK_WALK_MARGIN_MINUTES = 10
+
 class MobilityAgent:
     @staticmethod
-    async def _search_route_info(req: schemas.MobilityRequest) -> str:
-        """Tavilyを使って、2地点間の移動に関するWeb情報を検索する"""
+    async def _search_route_info(req: schemas.MobilityRequest, search_cache: Optional[SearchCache] = None) -> str:
+        """2地点間の移動に関する情報を集める。ローカル推定で分からない場合のみTavilyでWeb検索する"""
         origin = req.prev_event_location
         destination = req.next_event_location
-        
+
+        # 地名辞書と過去の移動判断から推定できる場合は、Web検索を行わない
+        estimate = await travel_estimator.estimate(origin, destination)
+        if estimate is not None:
+            return travel_estimator.format_for_prompt(estimate)
+
         # 複数の角度から情報を集めるための検索クエリ
         queries = [
             f"{origin}から{destination}までの公共交通機関での行き方 料金と時間",
             f"{origin}から{destination}までの徒歩での時間と距離"
         ]
         
-        # Tavilyの非同期検索を実行
+        # Tavilyで各クエリを並行して検索し、URLで重複を除いてまとめる
         try:
-            # searchメソッドは非同期ではないため、asyncio.to_threadで実行するのが望ましいですが
-            # ここでは簡潔さのために直接呼び出します。
-            # 大量の並列処理が必要な場合は to_thread の使用を検討してください。
-            search_results = tavily_client.search(query="\n".join(queries), search_depth="basic", max_results=5)
+            search_results = await _shared_search(
+                search_cache,
+                ("route", origin, destination),
+                lambda: upstream.tavily_search_many(
+                    queries=queries, search_depth="basic", max_results=5,
+                    cassette_label="mobility.route_search", cassette_context={"origin": origin, "destination": destination},
+                ),
+            )
             
             if not search_results or not search_results.get('results'):
                 return "経路に関する有益なWeb情報は見つかりませんでした。"
@@ -164,6 +241,38 @@ class MobilityAgent:
             print(f"Tavily API Error: {e}")
             return "経路に関するWeb情報の検索中にエラーが発生しました。"
 
+    @staticmethod
+    async def fallback_decision(req: schemas.MobilityRequest) -> schemas.MobilityResponse:
+        """期限内に移動判断ができなかった場合に、ローカル推定（無ければ控えめな既定値）で代用する"""
+        available_minutes = int((req.next_event_start_time - req.prev_event_end_time).total_seconds() // 60)
+        estimate = await travel_estimator.estimate(req.prev_event_location, req.next_event_location)
+        if estimate is not None and estimate.walk_minutes is not None and (
+            estimate.transit_minutes is None or estimate.walk_minutes <= estimate.transit_minutes + FALLBACK_WALK_MARGIN_MINUTES
+        ):
+            use_public_transport, minutes = False, estimate.walk_minutes
+        elif estimate is not None and estimate.transit_minutes is not None:
+            use_public_transport, minutes = True, estimate.transit_minutes
+        else:
+            use_public_transport, minutes = True, min(FALLBACK_TRAVEL_MINUTES, max(available_minutes // 3, 0))
+        return schemas.MobilityResponse(
+            use_public_transport=use_public_transport,
+            recommended_mode="公共交通機関" if use_public_transport else "徒歩",
+            reasoning="時間の制約により詳しい経路の検討を省略し、" + (
+                "ローカルの推定所要時間から判断しました。" if estimate is not None else "一般的な所要時間を仮定しました。"
+            ),
+            estimated_time=minutes,
+            estimated_cost="不明",
+        )
+
+    @staticmethod
+    def _situation(req: schemas.MobilityRequest) -> str:
+        """出力の修正を依頼する際に添える、最小限の状況説明"""
+        available_minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
+        return (
+            f"出発地: {req.prev_event_location} / 目的地: {req.next_event_location} / "
+            f"移動に使える合計時間: {available_minutes:.0f}分 / ユーザーの好み: 「{req.user_preferences}」"
+        )
+
     @staticmethod
     def _create_decision_prompt(search_context: str, req: schemas.MobilityRequest) -> str:
         """Web検索の結果を基に、LLMに意思決定を促すプロンプトを作成する"""
@@ -172,21 +281,21 @@ class MobilityAgent:
         available_minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
 
         prompt = f"""
-        あなたはユーザーのパーソナルモビリティアドバイザーです。提供された「Web検索から得られた経路情報」と、ユーザーの「好み」を基に、最適な移動手段を推論してください。
+        あなたはユーザーのパーソナルモビリティアドバイザーです。提供された「経路情報」と、ユーザーの「好み」を基に、最適な移動手段を推論してください。
 
         {search_context}
 
         # ユーザーの状況
-        - 前の予定の終了時刻: {req.prev_event_end_time.strftime('%H:%M')}
+        - 前の予定の終了時刻: {to_local(req.prev_event_end_time).strftime('%H:%M')}
         - 出発地: {req.prev_event_location}
-        - 次の予定の開始時刻: {req.next_event_start_time.strftime('%H:%M')}
+        - 次の予定の開始時刻: {to_local(req.next_event_start_time).strftime('%H:%M')}
         - 目的地: {req.next_event_location}
         - 移動に使える合計時間: {available_minutes:.0f}分
         - ユーザーの好み: 「{req.user_preferences}」
 
         # あなたのタスク
         上記の全ての情報を注意深く分析し、ユーザーが「公共交通機関を使うべきか」を判断してください。
-        Web検索の情報は不正確な場合があることを念頭に置き、常識的な範囲で推論してください。
+        経路情報（Web検索やローカル推定）は不正確な場合があることを念頭に置き、常識的な範囲で推論してください。
         以下のJSON形式で、結論と理由を明確に出力してください。
 
         {{
@@ -200,287 +309,714 @@ class MobilityAgent:
         return prompt
 
     @staticmethod
-    async def decide_mobility(req: schemas.MobilityRequest) -> schemas.MobilityResponse:
+    async def decide_mobility(
+        req: schemas.MobilityRequest, search_cache: Optional[SearchCache] = None
+    ) -> schemas.MobilityResponse:
         """移動判別エージェントのメイン処理（Tavily + OpenAI版）"""
-        if not openai_client.api_key or not tavily_client.api_key:
+        # 記録済みの呼び出しを再生する場合は、APIキーが無くても動かせる
+        if not cassette_recorder.offline and (not os.getenv("OPENAI_API_KEY") or not os.getenv("TAVILY_API_KEY")):
             raise ValueError("API Key is not set.")
 
-        # 1. Tavilyで経路情報をWeb検索
-        search_context = await MobilityAgent._search_route_info(req)
+        # 1. 経路情報を収集（ローカル推定で分からなければTavilyでWeb検索）
+        search_context = await MobilityAgent._search_route_info(req, search_cache)
 
         # 2. OpenAIに渡すプロンプトを生成
         prompt = MobilityAgent._create_decision_prompt(search_context, req)
 
         # 3. OpenAI APIで推論・意思決定
         try:
-            response = await openai_client.chat.completions.create(
+            response = await upstream.chat_completion(
                 model="gpt-4o",
                 messages=[{"role": "system", "content": prompt}],
-                response_format={"type": "json_object"}
+                response_format={"type": "json_object"},
+                cassette_label="mobility.decide",
+                cassette_context=req.model_dump(mode="json"),
             )
-            content = response.choices[0].message.content
-            if not content:
-                raise ValueError("OpenAI API returned an empty response.")
-            
-            decision_data = json.loads(content)
-            return schemas.MobilityResponse(**decision_data)
-
+            # 不正な項目があれば、誤りを伝えて問い合わせ直す
+            decision = await parse_model(
+                response.choices[0].message.content,
+                schemas.MobilityResponse,
+                label="mobility.decide",
+                situation=MobilityAgent._situation(req),
+                cassette_context=req.model_dump(mode="json"),
+            )
+        except (RateLimitError, DeadlineExceeded):
+            raise
         except Exception as e:
             # エラーハンドリングを強化
             print(f"Error during OpenAI call or data parsing: {e}")
             raise ConnectionError(f"AI decision-making failed: {e}")
+
+        # 判断結果を学習行列に反映し、次回以降のローカル推定に使う
+        # 記録済みの呼び出しを再生している場合は、ローカルの状態を変えないよう反映しない
+        if cassette_recorder.offline:
+            return decision
+        try:
+            await travel_estimator.record(req.prev_event_location, req.next_event_location, decision)
+        except Exception as e:
+            print(f"Failed to record travel time: {e}")
+        return decision
         
         
-# 今多分このエージェントと上のmobilityエージェントしか使ってない状態のはず。(村重)
-class MasterPlannerAgent:
+# Web検索結果をプロセス内で再利用する時間と件数
+SEARCH_CACHE_TTL_SECONDS = 600
+SEARCH_CACHE_MAX_ENTRIES = 256
+
+# リクエストの残り時間のうち、各段階に割り当てる割合。残りはプラン生成に使う
+MOBILITY_BUDGET_SHARE = 0.3
+SEARCH_BUDGET_SHARE = 0.4
+EMBEDDING_BUDGET_SHARE = 0.1
+# 期限内に検索できなかった場合に、検索結果の代わりにプロンプトに入れる文
+SEARCH_SKIPPED_CONTEXT = "（時間の制約によりWeb検索は省略しました。移動判断と一般的な知識を基にプランを作成してください）"
+
+class PlannerPipeline:
+    """
+    人格(app/personas.py)の定義に従ってプランを生成する共通の処理。
+    移動判断 → Web検索 → プラン生成 → パースの各段階の所要時間を人格ごとに計測する。
+    """
+
+    def __init__(self):
+        # (クエリ, 検索の深さ, 件数) -> (有効期限, 検索結果)
+        self._search_cache: OrderedDict[tuple, tuple[float, asyncio.Future]] = OrderedDict()
+        # 同じ人格・同じ入力で実行中の処理
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        self._stats: dict[str, dict] = {}
+
+    def _persona_stats(self, persona: Persona) -> dict:
+        return self._stats.setdefault(
+            persona.name,
+            {"runs": 0, "failures": 0, "search_cache_hits": 0, "plan_reuse_hits": 0, "degraded": {}, "stages": {}},
+        )
+
+    def _record_degraded(self, persona: Persona, stage: str) -> None:
+        degraded = self._persona_stats(persona)["degraded"]
+        degraded[stage] = degraded.get(stage, 0) + 1
+
+    def _record_stage(self, persona: Persona, stage: str, started: float) -> None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        stage_stats = self._persona_stats(persona)["stages"].setdefault(stage, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        stage_stats["count"] += 1
+        stage_stats["total_ms"] += elapsed_ms
+        stage_stats["max_ms"] = max(stage_stats["max_ms"], elapsed_ms)
+        record_span(f"planner:{stage}", elapsed_ms / 1000)
+
+    def snapshot(self) -> dict:
+        """人格ごとの実行回数と、段階ごとの平均・最大の所要時間"""
+        return {
+            name: {
+                "runs": stats["runs"],
+                "failures": stats["failures"],
+                "search_cache_hits": stats["search_cache_hits"],
+                "plan_reuse_hits": stats["plan_reuse_hits"],
+                "degraded": dict(stats["degraded"]),
+                "stages": {
+                    stage: {
+                        "count": s["count"],
+                        "avg_ms": round(s["total_ms"] / s["count"], 1),
+                        "max_ms": round(s["max_ms"], 1),
+                    }
+                    for stage, s in stats["stages"].items()
+                },
+            }
+            for name, stats in self._stats.items()
+        }
+
     @staticmethod
-    def _create_tavily_query_for_plans(req: schemas.MobilityRequest, mobility_decision: schemas.MobilityResponse) -> str:
-        """プラン生成のために、移動判断に基づいた検索クエリを作成する"""
-        
+    def _base_values(req: schemas.MobilityRequest) -> dict[str, str]:
+        available_minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
+        return {
+            "origin": req.prev_event_location,
+            "destination": req.next_event_location,
+            "prev_end_time": format_local(req.prev_event_end_time),
+            "next_start_time": format_local(req.next_event_start_time),
+            "preferences": req.user_preferences,
+            "available_minutes": f"{available_minutes:.0f}",
+        }
+
+    @staticmethod
+    def _mobility_values(req: schemas.MobilityRequest, mobility_decision: schemas.MobilityResponse) -> dict[str, str]:
         # 移動に使える合計時間から、推奨移動モードでの移動時間を引いた時間が、純粋な活動時間
         net_activity_minutes = ((req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60) - mobility_decision.estimated_time
-        
-        if net_activity_minutes < 15: # 活動時間が短すぎる場合
-             return f"{req.prev_event_location}で15分以内にできること"
-
         if mobility_decision.use_public_transport:
             # 公共交通機関を使う場合、出発地・目的地・またはその沿線で探す
-            return f"{req.prev_event_location}から{req.next_event_location}の間、またはその周辺で{net_activity_minutes:.0f}分で楽しめること"
+            search_area = f"{req.prev_event_location}から{req.next_event_location}の間、またはその周辺"
         else:
             # 徒歩などの場合、出発地のすぐ近くで探す
-            return f"{req.prev_event_location}周辺で{net_activity_minutes:.0f}分で楽しめること"
+            search_area = f"{req.prev_event_location}周辺"
+        return {
+            "mobility_reasoning": mobility_decision.reasoning,
+            "mobility_mode": mobility_decision.recommended_mode,
+            "mobility_minutes": str(mobility_decision.estimated_time),
+            "net_activity_minutes": f"{net_activity_minutes:.0f}",
+            "search_area": search_area,
+        }
 
     @staticmethod
-    def _create_final_planning_prompt(
-        req: schemas.MobilityRequest,
-        mobility_decision: schemas.MobilityResponse,
-        search_context: str
-    ) -> str:
-        prompt = f"""
-        あなたは、ユーザーの状況を深く理解し、最高の体験を提案するエキスパート・プランナーです。
-        以下のすべての情報を分析し、ユーザーに2つの異なる魅力的な行動プランを提案してください。
-        各プランは、移動やアクティビティを含む一連の「イベントの集合」として構成してください。
-
-        # ユーザーの基本情報
-        - 出発地: {req.prev_event_location}
-        - 前の予定の終了時刻: {req.prev_event_end_time.strftime('%Y-%m-%dT%H:%M:%SZ')}
-        - 目的地: {req.next_event_location}
-        - 次の予定の開始時刻: {req.next_event_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}
-        - ユーザーの好み: 「{req.user_preferences}」
+    def _situation(values: dict[str, str], mobility_decision: schemas.MobilityResponse) -> str:
+        """プランの追加を依頼する際に添える、最小限の状況説明"""
+        return "\n".join([
+            f"- 出発地: {values['origin']}（{values['prev_end_time']} 以降）",
+            f"- 目的地: {values['destination']}（{values['next_start_time']} まで）",
+            f"- ユーザーの好み: 「{values['preferences']}」",
+            f"- 移動手段: {mobility_decision.recommended_mode}（約{mobility_decision.estimated_time}分）",
+            "- 前の予定の終了から次の予定の開始まで、すべての時間が埋まるようにすること",
+        ])
 
-        # あなたが行った移動判断
-        {mobility_decision.reasoning}
-        推奨する移動手段は「{mobility_decision.recommended_mode}」で、所要時間は約{mobility_decision.estimated_time}分です。
+    @staticmethod
+    def _render_query(persona: Persona, values: dict[str, str]) -> str:
+        if persona.short_query_template is not None and float(values.get("net_activity_minutes", "inf")) < 15:
+            # 活動時間が短すぎる場合
+            return persona.short_query_template.render(values)
+        return persona.query_template.render(values)
+
+    async def _search(self, persona: Persona, query: str, cassette_context: dict) -> str:
+        """Web検索の結果をプロンプト用に整形して返す。同じ検索は実行中のものも含めて一定時間再利用する"""
+        started = time.perf_counter()
+        key = (query, persona.search_depth, persona.max_results)
+        now = time.monotonic()
+        cached = self._search_cache.get(key)
+        if cached is not None and cached[0] > now:
+            self._persona_stats(persona)["search_cache_hits"] += 1
+            future = cached[1]
+        else:
+            future = asyncio.ensure_future(upstream.tavily_search(
+                query=query, search_depth=persona.search_depth, max_results=persona.max_results,
+                cassette_label=f"persona.{persona.name}.search", cassette_context=cassette_context,
+            ))
+            future.add_done_callback(lambda done: self._discard_failed_search(key, done))
+            self._search_cache[key] = (now + SEARCH_CACHE_TTL_SECONDS, future)
+            self._search_cache.move_to_end(key)
+            while len(self._search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+                self._search_cache.popitem(last=False)
+        try:
+            # 期限切れで待つのをやめても、他の呼び出し元と共有している検索は止めない
+            search_result = await asyncio.shield(future)
+        finally:
+            self._record_stage(persona, "search", started)
+        return "\n".join([f"- {res['content']}" for res in search_result['results']])
+
+    def _discard_failed_search(self, key: tuple, future: asyncio.Future) -> None:
+        # 失敗した検索はキャッシュしない（待っている呼び出し元がいなくなっていても例外を回収する）
+        if future.cancelled() or future.exception() is not None:
+            if self._search_cache.get(key, (None, None))[1] is future:
+                del self._search_cache[key]
+
+    async def embed_contexts(self, persona: Persona, contexts: list[str]) -> list[Optional[array]]:
+        """
+        類似プランの検索に使うベクトル。再利用が無効な場合や取得に失敗した場合は None
+        （その場合は通常どおりプランを生成する）
+        """
+        if not is_plan_reuse_enabled() or not contexts:
+            return [None] * len(contexts)
+        started = time.perf_counter()
+        try:
+            return await within_budget(embed_contexts(contexts), EMBEDDING_BUDGET_SHARE)
+        except Exception as e:
+            print(f"Embedding for plan reuse failed: {e}")
+            return [None] * len(contexts)
+        finally:
+            self._record_stage(persona, "embedding", started)
+
+    async def find_similar_plans(
+        self, persona: Persona, vector: Optional[array], req: schemas.MobilityRequest,
+        mobility_decision: Optional[schemas.MobilityResponse], day_context: Optional[str] = None,
+    ) -> Optional[schemas.PlannerResponse]:
+        """
+        似た条件で生成済みのプランがあれば、時刻を新しい空き時間に合わせて返す。
+        day_context を渡した場合は、その日の他の予定のまとめが同じプランだけを再利用する
+        """
+        if vector is None:
+            return None
+        match = await plan_index.lookup(persona.name, vector, req, mobility_decision, day_context)
+        if match is None:
+            return None
+        self._persona_stats(persona)["plan_reuse_hits"] += 1
+        return schemas.PlannerResponse(
+            mobility_decision=mobility_decision or schemas.MobilityResponse.model_validate(match.entry["mobility_decision"]),
+            plans=retime_plans(match.entry, req),
+        )
 
-        # Web検索から得られた参考情報
-        {search_context}
+    async def save_plans(
+        self, persona: Persona, vector: Optional[array], req: schemas.MobilityRequest, context: str,
+        response: schemas.PlannerResponse, day_context: Optional[str] = None,
+    ) -> None:
+        """生成したプランを再利用できるよう保存する。プランが不足している場合は保存しない"""
+        if vector is None or len(response.plans) < persona.plan_count:
+            return
+        try:
+            await plan_index.add(persona.name, vector, req, context, response, day_context)
+        except Exception as e:
+            print(f"Failed to save plans for reuse: {e}")
 
-        # あなたの最終タスク
-        上記の情報を基に、ユーザーの好みを満たす、創造的で具体的な行動プランを2パターン生成してください。
-        各プランは、以下の要素からなるイベントのリストで構成されます。
-        1. 【移動】前の予定の場所からアクティビティの場所への移動
-        2. 【アクティビティ】メインの活動
-        3. 【移動】アクティビティの場所から次の予定の場所への移動
+    async def run(
+        self, persona: Persona, req: schemas.MobilityRequest,
+        mobility_decision: Optional[schemas.MobilityResponse] = None,
+        day_context: Optional[str] = None,
+    ) -> schemas.PlannerResponse:
+        """
+        プランを生成する。同じ人格・同じ入力の処理が実行中であれば、その結果を共有する。
+        day_context はその日の予定のまとめ（app/day_context.py）で、プロンプトで使う人格にだけ渡す
+        """
+        if "day_context" not in persona.prompt_template.fields:
+            day_context = None
+        key = (
+            persona.name,
+            req.model_dump_json(),
+            mobility_decision.model_dump_json() if mobility_decision else None,
+            day_context,
+        )
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(persona, req, mobility_decision, day_context))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _run(
+        self, persona: Persona, req: schemas.MobilityRequest,
+        mobility_decision: Optional[schemas.MobilityResponse],
+        day_context: Optional[str] = None,
+    ) -> schemas.PlannerResponse:
+        stats = self._persona_stats(persona)
+        stats["runs"] += 1
+        started = time.perf_counter()
+        try:
+            # 0. 似た条件（その日の他の予定も同じ）で生成済みのプランがあれば、OpenAIに問い合わせずに再利用する
+            context = request_context(req)
+            vector = (await self.embed_contexts(persona, [context]))[0]
+            reused = await self.find_similar_plans(persona, vector, req, mobility_decision, day_context)
+            if reused is not None:
+                return reused
+
+            values = self._base_values(req)
+            values["day_context"] = day_context or NO_DAY_CONTEXT
+            cassette_context = {"request": req.model_dump(mode="json")}
+            if day_context is not None:
+                cassette_context["day_context"] = day_context
+
+            # 1. 移動手段を決定し、プランのアイデアをWeb検索する
+            #    検索クエリが移動判断の結果を使わない人格は、両方を並行して行う
+            if mobility_decision is None and persona.needs_mobility:
+                if persona.search_depends_on_mobility:
+                    mobility_decision = await self._decide_mobility(persona, req)
+                    values.update(self._mobility_values(req, mobility_decision))
+                    cassette_context["mobility"] = mobility_decision.model_dump(mode="json")
+                    search_context = await self._search_within_budget(persona, self._render_query(persona, values), cassette_context)
+                else:
+                    mobility_decision, search_context = await asyncio.gather(
+                        self._decide_mobility(persona, req),
+                        self._search_within_budget(persona, self._render_query(persona, values), cassette_context),
+                    )
+                    values.update(self._mobility_values(req, mobility_decision))
+                    cassette_context["mobility"] = mobility_decision.model_dump(mode="json")
+            else:
+                mobility_decision = mobility_decision or persona.fixed_mobility
+                if persona.needs_mobility:
+                    values.update(self._mobility_values(req, mobility_decision))
+                    cassette_context["mobility"] = mobility_decision.model_dump(mode="json")
+                search_context = await self._search_within_budget(persona, self._render_query(persona, values), cassette_context)
+
+            # 2. 全ての情報を統合し、最終的なプラン生成をAIに指示する
+            values["search_context"] = search_context
+            final_prompt = persona.prompt_template.render(values)
+            llm_started = time.perf_counter()
+            response = await upstream.chat_completion(
+                model="gpt-4o",
+                messages=[{"role": "system", "content": final_prompt}],
+                response_format={"type": "json_object"},
+                cassette_label=f"persona.{persona.name}.plans",
+                cassette_context=cassette_context,
+            )
+            self._record_stage(persona, "llm", llm_started)
+
+            # 3. レスポンスをパースする。不正なプランだけを捨て、不足分は小さなプロンプトで問い合わせ直す
+            parse_started = time.perf_counter()
+            plans = await parse_plans(
+                response.choices[0].message.content,
+                label=f"persona.{persona.name}.plans",
+                expected=persona.plan_count,
+                situation=self._situation(values, mobility_decision),
+                cassette_context=cassette_context,
+            )
+            self._record_stage(persona, "parse", parse_started)
+            response = schemas.PlannerResponse(mobility_decision=mobility_decision, plans=plans)
+            # Web検索を省略して作ったプランは、再利用の対象にしない
+            if search_context != SEARCH_SKIPPED_CONTEXT:
+                await self.save_plans(persona, vector, req, context, response, day_context)
+            return response
+        except BaseException:
+            stats["failures"] += 1
+            raise
+        finally:
+            self._record_stage(persona, "total", started)
+
+    async def _decide_mobility(self, persona: Persona, req: schemas.MobilityRequest) -> schemas.MobilityResponse:
+        """移動判断には残り時間の一部だけを使い、間に合わなければローカル推定で代用する"""
+        started = time.perf_counter()
+        try:
+            return await within_budget(MobilityAgent.decide_mobility(req), MOBILITY_BUDGET_SHARE)
+        except DeadlineExceeded as e:
+            print(f"Mobility decision for {persona.name} skipped: {e}")
+            self._record_degraded(persona, "mobility")
+            return await MobilityAgent.fallback_decision(req)
+        finally:
+            self._record_stage(persona, "mobility", started)
+
+    async def _search_within_budget(self, persona: Persona, query: str, cassette_context: dict) -> str:
+        """Web検索には残り時間の一部だけを使い、間に合わなければ検索なしでプランを作る"""
+        try:
+            return await within_budget(self._search(persona, query, cassette_context), SEARCH_BUDGET_SHARE)
+        except DeadlineExceeded as e:
+            print(f"Web search for {persona.name} skipped: {e}")
+            self._record_degraded(persona, "search")
+            return SEARCH_SKIPPED_CONTEXT
 
-        時間計算は厳密に行ってください。前の予定の終了から次の予定の開始まですべての時間が埋まるように、イベントのstart_timeとend_timeを正確に設定してください。
-        必ず、以下のJSON形式で、2つのプランのリストとして出力してください。
+# アプリケーション全体で共有するパイプライン（検索結果のキャッシュと計測値を保持する）
+planner_pipeline = PlannerPipeline()
 
-        {{
-          "plans": [
-            {{
-              "pattern_description": "プラン1のテーマ（例：静かなカフェで読書プラン）",
-              "events": [
-                {{
-                  "title": "移動：{req.prev_event_location}からアクティビティ場所へ",
-                  "start_time": "{req.prev_event_end_time.strftime('%Y-%m-%dT%H:%M:%SZ')}",
-                  "end_time": "...",
-                  "location": "{req.prev_event_location}",
-                  "description": "移動手段：{mobility_decision.recommended_mode}"
-                }},
-                {{
-                  "title": "アクティビティのタイトル",
-                  "start_time": "...",
-                  "end_time": "...",
-                  "location": "アクティビティの具体的な場所",
-                  "description": "アクティビティの具体的な内容"
-                }},
-                {{
-                  "title": "移動：アクティビティ場所から{req.next_event_location}へ",
-                  "start_time": "...",
-                  "end_time": "{req.next_event_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}",
-                  "location": "アクティビティの場所",
-                  "description": "移動手段：..."
-                }}
-              ]
-            }},
-            {{
-              "pattern_description": "プラン2のテーマ（例：話題の雑貨屋巡りプラン）",
-              "events": [
-                {{
-                  "title": "移動：...",
-                  "start_time": "...",
-                  "end_time": "...",
-                  "location": "...",
-                  "description": "..."
-                }},
-                {{
-                  "title": "...",
-                  "start_time": "...",
-                  "end_time": "...",
-                  "location": "...",
-                  "description": "..."
-                }},
-                {{
-                  "title": "移動：...",
-                  "start_time": "...",
-                  "end_time": "...",
-                  "location": "...",
-                  "description": "..."
-                }}
-              ]
-            }}
-          ]
-        }}
-        """
-        return prompt
+# 今多分このエージェントと上のmobilityエージェントしか使ってない状態のはず。(村重)
+# プロンプトなどの定義は app/personas.py の "master" に移動し、処理は PlannerPipeline で共通化した
+class MasterPlannerAgent:
+    @staticmethod
+    async def generate_plans(req: schemas.MobilityRequest, day_context: Optional[str] = None) -> schemas.PlannerResponse:
+        return await planner_pipeline.run(persona_registry.get("master"), req, day_context=day_context)
 
     @staticmethod
-    async def generate_plans(req: schemas.MobilityRequest) -> schemas.PlannerResponse:
-        # 1. まず移動手段を決定する
-        mobility_decision = await MobilityAgent.decide_mobility(req)
+    async def generate_plans_with_decision(
+        req: schemas.MobilityRequest, mobility_decision: schemas.MobilityResponse, day_context: Optional[str] = None
+    ) -> schemas.PlannerResponse:
+        return await planner_pipeline.run(
+            persona_registry.get("master"), req, mobility_decision=mobility_decision, day_context=day_context
+        )
 
-        # 2. 移動判断に基づき、プランのアイデアをWeb検索する
-        tavily_query = MasterPlannerAgent._create_tavily_query_for_plans(req, mobility_decision)
-        search_result = tavily_client.search(query=tavily_query, search_depth="advanced", max_results=7)
-        search_context = "\n".join([f"- {res['content']}" for res in search_result['results']])
+class DayPlannerAgent:
+    """
+    1日の空き時間をまとめて計画するエージェント。
+    移動判断は空き時間ごとに並行して行い、同じ場所の検索は共有し、
+    プラン生成は全ての空き時間を1回のOpenAI呼び出しでまとめて行う。
+    """
 
-        # 3. 全ての情報を統合し、最終的なプラン生成をAIに指示する
-        final_prompt = MasterPlannerAgent._create_final_planning_prompt(req, mobility_decision, search_context)
-        
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": final_prompt}],
-            response_format={"type": "json_object"}
-        )
-        
-        content = response.choices[0].message.content
-        if not content:
-            raise ValueError("AI Planner returned an empty response.")
-        
-        plans_data = json.loads(content)
-        
-        # 新しいPlanPatternスキーマを使ってレスポンスを構築する
-        return schemas.PlannerResponse(
-            mobility_decision=mobility_decision,
-            plans=[schemas.PlanPattern(**plan) for plan in plans_data.get('plans', [])]
-        )
+    @staticmethod
+    def find_free_slots(
+        events: list, day_start: datetime, day_end: datetime, min_gap_minutes: int,
+        include_leading: bool, include_trailing: bool
+    ) -> list[tuple[datetime, datetime, Optional[object], Optional[object]]]:
+        """予定の間の空き時間を (開始, 終了, 直前の予定, 直後の予定) のリストで返す"""
+        slots = []
+        min_gap = timedelta(minutes=min_gap_minutes)
+        prev_event = None
+        cursor = day_start
+        # 重なっている予定は、最も遅く終わるものを直前の予定とみなす
+        for event in sorted(events, key=lambda e: e.start_time):
+            gap_start = max(cursor, day_start)
+            gap_end = min(event.start_time, day_end)
+            if gap_end - gap_start >= min_gap and (prev_event is not None or include_leading):
+                slots.append((gap_start, gap_end, prev_event, event))
+            if prev_event is None or event.end_time > cursor:
+                cursor = event.end_time
+                prev_event = event
+        if include_trailing and day_end - max(cursor, day_start) >= min_gap:
+            slots.append((max(cursor, day_start), day_end, prev_event, None))
+        return slots
 
-# app/services.py に以下の新しいクラスを追記
+    @staticmethod
+    def _plan_search_locations(req: schemas.MobilityRequest, mobility_decision: schemas.MobilityResponse) -> list[str]:
+        # 公共交通機関で移動する場合は、出発地と目的地の両方の周辺を候補にする
+        locations = [req.prev_event_location]
+        if mobility_decision.use_public_transport and req.next_event_location not in ("特になし", req.prev_event_location):
+            locations.append(req.next_event_location)
+        return locations
 
-class MasculineAgent:
     @staticmethod
-    def _create_tavily_query(req: schemas.MobilityRequest) -> str:
-        """トライアスリート向けのトレーニング場所を検索するクエリを生成する"""
-        
-        # available_minutes = (req.next_event_start_time - req.prev_event_end_time).total_seconds() / 60
-        origin = req.prev_event_location
-        destination = req.next_event_location
+    async def _search_location(location: str, user_preferences: str, search_cache: SearchCache) -> str:
+        async def search() -> str:
+            try:
+                result = await upstream.tavily_search(
+                    query=f"{location}周辺で楽しめること おすすめ {user_preferences}", search_depth="advanced", max_results=7,
+                    cassette_label="day_planner.search",
+                    cassette_context={"location": location, "user_preferences": user_preferences},
+                )
+            except (RateLimitError, DeadlineExceeded):
+                raise
+            except Exception as e:
+                print(f"Tavily API Error: {e}")
+                return "検索中にエラーが発生しました。"
+            return "\n".join([f"- {res['content']}" for res in result.get('results', [])])
+
+        return await _shared_search(search_cache, ("plans", location), search)
 
-        # クエリをより具体的に
-        return f"{origin}と{destination}の間にある、またはその周辺の、ランニングコース、オープンウォータースイミングができる場所、登山・トレイルランニングができる山。ジムや公共のトレーニング施設も含む。体を鍛えることができる場所であれば基本的にどこでも良い。"
+    @staticmethod
+    async def _decide_mobility(req: schemas.MobilityRequest, search_cache: SearchCache) -> schemas.MobilityResponse:
+        try:
+            return await within_budget(MobilityAgent.decide_mobility(req, search_cache), MOBILITY_BUDGET_SHARE)
+        except DeadlineExceeded as e:
+            print(f"Mobility decision skipped: {e}")
+            return await MobilityAgent.fallback_decision(req)
 
     @staticmethod
-    def _create_final_planning_prompt(req: schemas.MobilityRequest, search_context: str) -> str:
-        """超ストイックなトレーニングプランの生成を指示する最終プロンプトを作成する"""
-        
-        prompt = f"""
-        あなたは、トライアスロン世界大会優勝を目指すアスリートを指導する、鬼コーチです。
-        これから、選手の空き時間を使った、極限まで追い込むトレーニングプランを2つ立案してください。
+    async def _decide_mobility_for_slots(
+        reqs: list[schemas.MobilityRequest], search_cache: SearchCache
+    ) -> list[schemas.MobilityResponse]:
+        """空き時間ごとの移動判断を並行して行う。失敗した空き時間だけを、ローカル推定による判断で代用する"""
+        outcomes = await asyncio.gather(
+            *[DayPlannerAgent._decide_mobility(req, search_cache) for req in reqs], return_exceptions=True
+        )
+        decisions = []
+        for req, outcome in zip(reqs, outcomes):
+            if isinstance(outcome, BaseException):
+                # キャンセルなどは、他の空き時間の結果を待たずにそのまま伝える
+                if not isinstance(outcome, Exception):
+                    raise outcome
+                print(f"Mobility decision failed for {req.prev_event_location} -> {req.next_event_location}: {outcome}")
+                outcome = await MobilityAgent.fallback_decision(req)
+            decisions.append(outcome)
+        return decisions
+
+    @staticmethod
+    async def _search_location_within_budget(location: str, user_preferences: str, search_cache: SearchCache) -> str:
+        try:
+            return await within_budget(
+                DayPlannerAgent._search_location(location, user_preferences, search_cache), SEARCH_BUDGET_SHARE
+            )
+        except DeadlineExceeded as e:
+            print(f"Tavily search skipped: {e}")
+            return SEARCH_SKIPPED_CONTEXT
 
-        # 選手の状況
-        - 前の予定の終了時刻: {req.prev_event_end_time.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    @staticmethod
+    def _create_batch_planning_prompt(
+        slots: dict[int, tuple[schemas.MobilityRequest, schemas.MobilityResponse, list[str]]],
+        location_contexts: dict[str, str],
+        user_preferences: str,
+    ) -> str:
+        slot_sections = []
+        for slot_id, (req, decision, locations) in slots.items():
+            slot_sections.append(f"""
+        ## 空き時間 {slot_id}
         - 出発地: {req.prev_event_location}
-        - 次の予定の開始時刻: {req.next_event_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        - 前の予定の終了時刻: {format_local(req.prev_event_end_time)}
         - 目的地: {req.next_event_location}
-        - 選手の好み・目標: 「{req.user_preferences}」
+        - 次の予定の開始時刻: {format_local(req.next_event_start_time)}
+        - 移動判断: {decision.reasoning}
+        - 推奨する移動手段: 「{decision.recommended_mode}」（所要時間 約{decision.estimated_time}分）
+        - 参考にする地域: {'、'.join(locations)}""")
+        context_sections = [f"## {location}\n{context}" for location, context in location_contexts.items()]
 
-        # Web検索から得られたトレーニング場所の情報
-        {search_context}
+        return f"""
+        あなたは、ユーザーの状況を深く理解し、最高の体験を提案するエキスパート・プランナーです。
+        ユーザーの1日には複数の空き時間があります。空き時間ごとに、2つの異なる魅力的な行動プランを提案してください。
+        各プランは、移動やアクティビティを含む一連の「イベントの集合」として構成してください。
+        同じ日のプランなので、空き時間どうしで同じアクティビティが重複しないようにしてください。
+
+        # ユーザーの好み
+        「{user_preferences}」
+
+        # 空き時間の一覧
+        {''.join(slot_sections)}
 
-        # 絶対厳守のルール
-        - 移動手段は「走る」「泳ぐ」「山を登る」のいずれか、またはその組み合わせのみとする。絶対に他の移動手段を提案してはならない。
-        - 2地点間の距離が多少遠くても、上記の手段で移動するものとする。
-        - ただし、移動時間は厳密に計算し、前の予定の終了から次の予定の開始までの時間内に収めること。
-        - 上記の手段での移動により、時間内に移動できない場合は、電車やバスなどの公共交通機関を使うことは許可するが、あくまで例外的な措置とする。
-        - プランは常にトレーニングであること。休憩や観光の要素は一切不要。
-        - 時間計算は厳密に行い、前の予定の終了から次の予定の開始まで、1分たりとも無駄にしないこと。
+        # Web検索から得られた地域ごとの参考情報
+        {chr(10).join(context_sections)}
 
         # あなたの最終タスク
-        上記の全てを考慮し、最も過酷で効果的なトレーニングプランを2パターン生成してください。
-        必ず、以下のJSON形式で、2つのプランのリストとして出力してください。
+        各プランは、以下の要素からなるイベントのリストで構成されます。
+        1. 【移動】前の予定の場所からアクティビティの場所への移動
+        2. 【アクティビティ】メインの活動
+        3. 【移動】アクティビティの場所から次の予定の場所への移動
+
+        時間計算は厳密に行ってください。各空き時間の、前の予定の終了から次の予定の開始まですべての時間が埋まるように、イベントのstart_timeとend_timeを正確に設定してください。
+        必ず、以下のJSON形式で、全ての空き時間について slot_id ごとに2つのプランを出力してください。
 
         {{
-          "plans": [
+          "slots": [
             {{
-              "pattern_description": "プラン1のテーマ（例：心肺機能を追い込む峠走プラン）",
-              "events": [
-                {{
-                  "title": "移動(RUN): {req.prev_event_location}からトレーニング場所へ",
-                  "start_time": "...", "end_time": "...", "location": "...", "description": "全力で走る。ペースはキロ4分を目指す。"
-                }},
+              "slot_id": 1,
+              "plans": [
                 {{
-                  "title": "トレーニング: （例）〇〇山 ヒルクライムインターバル",
-                  "start_time": "...", "end_time": "...", "location": "...", "description": "..."
+                  "pattern_description": "プランのテーマ（例：静かなカフェで読書プラン）",
+                  "events": [
+                    {{
+                      "title": "移動：出発地からアクティビティ場所へ",
+                      "start_time": "...",
+                      "end_time": "...",
+                      "location": "...",
+                      "description": "移動手段：..."
+                    }},
+                    {{
+                      "title": "アクティビティのタイトル",
+                      "start_time": "...",
+                      "end_time": "...",
+                      "location": "アクティビティの具体的な場所",
+                      "description": "アクティビティの具体的な内容"
+                    }},
+                    {{
+                      "title": "移動：アクティビティ場所から目的地へ",
+                      "start_time": "...",
+                      "end_time": "...",
+                      "location": "...",
+                      "description": "移動手段：..."
+                    }}
+                  ]
                 }},
-                {{
-                  "title": "移動(RUN): トレーニング場所から{req.next_event_location}へ",
-                  "start_time": "...", "end_time": "...", "location": "...", "description": "クールダウンを兼ねてジョグで移動。"
-                }}
+                {{ "pattern_description": "...", "events": [ ... ] }}
               ]
-            }},
-            {{
-              "pattern_description": "プラン2のテーマ（例：実戦想定ブリックトレーニング）",
-              "events": [ ... ]
             }}
           ]
         }}
         """
-        return prompt
 
     @staticmethod
-    async def generate_plans(req: schemas.MobilityRequest) -> schemas.PlannerResponse:
-        """MasculineAgentのメイン処理"""
-        
-        # 1. トレーニング場所のアイデアをWeb検索
-        tavily_query = MasculineAgent._create_tavily_query(req)
-        search_result = tavily_client.search(query=tavily_query, search_depth="advanced", max_results=7)
-        search_context = "\n".join([f"- {res['content']}" for res in search_result['results']])
+    async def generate_day_plans(db: AsyncSession, request: schemas.DayPlannerRequest) -> schemas.DayPlannerResponse:
+        # 日付・時刻はユーザーのタイムゾーンで解釈し、予定との比較はUTCで行う
+        tz = user_timezone()
+        day_begin, day_finish = local_day_bounds(request.date, tz)
+        day_start = to_utc(datetime.combine(request.date, request.day_start, tzinfo=tz)) if request.day_start else day_begin
+        day_end = to_utc(datetime.combine(request.date, request.day_end, tzinfo=tz)) if request.day_end else day_finish
+
+        # 1. その日の予定を1回のクエリで取得し、空き時間と前後の予定を求める
+        events = list(await crud.get_events_by_period(db, start=day_begin, end=day_finish))
+        free_slots = DayPlannerAgent.find_free_slots(
+            events, day_start, day_end, request.min_gap_minutes,
+            include_leading=request.day_start is not None, include_trailing=request.day_end is not None,
+        )
+        if not free_slots:
+            return schemas.DayPlannerResponse(date=request.date, slots=[])
+        day_context = DayContext.from_events(request.date, events)
+
+        mobility_requests = [
+            schemas.MobilityRequest(
+                prev_event_end_time=start,
+                prev_event_location=(prev_event.location if prev_event else None) or "現在地",
+                next_event_start_time=end,
+                next_event_location=(next_event.location if next_event else None) or "特になし",
+                user_preferences=request.user_preferences,
+            )
+            for start, end, prev_event, next_event in free_slots
+        ]
 
-        # 2. 最終的なプラン生成をAIに指示
-        final_prompt = MasculineAgent._create_final_planning_prompt(req, search_context)
-        
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": final_prompt}],
-            response_format={"type": "json_object"}
+        # 2. 移動判断を並行して行う（同じ区間の経路検索は共有する）
+        search_cache: SearchCache = {}
+        decisions = await DayPlannerAgent._decide_mobility_for_slots(mobility_requests, search_cache)
+
+        # 3. 似た条件（その日の他の予定も同じ）で生成済みのプランがある空き時間は、それを再利用する
+        #    ベクトルは好みの文だけから作るため、全ての空き時間で1つを共有する
+        master = persona_registry.get("master")
+        reuse_context = request_context(mobility_requests[0])
+        vector = (await planner_pipeline.embed_contexts(master, [reuse_context]))[0]
+        slot_summaries = [day_context.summary(req.prev_event_end_time, req.next_event_start_time) for req in mobility_requests]
+        reused_by_slot: dict[int, schemas.PlannerResponse] = {}
+        for slot_id, (req, decision) in enumerate(zip(mobility_requests, decisions), start=1):
+            reused = await planner_pipeline.find_similar_plans(master, vector, req, decision, slot_summaries[slot_id - 1])
+            if reused is not None:
+                reused_by_slot[slot_id] = reused
+
+        # 4. 残りの空き時間は、場所ごとの検索とプラン生成をまとめて行う
+        slot_inputs = {
+            slot_id: (req, decision, DayPlannerAgent._plan_search_locations(req, decision))
+            for slot_id, (req, decision) in enumerate(zip(mobility_requests, decisions), start=1)
+            if slot_id not in reused_by_slot
+        }
+        plans_by_slot: dict[int, list[schemas.PlanPattern]] = {}
+        degraded_slots: set[int] = set()
+        if slot_inputs:
+            plans_by_slot, degraded_slots = await DayPlannerAgent._generate_batch_plans(
+                slot_inputs, request.user_preferences, search_cache
+            )
+
+        # 5. 空き時間ごとの PlannerResponse に分割する。回答から漏れた空き時間は個別に生成し直す
+        async def plans_for_slot(slot_id: int, req: schemas.MobilityRequest, decision: schemas.MobilityResponse) -> schemas.PlannerResponse:
+            if slot_id in reused_by_slot:
+                return reused_by_slot[slot_id]
+            plans = plans_by_slot.get(slot_id)
+            if plans:
+                response = schemas.PlannerResponse(mobility_decision=decision, plans=plans)
+                if slot_id not in degraded_slots:
+                    await planner_pipeline.save_plans(master, vector, req, reuse_context, response, slot_summaries[slot_id - 1])
+                return response
+            return await MasterPlannerAgent.generate_plans_with_decision(req, decision, day_context=slot_summaries[slot_id - 1])
+
+        planner_responses = await asyncio.gather(
+            *[
+                plans_for_slot(slot_id, req, decision)
+                for slot_id, (req, decision) in enumerate(zip(mobility_requests, decisions), start=1)
+            ]
         )
-        
-        content = response.choices[0].message.content
-        if not content:
-            raise ValueError("AI Planner returned an empty response.")
-        
-        plans_data = json.loads(content)
-        
-        # MobilityAgentを使わないので、ダミーの判断結果を生成してレスポンスの型を合わせる
-        dummy_mobility_decision = schemas.MobilityResponse(
-            use_public_transport=False,
-            recommended_mode="己の肉体",
-            reasoning="アスリートに文明の利器は不要。移動は全てトレーニングの一環である。",
-            estimated_time=0, # 時間はプラン内で計算
-            estimated_cost="0円"
+        return schemas.DayPlannerResponse(
+            date=request.date,
+            slots=[
+                schemas.DayPlanSlot(
+                    free_time_start=start,
+                    free_time_end=end,
+                    prev_event_id=prev_event.id if prev_event else None,
+                    next_event_id=next_event.id if next_event else None,
+                    plan=plan,
+                )
+                for (start, end, prev_event, next_event), plan in zip(free_slots, planner_responses)
+            ],
         )
-        
-        return schemas.PlannerResponse(
-            mobility_decision=dummy_mobility_decision,
-            plans=[schemas.PlanPattern(**plan) for plan in plans_data.get('plans', [])]
-        )
\ No newline at end of file
+
+    @staticmethod
+    async def _generate_batch_plans(
+        slot_inputs: dict[int, tuple[schemas.MobilityRequest, schemas.MobilityResponse, list[str]]],
+        user_preferences: str,
+        search_cache: SearchCache,
+    ) -> tuple[dict[int, list[schemas.PlanPattern]], set[int]]:
+        """
+        (空き時間ID -> 有効なプラン, Web検索を省略した空き時間のID) を返す。
+        回答に含まれなかった空き時間はプランの辞書に含まない
+        """
+        # プラン用の検索は場所ごとに1回だけ行う
+        locations = list(dict.fromkeys(location for _, _, slot_locations in slot_inputs.values() for location in slot_locations))
+        contexts = await asyncio.gather(
+            *[
+                DayPlannerAgent._search_location_within_budget(location, user_preferences, search_cache)
+                for location in locations
+            ]
+        )
+        location_contexts = dict(zip(locations, contexts))
+        degraded_slots = {
+            slot_id for slot_id, (_, _, slot_locations) in slot_inputs.items()
+            if any(location_contexts[location] == SEARCH_SKIPPED_CONTEXT for location in slot_locations)
+        }
+
+        # 空き時間のプランを1回の呼び出しでまとめて生成する
+        prompt = DayPlannerAgent._create_batch_planning_prompt(slot_inputs, location_contexts, user_preferences)
+        response = await upstream.chat_completion(
+            model="gpt-4o",
+            messages=[{"role": "system", "content": prompt}],
+            response_format={"type": "json_object"},
+            cassette_label="day_planner.plans",
+            cassette_context={
+                "slots": [
+                    {"request": req.model_dump(mode="json"), "mobility": decision.model_dump(mode="json")}
+                    for req, decision, _ in slot_inputs.values()
+                ],
+            },
+        )
+        # 不正なプランは捨て、有効なプランが無い空き時間は下で個別に生成し直す
+        label = "day_planner.plans"
+        parse_stats.record(label, "responses")
+        try:
+            slots_data = repair_json(response.choices[0].message.content)
+        except ValueError as e:
+            print(f"Invalid batch planning response: {e}")
+            parse_stats.record(label, "unparseable")
+            slots_data = {}
+        plans_by_slot: dict[int, list[schemas.PlanPattern]] = {}
+        for slot_data in (slots_data.get("slots", []) if isinstance(slots_data, dict) else []):
+            try:
+                slot_id = int(slot_data["slot_id"])
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Invalid slot in batch planning response: {e}")
+                continue
+            valid, invalid = validate_items(slot_data.get("plans", []), schemas.PlanPattern)
+            parse_stats.record(label, "items_valid", len(valid))
+            parse_stats.record(label, "items_dropped", len(invalid))
+            plans_by_slot[slot_id] = valid
+
+        return plans_by_slot, degraded_slots
+
+# プロンプトなどの定義は app/personas.py の "masculine" に移動し、処理は PlannerPipeline で共通化した
+class MasculineAgent:
+    @staticmethod
+    async def generate_plans(req: schemas.MobilityRequest) -> schemas.PlannerResponse:
+        """MasculineAgentのメイン処理"""
+        return await planner_pipeline.run(persona_registry.get("masculine"), req)
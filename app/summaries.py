@@ -0,0 +1,191 @@
+# app/summaries.py
+
+import json
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, Sequence
+from zoneinfo import ZoneInfo
+
+from . import schemas
+from .timezones import local_day_bounds, to_local
+
+# 予定のタイトル・説明に含まれる語から分類を決める（上から順に最初に一致したもの）
+CATEGORY_KEYWORDS: list[tuple[str, tuple[str, ...]]] = [
+    ("移動", ("移動", "通勤", "出張")),
+    ("食事", ("ランチ", "ディナー", "朝食", "昼食", "夕食", "食事", "飲み会", "カフェ")),
+    ("仕事", ("会議", "ミーティング", "打ち合わせ", "MTG", "商談", "面談", "面接", "仕事", "作業")),
+    ("学習", ("授業", "講義", "勉強", "ゼミ", "研修", "試験", "セミナー")),
+    ("運動", ("ジム", "ランニング", "ヨガ", "トレーニング", "散歩", "サッカー", "テニス", "筋トレ")),
+]
+DEFAULT_CATEGORY = "その他"
+NO_LOCATION = "指定なし"
+
+GRANULARITIES = ("day", "week", "month")
+
+
+def categorize(title: Optional[str], description: Optional[str] = None) -> str:
+    text = f"{title or ''} {description or ''}".upper()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(keyword.upper() in text for keyword in keywords):
+            return category
+    return DEFAULT_CATEGORY
+
+
+@dataclass
+class DayTotals:
+    """1日分の集計値。秒単位の整数で持ち、差分の加算・減算で誤差が出ないようにする"""
+    event_count: int = 0
+    busy_seconds: int = 0
+    hourly_seconds: list[int] = field(default_factory=lambda: [0] * 24)
+    # 名前 -> [件数, 秒数]
+    locations: dict[str, list[int]] = field(default_factory=dict)
+    categories: dict[str, list[int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_row(cls, row) -> "DayTotals":
+        return cls(
+            event_count=row.event_count,
+            busy_seconds=row.busy_seconds,
+            hourly_seconds=json.loads(row.hourly_seconds),
+            locations=json.loads(row.locations),
+            categories=json.loads(row.categories),
+        )
+
+    def write_to(self, row) -> None:
+        row.event_count = self.event_count
+        row.busy_seconds = self.busy_seconds
+        row.hourly_seconds = json.dumps(self.hourly_seconds)
+        row.locations = json.dumps(self.locations, ensure_ascii=False)
+        row.categories = json.dumps(self.categories, ensure_ascii=False)
+
+    def add(self, other: "DayTotals", sign: int = 1) -> None:
+        self.event_count += sign * other.event_count
+        self.busy_seconds += sign * other.busy_seconds
+        for hour, seconds in enumerate(other.hourly_seconds):
+            self.hourly_seconds[hour] += sign * seconds
+        for target, source in ((self.locations, other.locations), (self.categories, other.categories)):
+            for name, (count, seconds) in source.items():
+                entry = target.setdefault(name, [0, 0])
+                entry[0] += sign * count
+                entry[1] += sign * seconds
+                # 予定が無くなった項目は残さない
+                if entry[0] <= 0:
+                    del target[name]
+
+
+@dataclass(frozen=True)
+class EventFacts:
+    """集計に使う予定の項目（更新前後の差分を取るために値として保持する）"""
+    start_time: datetime
+    end_time: datetime
+    title: Optional[str]
+    location: Optional[str]
+    description: Optional[str]
+
+    @classmethod
+    def of(cls, event) -> "EventFacts":
+        return cls(event.start_time, event.end_time, event.title, event.location, event.description)
+
+
+def event_totals(facts: EventFacts, tz: ZoneInfo) -> dict[date, DayTotals]:
+    """
+    予定がユーザーのタイムゾーンでの各日・各時間帯に占める時間を求める。
+    日をまたぐ予定は日ごとに分けて、それぞれの日に1件として数える。
+    """
+    totals: dict[date, DayTotals] = {}
+    if facts.end_time <= facts.start_time:
+        return totals
+    location = facts.location or NO_LOCATION
+    category = categorize(facts.title, facts.description)
+    day = to_local(facts.start_time, tz).date()
+    while True:
+        # 時刻の計算はUTCで行う（夏時間の切り替わりで1日が23・25時間になる場合も正しく扱う）
+        day_start, next_day = local_day_bounds(day, tz)
+        start = max(facts.start_time, day_start)
+        end = min(facts.end_time, next_day)
+        if start >= end:
+            break
+        day_totals = DayTotals(event_count=1)
+        hour_start = to_local(start, tz).replace(minute=0, second=0, microsecond=0).astimezone(timezone.utc)
+        while hour_start < end:
+            hour_end = hour_start + timedelta(hours=1)
+            seconds = int((min(end, hour_end) - max(start, hour_start)).total_seconds())
+            day_totals.hourly_seconds[to_local(hour_start, tz).hour] += seconds
+            hour_start = hour_end
+        day_totals.busy_seconds = sum(day_totals.hourly_seconds)
+        day_totals.locations[location] = [1, day_totals.busy_seconds]
+        day_totals.categories[category] = [1, day_totals.busy_seconds]
+        totals[day] = day_totals
+        if end >= facts.end_time:
+            break
+        day += timedelta(days=1)
+    return totals
+
+
+def _bucket_start(day: date, granularity: str) -> date:
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+
+def _bucket_end(bucket_start: date, granularity: str) -> date:
+    if granularity == "week":
+        return bucket_start + timedelta(days=6)
+    if granularity == "month":
+        next_month = (bucket_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return next_month - timedelta(days=1)
+    return bucket_start
+
+
+def _minutes(seconds: int) -> float:
+    return round(seconds / 60, 1)
+
+
+def _breakdown(entries: dict[str, list[int]]) -> list[schemas.EventStatsBreakdown]:
+    return [
+        schemas.EventStatsBreakdown(name=name, event_count=count, minutes=_minutes(seconds))
+        for name, (count, seconds) in sorted(entries.items(), key=lambda item: (-item[1][1], item[0]))
+    ]
+
+
+def aggregate(rows: Sequence, start: date, end: date, granularity: str = "day") -> schemas.EventStats:
+    """日ごとの集計行(DailySummary)を期間全体と、日・週・月ごとのまとまりに集計する"""
+    total = DayTotals()
+    buckets: dict[date, list[int]] = {}
+    version = 0
+    for row in rows:
+        day_totals = DayTotals.from_row(row)
+        total.add(day_totals)
+        version += row.version
+        if day_totals.event_count == 0:
+            continue
+        bucket = buckets.setdefault(_bucket_start(row.day, granularity), [0, 0])
+        bucket[0] += day_totals.event_count
+        bucket[1] += day_totals.busy_seconds
+    return schemas.EventStats(
+        start=start,
+        end=end,
+        event_count=total.event_count,
+        busy_minutes=_minutes(total.busy_seconds),
+        hourly_minutes=[_minutes(seconds) for seconds in total.hourly_seconds],
+        locations=_breakdown(total.locations),
+        categories=_breakdown(total.categories),
+        buckets=[
+            schemas.EventStatsBucket(
+                start=max(bucket_start, start),
+                end=min(_bucket_end(bucket_start, granularity), end),
+                event_count=count,
+                busy_minutes=_minutes(seconds),
+            )
+            for bucket_start, (count, seconds) in sorted(buckets.items())
+        ],
+        version=version,
+    )
+
+
+def accumulate(merged: dict[date, DayTotals], event, tz: ZoneInfo) -> None:
+    """予定1件分を日ごとの集計値に加える（集計表の作り直し用）"""
+    for day, day_totals in event_totals(EventFacts.of(event), tz).items():
+        merged.setdefault(day, DayTotals()).add(day_totals)
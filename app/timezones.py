@@ -0,0 +1,102 @@
+# app/timezones.py
+
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# ユーザーのタイムゾーンが未設定の場合の既定値（DEFAULT_TIMEZONE で変更できる）
+DEFAULT_TIMEZONE = "Asia/Tokyo"
+# 他のワーカーで変更されたタイムゾーンの設定を読み直す間隔（秒）
+SETTINGS_REFRESH_SECONDS = 30
+
+
+@lru_cache(maxsize=64)
+def resolve_timezone(name: str) -> ZoneInfo:
+    """IANAのタイムゾーン名（例: "Asia/Tokyo"）を解決する。不正な名前は ValueError"""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Unknown timezone: {name}") from e
+
+
+class TimezoneSettings:
+    """
+    ユーザーのタイムゾーンの設定。DB(user_settings)の値をプロセス内に保持し、一定間隔で読み直す。
+    タイムゾーンの付いていない日時の解釈と、日ごとの集計・予定の日付の計算に使う。
+    """
+
+    def __init__(self):
+        self._name: Optional[str] = None
+        self._loaded_at = 0.0
+
+    @property
+    def name(self) -> str:
+        return self._name or os.getenv("DEFAULT_TIMEZONE", DEFAULT_TIMEZONE)
+
+    @property
+    def zone(self) -> ZoneInfo:
+        return resolve_timezone(self.name)
+
+    def set(self, name: str) -> None:
+        resolve_timezone(name)
+        self._name = name
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self, force: bool = False) -> None:
+        if not force and time.monotonic() - self._loaded_at < SETTINGS_REFRESH_SECONDS:
+            return
+        from . import crud
+        from .database import AsyncSessionLocal
+
+        async with AsyncSessionLocal() as db:
+            name = await crud.get_user_timezone_name(db)
+        self._name = name
+        self._loaded_at = time.monotonic()
+
+
+# アプリケーション全体で共有する設定
+timezone_settings = TimezoneSettings()
+
+
+def user_timezone() -> ZoneInfo:
+    return timezone_settings.zone
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def localize(value: datetime) -> datetime:
+    """タイムゾーンの付いていない日時を、ユーザーのタイムゾーンの時刻とみなす"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=user_timezone())
+    return value
+
+
+def to_utc(value: datetime) -> datetime:
+    return localize(value).astimezone(timezone.utc)
+
+
+def to_local(value: datetime, tz: Optional[ZoneInfo] = None) -> datetime:
+    return localize(value).astimezone(tz or user_timezone())
+
+
+def local_date(value: datetime, tz: Optional[ZoneInfo] = None) -> date:
+    """ユーザーのタイムゾーンでの日付"""
+    return to_local(value, tz).date()
+
+
+def local_day_bounds(day: date, tz: Optional[ZoneInfo] = None) -> tuple[datetime, datetime]:
+    """ユーザーのタイムゾーンでのその日の [開始, 終了) をUTCで返す（夏時間で23・25時間になる日も正しく扱う）"""
+    tz = tz or user_timezone()
+    start = datetime.combine(day, datetime.min.time(), tzinfo=tz)
+    end = datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+
+
+def format_local(value: datetime, tz: Optional[ZoneInfo] = None) -> str:
+    """プロンプト用に、ユーザーのタイムゾーンの時刻をオフセット付きで整形する（例: 2025-01-01T10:00:00+09:00）"""
+    return to_local(value, tz).isoformat(timespec="seconds")
@@ -0,0 +1,279 @@
+# app/travel_time.py
+
+import os
+import json
+import math
+import asyncio
+import unicodedata
+from typing import Optional, Tuple, Dict
+
+from . import schemas
+from .coordination import coordination_store, is_shared_coordination_enabled
+
+# 同梱のサンプル地名辞書。TRAVEL_GAZETTEER_PATH で差し替え可能
+DEFAULT_GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), "data", "gazetteer.json")
+DEFAULT_TRAVEL_MATRIX_PATH = "./travel_matrix.json"
+
+# 推定に使う係数
+ROUTE_DETOUR_FACTOR = 1.3       # 直線距離 → 実際の道のりへの補正
+WALK_SPEED_KMH = 4.8            # 徒歩の平均速度
+TRANSIT_SPEED_KMH = 25.0        # 乗換込みの公共交通機関の平均速度
+TRANSIT_OVERHEAD_MINUTES = 10   # 駅までの徒歩・待ち時間
+TRANSIT_MIN_DISTANCE_KM = 1.0   # これより近い場合は公共交通機関を候補にしない
+LEARNED_EMA_ALPHA = 0.3         # 学習済み所要時間の指数移動平均の重み
+
+# 地名の末尾に付いていても同じ場所とみなす接尾辞（「渋谷駅」「東京都」→「渋谷」「東京」）
+PLACE_SUFFIXES = ("駅", "都", "府", "区")
+# 部分一致に使う地名の最短の長さ（これより短い別名は完全一致でのみ使う）
+MIN_PARTIAL_MATCH_LENGTH = 2
+# 部分一致した地名の直後に続いてよい語（「京都駅前のカフェ」「渋谷周辺」など）。これ以外が続く場合は別の地名とみなす
+PLACE_FOLLOWERS = ("駅", "前", "の", "周辺", "付近", "近く", "辺り", "エリア", "方面")
+# 地名の区切りとみなす記号（空白は正規化で取り除かれる）
+PLACE_SEPARATORS = "・,、/()（）「」[]@→"
+
+Coordinate = Tuple[float, float]
+
+
+def normalize_place_name(name: str) -> str:
+    """地名の表記ゆれ（全角/半角・空白・大文字小文字）を吸収したキーを返す"""
+    normalized = unicodedata.normalize("NFKC", name or "")
+    return "".join(normalized.split()).lower()
+
+
+def haversine_km(a: Coordinate, b: Coordinate) -> float:
+    """2点間の大円距離(km)を計算する"""
+    lat1, lon1 = map(math.radians, a)
+    lat2, lon2 = map(math.radians, b)
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+
+class Gazetteer:
+    """地名を座標に変換するためのインターフェース"""
+
+    def lookup(self, name: str) -> Optional[Coordinate]:
+        raise NotImplementedError
+
+
+class JsonFileGazetteer(Gazetteer):
+    """
+    ローカルのJSONファイルから地名辞書を読み込むGazetteer。
+    ファイル形式: {"places": [{"name": "京都駅", "aliases": ["Kyoto Station"], "lat": 34.98, "lon": 135.75}]}
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        # パスが未指定の場合は、初回読み込み時に環境変数から解決する
+        self.path = path
+        self._places: Optional[Dict[str, Coordinate]] = None
+        # 部分一致用に、長い名前から順に並べたキー
+        self._keys_by_length: list[str] = []
+
+    def _load(self) -> Dict[str, Coordinate]:
+        if self._places is not None:
+            return self._places
+
+        if self.path is None:
+            self.path = os.getenv("TRAVEL_GAZETTEER_PATH", DEFAULT_GAZETTEER_PATH)
+
+        places: Dict[str, Coordinate] = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            for place in data.get("places", []):
+                coordinate = (float(place["lat"]), float(place["lon"]))
+                for name in [place["name"], *place.get("aliases", [])]:
+                    key = normalize_place_name(name)
+                    if key:
+                        places[key] = coordinate
+        except FileNotFoundError:
+            print(f"Gazetteer file not found: {self.path}")
+        except (ValueError, KeyError) as e:
+            print(f"Failed to load gazetteer {self.path}: {e}")
+
+        self._places = places
+        self._keys_by_length = sorted(places, key=len, reverse=True)
+        return places
+
+    def lookup(self, name: str) -> Optional[Coordinate]:
+        places = self._load()
+        key = normalize_place_name(name)
+        if not key:
+            return None
+        exact = self._lookup_exact(places, key)
+        if exact is not None:
+            return exact
+        # 「京都駅前のカフェ」のような表記は、区切りで始まり区切りで終わる地名で代用する。
+        # 「東京都庁」の「京都」のように、別の地名の一部にしか一致しない場合は使わない
+        matches = {
+            places[candidate] for candidate in self._keys_by_length
+            if len(candidate) >= MIN_PARTIAL_MATCH_LENGTH and self._contains_place(key, candidate)
+        }
+        # 複数の場所に一致する場合（「渋谷・新宿」など）は、どちらとも決められないため推定しない
+        return matches.pop() if len(matches) == 1 else None
+
+    @staticmethod
+    def _lookup_exact(places: Dict[str, Coordinate], key: str) -> Optional[Coordinate]:
+        """完全一致か、接尾辞（駅・都・府・区）の有無だけが違う地名"""
+        if key in places:
+            return places[key]
+        for suffix in PLACE_SUFFIXES:
+            if key.endswith(suffix) and key[:-len(suffix)] in places:
+                return places[key[:-len(suffix)]]
+        return places.get(f"{key}駅")
+
+    @staticmethod
+    def _contains_place(key: str, candidate: str) -> bool:
+        start = key.find(candidate)
+        while start != -1:
+            end = start + len(candidate)
+            starts_at_boundary = start == 0 or key[start - 1] in PLACE_SEPARATORS
+            rest = key[end:]
+            ends_at_boundary = not rest or rest[0] in PLACE_SEPARATORS or rest.startswith(PLACE_FOLLOWERS)
+            if starts_at_boundary and ends_at_boundary:
+                return True
+            start = key.find(candidate, start + 1)
+        return False
+
+
+class LearnedTravelMatrix:
+    """
+    過去の移動判断(MobilityResponse.estimated_time)から学習した所要時間の行列。
+    複数ワーカー運用時(COORDINATION_BACKEND=sqlite)は、共有ストアに保存する。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._matrix: Optional[Dict[str, dict]] = None
+        # ファイルへの書き出しを1つずつ行う（一時ファイルを共有するため）
+        self._write_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(origin: str, destination: str, use_public_transport: bool) -> str:
+        mode = "transit" if use_public_transport else "walk"
+        return f"{normalize_place_name(origin)}|{normalize_place_name(destination)}|{mode}"
+
+    def _load(self) -> Dict[str, dict]:
+        if self._matrix is None:
+            if self.path is None:
+                self.path = os.getenv("TRAVEL_MATRIX_PATH", DEFAULT_TRAVEL_MATRIX_PATH)
+            self._matrix = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        self._matrix = json.load(f)
+                except ValueError as e:
+                    print(f"Failed to load travel matrix {self.path}: {e}")
+        return self._matrix
+
+    def _write(self, content: str) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _updated_entry(entry: Optional[dict], minutes: int) -> dict:
+        if entry is None:
+            return {"minutes": float(minutes), "count": 1}
+        return {
+            "minutes": (1 - LEARNED_EMA_ALPHA) * entry["minutes"] + LEARNED_EMA_ALPHA * minutes,
+            "count": entry["count"] + 1,
+        }
+
+    async def get(self, origin: str, destination: str, use_public_transport: bool) -> Optional[dict]:
+        key = self._key(origin, destination, use_public_transport)
+        if is_shared_coordination_enabled():
+            # 共有ストアの読み書きはファイルロックを待つことがあるため、イベントループの外で行う
+            return await asyncio.to_thread(coordination_store.get_json, f"travel:{key}")
+        if self._matrix is None:
+            await asyncio.to_thread(self._load)
+        return self._load().get(key)
+
+    async def record(self, origin: str, destination: str, use_public_transport: bool, minutes: int) -> None:
+        key = self._key(origin, destination, use_public_transport)
+        if is_shared_coordination_enabled():
+            await asyncio.to_thread(
+                coordination_store.update_json, f"travel:{key}", lambda entry: self._updated_entry(entry, minutes)
+            )
+            return
+
+        if self._matrix is None:
+            await asyncio.to_thread(self._load)
+        matrix = self._load()
+        matrix[key] = self._updated_entry(matrix.get(key), minutes)
+        if not self.path:
+            return
+        try:
+            async with self._write_lock:
+                # 書き込み中に行列が変わらないよう、文字列にしてからファイルに書き出す
+                content = json.dumps(matrix, ensure_ascii=False)
+                await asyncio.to_thread(self._write, content)
+        except OSError as e:
+            print(f"Failed to save travel matrix: {e}")
+
+
+class TravelTimeEstimator:
+    """Web検索を使わずに、2地点間の所要時間をローカルで推定する"""
+
+    def __init__(self, gazetteer: Gazetteer, learned: LearnedTravelMatrix):
+        self.gazetteer = gazetteer
+        self.learned = learned
+
+    async def estimate(self, origin: str, destination: str) -> Optional[schemas.TravelTimeEstimate]:
+        """推定できるデータが無い場合はNoneを返す"""
+        learned_walk = await self.learned.get(origin, destination, use_public_transport=False)
+        learned_transit = await self.learned.get(origin, destination, use_public_transport=True)
+
+        origin_coord = self.gazetteer.lookup(origin)
+        destination_coord = self.gazetteer.lookup(destination)
+
+        distance_km = walk_minutes = transit_minutes = None
+        if origin_coord and destination_coord:
+            distance_km = haversine_km(origin_coord, destination_coord)
+            route_km = distance_km * ROUTE_DETOUR_FACTOR
+            walk_minutes = round(route_km / WALK_SPEED_KMH * 60)
+            if distance_km >= TRANSIT_MIN_DISTANCE_KM:
+                transit_minutes = round(TRANSIT_OVERHEAD_MINUTES + route_km / TRANSIT_SPEED_KMH * 60)
+
+        if learned_walk:
+            walk_minutes = round(learned_walk["minutes"])
+        if learned_transit:
+            transit_minutes = round(learned_transit["minutes"])
+
+        if walk_minutes is None and transit_minutes is None:
+            return None
+
+        return schemas.TravelTimeEstimate(
+            distance_km=round(distance_km, 2) if distance_km is not None else None,
+            walk_minutes=walk_minutes,
+            transit_minutes=transit_minutes,
+            learned_samples=(learned_walk or {}).get("count", 0) + (learned_transit or {}).get("count", 0),
+        )
+
+    async def record(self, origin: str, destination: str, decision: schemas.MobilityResponse) -> None:
+        """移動判断の結果を学習行列に反映する"""
+        if decision.estimated_time <= 0:
+            return
+        await self.learned.record(origin, destination, decision.use_public_transport, decision.estimated_time)
+
+    @staticmethod
+    def format_for_prompt(estimate: schemas.TravelTimeEstimate) -> str:
+        """LLMへのプロンプト用に推定結果を整形する"""
+        lines = ["# ローカル推定による経路情報"]
+        if estimate.distance_km is not None:
+            lines.append(f"- 直線距離: 約{estimate.distance_km:.1f}km")
+        if estimate.walk_minutes is not None:
+            lines.append(f"- 徒歩の所要時間: 約{estimate.walk_minutes}分")
+        if estimate.transit_minutes is not None:
+            lines.append(f"- 公共交通機関の所要時間: 約{estimate.transit_minutes}分（駅までの移動・待ち時間込み）")
+        elif estimate.distance_km is not None and estimate.distance_km < TRANSIT_MIN_DISTANCE_KM:
+            # 座標が分からず距離を計算できなかった場合は、公共交通機関を候補から外さない
+            lines.append("- 公共交通機関: 距離が近いため候補外")
+        if estimate.learned_samples:
+            lines.append(f"- 過去の移動判断 {estimate.learned_samples}件 の実績を反映済み")
+        return "\n".join(lines)
+
+
+# アプリケーション全体で共有する推定器
+# 地名辞書・学習行列は初回の推定時に遅延読み込みされる
+travel_estimator = TravelTimeEstimator(gazetteer=JsonFileGazetteer(), learned=LearnedTravelMatrix())
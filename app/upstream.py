@@ -0,0 +1,173 @@
+# app/upstream.py
+
+import os
+import asyncio
+from typing import Any, Optional
+
+from .cassettes import cassette_recorder
+from .clients import get_openai_client, get_tavily_client
+from .latency import latency_tracker, remaining, within_budget
+from .profiling import span
+from .rate_limit import (
+    upstream_limiter, estimate_chat_cost_usd, estimate_prompt_tokens, openai_cost_usd, parse_reset_duration,
+    TAVILY_CREDITS, TAVILY_CREDIT_USD, DEFAULT_QUEUE_TIMEOUT_SECONDS
+)
+
+
+def _latency_key(upstream: str, cassette_label: Optional[str]) -> str:
+    # 所要時間は呼び出し元ごとに大きく違うため、ヘッジの判断は呼び出し元（カセットのラベル）ごとに行う
+    return f"{upstream}:{cassette_label}" if cassette_label else upstream
+
+
+def _queue_timeout() -> Optional[float]:
+    """リクエストに期限がある場合は、リミッターの空きを待つ時間も期限までに制限する"""
+    left = remaining()
+    if left is None:
+        return None
+    return min(max(left, 0.0), float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT_SECONDS)))
+
+
+async def chat_completion(
+    *, model: str, messages: list[dict], cassette_label: Optional[str] = None, cassette_context: Any = None, **kwargs: Any
+):
+    """
+    レート制限と料金上限を適用してOpenAIのChat Completionsを呼び出す。
+    cassette_label / cassette_context は記録・再生(app/cassettes.py)で、呼び出し元と入力を識別するために使う。
+    """
+    from openai.types.chat import ChatCompletion
+
+    with span(f"openai:{model}"):
+        return await cassette_recorder.call(
+            "openai.chat",
+            # タイムアウトなどの通信設定は、記録のキーに含めない
+            {"model": model, "messages": messages, **{k: v for k, v in kwargs.items() if k != "timeout"}},
+            # 遅い呼び出しはヘッジし、リクエストの期限を超えたら打ち切る
+            lambda: within_budget(latency_tracker.hedged(
+                _latency_key(f"openai:{model}", cassette_label),
+                lambda: _chat_completion(model=model, messages=messages, **kwargs),
+            )),
+            encode=lambda completion: completion.model_dump(mode="json"),
+            decode=ChatCompletion.model_validate,
+            label=cassette_label,
+            context=cassette_context,
+        )
+
+
+async def _chat_completion(*, model: str, messages: list[dict], **kwargs: Any):
+    import openai
+
+    client = get_openai_client()
+    slot = await upstream_limiter.acquire(
+        "openai", model, estimated_tokens=estimate_prompt_tokens(messages),
+        estimated_usd=estimate_chat_cost_usd(model, messages), timeout=_queue_timeout(),
+    )
+    try:
+        raw_response = await client.chat.completions.with_raw_response.create(
+            model=model, messages=messages, **kwargs
+        )
+    except openai.RateLimitError as e:
+        raise await slot.upstream_rate_limited(parse_reset_duration(e.response.headers.get("retry-after")))
+
+    # レスポンスヘッダーの残量に合わせてリミッターを補正し、実際の消費量を計上する
+    await slot.observe_headers(raw_response.headers)
+    completion = raw_response.parse()
+    if completion.usage:
+        await slot.record_usage(completion.usage.prompt_tokens, completion.usage.completion_tokens)
+    return completion
+
+
+async def embeddings(
+    *, model: str, texts: list[str], dimensions: Optional[int] = None,
+    cassette_label: Optional[str] = None, cassette_context: Any = None
+) -> list[list[float]]:
+    """レート制限と料金上限を適用してOpenAIのEmbeddingsを呼び出し、texts と同じ順のベクトルを返す"""
+    kwargs: dict[str, Any] = {"dimensions": dimensions} if dimensions else {}
+    with span(f"openai:{model}"):
+        return await cassette_recorder.call(
+            "openai.embeddings",
+            {"model": model, "input": texts, **kwargs},
+            lambda: within_budget(latency_tracker.hedged(
+                _latency_key(f"openai:{model}", cassette_label),
+                lambda: _embeddings(model=model, texts=texts, **kwargs),
+            )),
+            label=cassette_label,
+            context=cassette_context,
+        )
+
+
+async def _embeddings(*, model: str, texts: list[str], **kwargs: Any) -> list[list[float]]:
+    import openai
+
+    client = get_openai_client()
+    estimated_tokens = sum(len(text) for text in texts)
+    slot = await upstream_limiter.acquire(
+        "openai", model, estimated_tokens=estimated_tokens,
+        estimated_usd=openai_cost_usd(model, estimated_tokens, 0), timeout=_queue_timeout(),
+    )
+    try:
+        raw_response = await client.embeddings.with_raw_response.create(model=model, input=texts, **kwargs)
+    except openai.RateLimitError as e:
+        raise await slot.upstream_rate_limited(parse_reset_duration(e.response.headers.get("retry-after")))
+
+    await slot.observe_headers(raw_response.headers)
+    response = raw_response.parse()
+    await slot.record_usage(response.usage.prompt_tokens, 0)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+async def tavily_search(
+    *, query: str, search_depth: str = "basic", max_results: int = 5,
+    cassette_label: Optional[str] = None, cassette_context: Any = None
+) -> dict:
+    """レート制限と料金上限を適用してTavilyで検索する"""
+    with span(f"tavily:{search_depth}"):
+        return await cassette_recorder.call(
+            "tavily.search",
+            {"query": query, "search_depth": search_depth, "max_results": max_results},
+            lambda: within_budget(latency_tracker.hedged(
+                _latency_key(f"tavily:{search_depth}", cassette_label),
+                lambda: _tavily_search(query=query, search_depth=search_depth, max_results=max_results),
+            )),
+            label=cassette_label,
+            context=cassette_context,
+        )
+
+
+async def tavily_search_many(
+    *, queries: list[str], search_depth: str = "basic", max_results: int = 5,
+    cassette_label: Optional[str] = None, cassette_context: Any = None
+) -> dict:
+    """
+    複数のクエリを並行して検索し、URLで重複を除いてスコアの高い順にまとめる。
+    一部のクエリが失敗しても、残りの結果を返す（全て失敗した場合は最初の例外を送出する）
+    """
+    from .agent.search_improved import merge_responses
+
+    outcomes = await asyncio.gather(*(
+        tavily_search(
+            query=query, search_depth=search_depth, max_results=max_results, cassette_label=cassette_label,
+            # 同じ呼び出し元の複数のクエリを、記録・再生で区別する
+            cassette_context={"context": cassette_context, "query_index": index},
+        )
+        for index, query in enumerate(queries)
+    ), return_exceptions=True)
+    responses = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+    if not responses:
+        raise next(outcome for outcome in outcomes if isinstance(outcome, BaseException))
+    return merge_responses(responses, limit=max_results)
+
+
+async def _tavily_search(*, query: str, search_depth: str, max_results: int) -> dict:
+    from .agent.search_improved import SearchRateLimitError
+
+    client = get_tavily_client()
+    credits = TAVILY_CREDITS.get(search_depth, 1)
+    slot = await upstream_limiter.acquire(
+        "tavily", "search", estimated_usd=credits * TAVILY_CREDIT_USD, timeout=_queue_timeout()
+    )
+    try:
+        result = await client.search(query, search_depth=search_depth, max_results=max_results)
+    except SearchRateLimitError as e:
+        raise await slot.upstream_rate_limited(parse_reset_duration(e.retry_after))
+    await slot.record_credits(credits)
+    return result
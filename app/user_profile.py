@@ -1,17 +1,21 @@
 import os
-import httpx
-import json
-from dotenv import load_dotenv
 from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, date
-from typing import Sequence
+from typing import Optional, Sequence
 
-from . import crud, models, schemas
+from . import crud, models, schemas, upstream
+from .cassettes import cassette_recorder
+from .coordination import coordination_store
+from .latency import deadline_scope
+from .llm_parsing import repair_json
+from .profile_cache import profile_cache
+from .timezones import local_day_bounds
 
-load_dotenv()
+# 環境変数はアプリケーション起動時(lifespan)に app/clients.py で読み込まれる
+# OpenAIの呼び出しは app/upstream.py 経由で行う（レート制限・記録/再生を共通化するため）
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+# 残しておく過去のプロフィールの件数（USER_PROFILE_RETENTION で変更できる）
+DEFAULT_PROFILE_RETENTION = 10
 
 class UserProfileService:
     @staticmethod
@@ -72,7 +76,8 @@ class UserProfileService:
     @staticmethod
     async def generate_profile(db: AsyncSession) -> models.UserProfile:
         """最近の予定からユーザープロフィールを生成する"""
-        if not OPENAI_API_KEY:
+        # 記録済みの呼び出しを再生する場合は、APIキーが無くても動かせる
+        if not cassette_recorder.offline and not os.getenv("OPENAI_API_KEY"):
             raise ValueError("OpenAI API Key is not set. Please set the OPENAI_API_KEY environment variable.")
 
         recent_events = await crud.get_recently_updated_events(db=db, limit=20)
@@ -83,29 +88,59 @@ class UserProfileService:
                 "outing_tendency": "予定の履歴がありません。"
             }
             profile = schemas.UserProfileCreate(**default_profile_data)
-            return await crud.create_user_profile(db=db, profile=profile)
+            return await UserProfileService._save_profile(db, profile)
 
         events_summary = UserProfileService._format_events_for_prompt(recent_events)
         prompt = UserProfileService._create_prompt(events_summary)
 
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
-        payload = {
-            "model": "gpt-4o-mini",
-            "messages": [{"role": "user", "content": prompt}],
-            "response_format": {"type": "json_object"},
-            "max_tokens": 1000,
-            "temperature": 0.5,
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(OPENAI_API_URL, headers=headers, json=payload, timeout=30.0)
-            response.raise_for_status()
-            response_data = response.json()
-            profile_json_string = response_data["choices"][0]["message"]["content"].strip()
-            profile_data = json.loads(profile_json_string)
-
-            profile = schemas.UserProfileCreate(**profile_data)
-            return await crud.create_user_profile(db=db, profile=profile)
+        # レート制限と料金上限は upstream で適用される
+        response = await upstream.chat_completion(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
+            max_tokens=1000,
+            temperature=0.5,
+            timeout=30.0,
+            cassette_label="profile.generate",
+            cassette_context={"events": events_summary},
+        )
+        profile_data = repair_json(response.choices[0].message.content)
+
+        profile = schemas.UserProfileCreate(**profile_data)
+        return await UserProfileService._save_profile(db, profile)
+
+    @staticmethod
+    async def _save_profile(db: AsyncSession, profile: schemas.UserProfileCreate) -> models.UserProfile:
+        """プロフィールを保存してキャッシュを更新し、保存件数を超えた古いプロフィールを削除する"""
+        db_profile = await crud.create_user_profile(db=db, profile=profile)
+        profile_cache.set_profile(schemas.UserProfileResponse.model_validate(db_profile))
+        try:
+            await crud.delete_old_user_profiles(db, keep=int(os.getenv("USER_PROFILE_RETENTION", DEFAULT_PROFILE_RETENTION)))
+        except Exception as e:
+            print(f"Failed to delete old user profiles: {e}")
+        return db_profile
+
+    @staticmethod
+    async def get_latest_profile(db: AsyncSession) -> Optional[schemas.UserProfileResponse]:
+        """最新のプロフィール。キャッシュが有効な間はDBを読まない"""
+        cached, profile = profile_cache.get_profile()
+        if cached:
+            return profile
+        db_profile = await crud.get_latest_user_profile(db)
+        profile = schemas.UserProfileResponse.model_validate(db_profile) if db_profile else None
+        profile_cache.set_profile(profile)
+        return profile
+
+    @staticmethod
+    async def events_updated_on(db: AsyncSession, day: date) -> bool:
+        """その日に予定が追加・更新されたか。このプロセスでの変更はDBを読まずに判定する"""
+        cached = profile_cache.events_updated_on(day)
+        if cached is not None:
+            return cached
+        start_of_day, _ = local_day_bounds(day)
+        updated = await crud.has_events_updated_since(db, since=start_of_day)
+        profile_cache.set_events_updated_on(day, updated)
+        return updated
 
     @staticmethod
     async def regenerate_profile_if_stale(db: AsyncSession):
@@ -113,7 +148,7 @@ class UserProfileService:
         プロフィールの鮮度をチェックし、古ければ再生成する。
         この関数はバックグラウンドタスクでの実行を想定しており、メインスレッドをブロックしない。
         """
-        latest_profile = await crud.get_latest_user_profile(db)
+        latest_profile = await UserProfileService.get_latest_profile(db)
         today = date.today()
 
         # プロフィールが存在し、かつ今日生成されたものであれば何もしない
@@ -122,10 +157,16 @@ class UserProfileService:
             return
 
         # プロフィールが存在しないか、古い場合に再生成を試みる
-        try:
-            print("Regenerating user profile due to new event activity...")
-            await UserProfileService.generate_profile(db)
-            print("User profile regenerated successfully.")
-        except Exception as e:
-            # 本番環境ではloggingを使用してエラーを記録することが望ましい
-            print(f"Error during automatic profile regeneration: {e}")
+        # 連続した予定の変更や複数ワーカーから同時に再生成しないよう、1つだけ実行する
+        async with coordination_store.single_flight("profile-regeneration") as acquired:
+            if not acquired:
+                return
+            try:
+                print("Regenerating user profile due to new event activity...")
+                # レスポンス後に実行されるため、元のリクエストの期限は引き継がない
+                with deadline_scope(None):
+                    await UserProfileService.generate_profile(db)
+                print("User profile regenerated successfully.")
+            except Exception as e:
+                # 本番環境ではloggingを使用してエラーを記録することが望ましい
+                print(f"Error during automatic profile regeneration: {e}")
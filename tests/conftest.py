@@ -0,0 +1,151 @@
+# tests/conftest.py
+
+import os
+import uuid
+import asyncio
+import inspect
+import tempfile
+
+import pytest
+
+# アプリケーションのモジュールを読み込む前に、テスト用の作業ディレクトリとDBを用意する
+# （SQLite のファイルや学習行列などは作業ディレクトリに作られる）
+WORK_DIR = tempfile.mkdtemp(prefix="secretary-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{WORK_DIR}/calendar.db")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("TAVILY_API_KEY", "test")
+# 上流API(OpenAI / Tavily)は呼び出さない（記録の無い呼び出しはエラーになる）
+os.environ.setdefault("LLM_CASSETTE_MODE", "replay")
+os.chdir(WORK_DIR)
+
+# テスト全体で1つのイベントループを使う（DBの接続プールはループごとに作り直せないため）
+_runner = asyncio.Runner()
+
+
+def run(coro):
+    """同期のフィクスチャからコルーチンを実行する"""
+    return _runner.run(coro)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """async def のテストを共有のイベントループで実行する"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    _runner.run(pyfuncitem.obj(**arguments))
+    return True
+
+
+def pytest_unconfigure(config):
+    _runner.close()
+
+
+
+async def _reset_database() -> None:
+    from app.database import Base, engine, init_db
+    from app.day_context import day_context_builder
+    from app.timezones import timezone_settings
+
+    await init_db()
+    async with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            await conn.execute(table.delete())
+    await timezone_settings.refresh(force=True)
+    # 消した予定をキャッシュから返さないようにする
+    day_context_builder.clear()
+
+
+@pytest.fixture
+def db():
+    """空のDBのセッション"""
+    from app.database import AsyncSessionLocal
+
+    run(_reset_database())
+    session = AsyncSessionLocal()
+    yield session
+    run(session.close())
+
+
+@pytest.fixture(scope="session")
+def postgres_url():
+    """
+    テスト用の PostgreSQL サーバー。TEST_POSTGRES_URL が無ければ pgserver で一時的に起動する。
+    どちらも使えない場合は PostgreSQL のテストをスキップする
+    """
+    pytest.importorskip("asyncpg")
+    url = os.getenv("TEST_POSTGRES_URL")
+    if url:
+        yield url
+        return
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip("PostgreSQL is not available (set TEST_POSTGRES_URL or install pgserver)")
+    try:
+        server = pgserver.get_server(os.path.join(WORK_DIR, "postgres"), cleanup_mode="stop")
+    except Exception as e:
+        pytest.skip(f"Failed to start a PostgreSQL server: {e}")
+    yield server.get_uri()
+    server.cleanup()
+
+
+async def _create_database(url: str, name: str) -> bool:
+    """テスト用のDBを作成する。pg_trgm が使えないサーバーの場合は作成せずに False を返す"""
+    import asyncpg
+
+    conn = await asyncpg.connect(url)
+    try:
+        if not await conn.fetchval("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"):
+            return False
+        await conn.execute(f'CREATE DATABASE "{name}"')
+        return True
+    finally:
+        await conn.close()
+
+
+async def _drop_database(url: str, name: str) -> None:
+    import asyncpg
+
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(scope="session")
+def postgres_engine(postgres_url):
+    """テストの実行ごとに新しく作成したDBのエンジン（実行後にDBごと削除する）"""
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from app.database import _engine_options, resolve_database_url
+
+    name = f"secretary_test_{uuid.uuid4().hex[:12]}"
+    if not run(_create_database(postgres_url, name)):
+        pytest.skip("The pg_trgm extension is not available on the PostgreSQL server")
+    url = make_url(resolve_database_url(postgres_url)).set(database=name).render_as_string(hide_password=False)
+    engine = create_async_engine(url, **_engine_options(url))
+    yield engine
+    run(engine.dispose())
+    run(_drop_database(postgres_url, name))
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def backend(request, monkeypatch):
+    """
+    SQLite / PostgreSQL のそれぞれで、空のDBのセッションを作る sessionmaker。
+    方言はアプリケーションの読み込み時に DATABASE_URL から決まるため、PostgreSQL の場合は差し替える
+    """
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from app import crud, database
+
+    if request.param == "postgresql":
+        engine = request.getfixturevalue("postgres_engine")
+        monkeypatch.setattr(database, "engine", engine)
+        monkeypatch.setattr(database, "DIALECT", "postgresql")
+        monkeypatch.setattr(database, "IS_SQLITE", False)
+        monkeypatch.setattr(database, "IS_POSTGRESQL", True)
+        monkeypatch.setattr(crud, "IS_POSTGRESQL", True)
+    run(_reset_database())
+    yield async_sessionmaker(autocommit=False, autoflush=False, bind=database.engine, expire_on_commit=False)
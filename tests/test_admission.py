@@ -0,0 +1,34 @@
+# tests/test_admission.py
+
+import httpx
+
+from app.admission import AdmissionController
+from app.main import app
+
+ORIGIN = "http://localhost:3000"
+FREE_TIME = {
+    "free_time_start": "2026-05-01T13:00:00+09:00",
+    "free_time_end": "2026-05-01T15:00:00+09:00",
+    "user_preferences": "カフェ",
+}
+
+
+async def test_saturated_ai_pool_is_rejected_with_retry_after_and_cors(db, monkeypatch):
+    # 待たせずに断るよう、待ちの上限を0にしたコントローラーの実行枠を使い切る
+    monkeypatch.setenv("ADMISSION_AI_QUEUE", "0")
+    controller = AdmissionController()
+    monkeypatch.setattr("app.main.admission_controller", controller)
+    ai_pool = controller._configure()["ai"]
+    for _ in range(ai_pool.route_class.max_concurrency):
+        await controller.acquire("ai")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+        response = await client.post(
+            "/planner/generate-plans-from-free-time", json=FREE_TIME, headers={"Origin": ORIGIN}
+        )
+    assert response.status_code == 503
+    assert int(response.headers["retry-after"]) >= 1
+    # ブラウザが503と Retry-After を読めるよう、CORS のヘッダーが付いている
+    assert response.headers["access-control-allow-origin"] == ORIGIN
+    assert "Retry-After" in response.headers["access-control-expose-headers"]
+    assert ai_pool.snapshot()["shed_queue_full"] == 1
@@ -0,0 +1,103 @@
+# tests/test_backends.py
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from app import crud, schemas
+from app.timezones import local_date
+
+# UTCで指定する（SQLite / PostgreSQL のどちらでもタイムゾーン無しのUTCで保存される）
+DAY = datetime(2026, 5, 1, 1, 0, tzinfo=timezone.utc)
+
+
+def _at(hours: float) -> datetime:
+    return DAY + timedelta(hours=hours)
+
+
+async def _create(db, title: str, start: float, end: float, location: str | None = None, description: str | None = None):
+    return await crud.create_event(db, schemas.EventCreate(
+        title=title, start_time=_at(start), end_time=_at(end), location=location, description=description,
+    ))
+
+
+async def test_period_queries_treat_ranges_as_half_open(backend):
+    async with backend() as db:
+        morning = await _create(db, "朝会", 0, 1)
+        noon = await _create(db, "昼会", 1, 2)
+        long = await _create(db, "研修", -1, 3)
+
+        # 終了と開始が同時刻の予定は重ならない（PostgreSQL では tsrange の && で判定する）
+        assert [e.id for e in await crud.get_events_by_period(db, _at(0.5), _at(1))] == [long.id, morning.id]
+        overlapping = await crud.get_overlapping_events(db, _at(1), _at(2), exclude_id=noon.id)
+        assert [e.id for e in overlapping] == [long.id]
+        assert await crud.get_events_by_period(db, _at(3), _at(4)) == []
+
+
+async def test_concurrent_writes_keep_daily_summary_consistent(backend):
+    writers = 8
+
+    async def write(i: int) -> None:
+        async with backend() as db:
+            await _create(db, f"予定{i}", i * 0.1, i * 0.1 + 1)
+
+    # 同じ日の集計の行を、別々のトランザクションから同時に作成・更新する（ON CONFLICT と FOR UPDATE）
+    await asyncio.gather(*(write(i) for i in range(writers)))
+    async with backend() as db:
+        day = local_date(DAY)
+        summary, = await crud.get_daily_summaries(db, day, day)
+        assert summary.event_count == writers
+        assert summary.version == writers
+        assert await crud.get_daily_summary_version(db, day) == writers
+
+
+async def test_search_matches_the_same_events_on_both_backends(backend):
+    async with backend() as db:
+        title = await _create(db, "京都観光の打ち合わせ", 0, 1)
+        description = await _create(db, "ランチ", 2, 3, description="打ち合わせの後に")
+        await _create(db, "東京出張", 4, 5, location="京都駅")
+        await _create(db, "100%達成の祝い", 6, 7)
+
+        # タイトルの一致が説明の一致より先に並ぶ
+        assert [e.id for e in await crud.search_events(db, "打ち合わせ")] == [title.id, description.id]
+        # 前方一致はタイトルか場所がその語で始まる予定
+        assert [e.title for e in await crud.search_events(db, "京都*")] == ["京都観光の打ち合わせ", "東京出張"]
+        # LIKE の特殊文字はエスケープされる
+        assert [e.title for e in await crud.search_events(db, "0%")] == ["100%達成の祝い"]
+        # 期間で絞り込む
+        assert [e.id for e in await crud.search_events(db, "打ち合わせ", start=_at(1), end=_at(4))] == [description.id]
+
+
+async def test_change_log_cursor_never_skips_a_late_commit(backend):
+    writers = 6
+    done = asyncio.Event()
+
+    async def write(i: int) -> None:
+        async with backend() as db:
+            await crud._add_event(db, schemas.EventCreate(
+                title=f"予定{i}", start_time=_at(i * 24), end_time=_at(i * 24 + 1),
+            ))
+            await db.flush()
+            # 先に採番された変更ほど、コミットを遅らせる
+            await asyncio.sleep((writers - i) * 0.05)
+            await db.commit()
+
+    async def read() -> list[int]:
+        # 差分同期のクライアントと同じく、読んだ最後の seq までカーソルを進める
+        cursor, seen = 0, []
+        while True:
+            finished = done.is_set()
+            async with backend() as db:
+                changes = await crud.get_event_changes(db, since=cursor, limit=100)
+            seen.extend(change.seq for change in changes)
+            cursor = seen[-1] if seen else cursor
+            if finished:
+                return seen
+            await asyncio.sleep(0.01)
+
+    reader = asyncio.create_task(read())
+    await asyncio.gather(*(write(i) for i in range(writers)))
+    done.set()
+    seen = await reader
+    async with backend() as db:
+        assert seen == [change.seq for change in await crud.get_event_changes(db, since=0, limit=100)]
+    assert len(seen) == writers
@@ -0,0 +1,92 @@
+# tests/test_change_feed.py
+
+import asyncio
+from datetime import datetime, timedelta
+
+from app import change_feed, crud, models, schemas
+from app.change_feed import ChangeHub
+
+
+async def _create(db, title: str):
+    start = datetime(2026, 5, 1, 10, 0)
+    return await crud.create_event(db, schemas.EventCreate(
+        title=title, start_time=start, end_time=start + timedelta(hours=1),
+    ))
+
+
+async def _next_change(stream):
+    # keep-alive の None は読み飛ばす
+    while True:
+        change = await asyncio.wait_for(anext(stream), timeout=5)
+        if change is not None:
+            return change
+
+
+def _count_loads(monkeypatch) -> list:
+    calls = []
+    load_changes = change_feed._load_changes
+
+    async def counting(*args, **kwargs):
+        calls.append(kwargs)
+        return await load_changes(*args, **kwargs)
+
+    monkeypatch.setattr(change_feed, "_load_changes", counting)
+    return calls
+
+
+async def test_subscribers_resume_from_db_then_share_one_reader(db, monkeypatch):
+    hub = ChangeHub()
+    monkeypatch.setattr(change_feed, "change_hub", hub)
+    monkeypatch.setattr(crud, "change_hub", hub)
+    calls = _count_loads(monkeypatch)
+
+    await _create(db, "再開前の予定")
+    streams = [hub.stream(since=0) for _ in range(5)]
+    try:
+        # 再開位置までの履歴は、購読者ごとにDBから読む
+        for stream in streams:
+            assert (await _next_change(stream)).data["title"] == "再開前の予定"
+        resume_loads = len(calls)
+
+        for i in range(3):
+            await _create(db, f"予定{i}")
+        for stream in streams:
+            assert [(await _next_change(stream)).data["title"] for _ in range(3)] == ["予定0", "予定1", "予定2"]
+        # その後の変更はプロセス内の通知で配られ、購読者の数だけDBを読み直すことはない
+        assert len(calls) == resume_loads
+    finally:
+        for stream in streams:
+            await stream.aclose()
+    assert hub._poller is None
+
+
+async def test_overflowed_subscriber_catches_up_from_db(db, monkeypatch):
+    hub = ChangeHub()
+    monkeypatch.setattr(crud, "change_hub", hub)
+    monkeypatch.setattr(change_feed, "SUBSCRIBER_QUEUE_SIZE", 2)
+
+    stream = hub.stream(since=0)
+    try:
+        await _create(db, "最初の予定")
+        assert (await _next_change(stream)).data["title"] == "最初の予定"
+        # 読み出さない間に待ち行列の上限を超えて変更が届く
+        for i in range(5):
+            await _create(db, f"予定{i}")
+        assert [(await _next_change(stream)).data["title"] for _ in range(5)] == [f"予定{i}" for i in range(5)]
+    finally:
+        await stream.aclose()
+
+
+async def test_publisher_picks_up_changes_from_other_workers(db, monkeypatch):
+    hub = ChangeHub()
+    monkeypatch.setattr(change_feed, "POLL_INTERVAL_SECONDS", 0.05)
+
+    stream = hub.stream(since=0)
+    try:
+        assert await asyncio.wait_for(anext(stream), timeout=5) is None
+        # 別のワーカーが書いた変更（このプロセスには通知されない）
+        db.add(models.EventChange(event_id=1, operation="create", payload='{"title": "別のワーカーの予定"}'))
+        await db.commit()
+        assert (await _next_change(stream)).data["title"] == "別のワーカーの予定"
+    finally:
+        await stream.aclose()
@@ -0,0 +1,102 @@
+# tests/test_compression.py
+
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from app import compression, crud, schemas
+from app.main import app
+
+ORIGIN = "http://localhost:3000"
+PERIOD = {"start": "2026-05-01T00:00:00+09:00", "end": "2026-05-08T00:00:00+09:00"}
+# 計測するエンドポイント（クエリ付き）
+ENDPOINTS = {
+    "GET /events/": ("/events/", PERIOD),
+    "GET /events/conflicts": ("/events/conflicts", PERIOD),
+    "GET /events/search": ("/events/search", {"q": "打ち合わせ", "limit": 100}),
+    "GET /events/stats": ("/events/stats", {"start": "2026-05-01", "end": "2026-05-07"}),
+    "GET /events/sync": ("/events/sync", {"limit": 1000}),
+}
+BENCHMARK_ROUNDS = 20
+
+
+async def _seed(db, count: int) -> None:
+    for i in range(count):
+        start = datetime(2026, 5, 1, 0, 0) + timedelta(hours=i * 3 % 168)
+        await crud.create_event(db, schemas.EventCreate(
+            title=f"打ち合わせ {i}", start_time=start, end_time=start + timedelta(hours=1),
+            location="会議室A", description="週次の進捗確認と次の作業の相談",
+        ))
+
+
+def _vary(response: httpx.Response) -> set[str]:
+    """Vary が1つのヘッダーにまとまっていることを確かめ、その値の集合を返す"""
+    values = response.headers.get_list("vary")
+    assert len(values) == 1
+    return {value.strip().lower() for value in values[0].split(",")}
+
+
+def _client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver")
+
+
+async def test_small_response_varies_on_origin_and_accept_encoding(db):
+    await _seed(db, 1)
+    async with _client() as client:
+        response = await client.get("/events/", params=PERIOD, headers={"Origin": ORIGIN, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    # CORS の Vary: Origin と別のヘッダーにせず、1つにまとめる
+    assert {"origin", "accept-encoding"} <= _vary(response)
+
+
+async def test_compressed_response_merges_vary(db):
+    await _seed(db, 50)
+    async with _client() as client:
+        response = await client.get("/events/", params=PERIOD, headers={"Origin": ORIGIN, "Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert {"origin", "accept-encoding"} <= _vary(response)
+    assert len(response.json()) == 50
+
+
+async def test_response_without_accept_encoding_still_varies(db):
+    await _seed(db, 50)
+    async with _client() as client:
+        response = await client.get("/events/", params=PERIOD, headers={"Accept-Encoding": ""})
+    assert "content-encoding" not in response.headers
+    # 圧縮しなかったレスポンスも、Accept-Encoding を送るクライアントのキャッシュと区別させる
+    assert "accept-encoding" in _vary(response)
+
+
+def test_vary_is_not_duplicated():
+    assert compression._with_vary([(b"vary", b"origin, accept-encoding")]) == [(b"vary", b"origin, accept-encoding")]
+    assert compression._with_vary([(b"vary", b"*")]) == [(b"vary", b"*")]
+
+
+@pytest.mark.benchmark
+async def test_bytes_and_cpu_per_endpoint(db, monkeypatch):
+    """同じリクエストを各圧縮方式で繰り返し、エンドポイントごとの送信バイト数と圧縮のCPU時間を比べる"""
+    await _seed(db, 300)
+    stats = compression.CompressionStats()
+    monkeypatch.setattr(compression, "compression_stats", stats)
+    encodings = ["identity", *compression.available_encodings()]
+
+    async with _client() as client:
+        for encoding in encodings:
+            for path, params in ENDPOINTS.values():
+                for _ in range(BENCHMARK_ROUNDS):
+                    response = await client.get(path, params=params, headers={"Accept-Encoding": encoding})
+                    assert response.status_code == 200
+
+    endpoints = stats.snapshot()["endpoints"]
+    print()
+    print(f"{'endpoint':<22}{'encoding':<10}{'raw bytes':>12}{'sent bytes':>12}{'ratio':>8}{'cpu ms/resp':>13}")
+    for endpoint in ENDPOINTS:
+        for encoding in encodings:
+            entry = endpoints[endpoint][encoding]
+            cpu_ms = entry["cpu_seconds"] / entry["responses"] * 1000
+            print(f"{endpoint:<22}{encoding:<10}{entry['raw_bytes']:>12}{entry['sent_bytes']:>12}"
+                  f"{entry['ratio'] or 0:>8}{cpu_ms:>13.3f}")
+            if encoding != "identity" and entry["raw_bytes"] >= compression.minimum_size() * BENCHMARK_ROUNDS:
+                assert entry["sent_bytes"] < entry["raw_bytes"]
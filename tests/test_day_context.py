@@ -0,0 +1,69 @@
+# tests/test_day_context.py
+
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from app import crud, schemas
+from app.day_context import MAX_LATER_EVENTS, DayContext, DayEvent, day_context_builder
+
+TOKYO = ZoneInfo("Asia/Tokyo")
+DAY = date(2026, 5, 1)
+
+
+def _at(hour: int, minute: int = 0) -> datetime:
+    return datetime(2026, 5, 1, hour, minute, tzinfo=TOKYO)
+
+
+def _day_event(id: int, start: datetime, end: datetime, location: str | None = None) -> DayEvent:
+    return DayEvent(id, f"予定{id}", start, end, location)
+
+
+def test_summary_lists_earlier_overlapping_and_later_events():
+    context = DayContext(DAY, [
+        _day_event(1, _at(9), _at(10), "自宅"),
+        _day_event(2, _at(10), _at(11), "渋谷駅"),
+        _day_event(3, _at(13), _at(14)),
+        _day_event(4, _at(16), _at(17), "新宿駅"),
+        # 日をまたぐ予定は日付も付ける
+        _day_event(5, _at(23), _at(23) + timedelta(hours=2), "新宿駅"),
+    ])
+    summary = context.summary(_at(11), _at(15))
+
+    assert "- この日の予定: 5件" in summary
+    assert "- 移動の流れ: 自宅 → 渋谷駅 → ［この空き時間］ → 新宿駅" in summary
+    earlier, rest = summary.split("- この空き時間と重なっている予定")
+    overlapping, later = rest.split("- この空き時間の後に控えている予定")
+    assert "09:00〜10:00 予定1 @自宅" in earlier and "10:00〜11:00 予定2 @渋谷駅" in earlier
+    assert "13:00〜14:00 予定3" in overlapping and "@" not in overlapping
+    assert "16:00〜17:00 予定4 @新宿駅" in later
+    assert "23:00〜05/02 01:00 予定5 @新宿駅" in later
+
+
+def test_summary_limits_later_events_and_handles_empty_day():
+    assert DayContext(DAY, []).summary(_at(11), _at(12)) == "この日は他に予定がありません。"
+
+    events = [_day_event(i, _at(12, i * 5), _at(12, i * 5 + 5)) for i in range(MAX_LATER_EVENTS + 2)]
+    summary = DayContext(DAY, events).summary(_at(10), _at(12))
+    assert "ほか2件" in summary
+    assert "予定0" in summary and f"予定{MAX_LATER_EVENTS}" not in summary
+
+
+async def test_builder_cache_is_invalidated_by_summary_version(db):
+    day_context_builder.clear()
+    event = await crud.create_event(db, schemas.EventCreate(title="会議", start_time=_at(10), end_time=_at(11)))
+    before = day_context_builder.snapshot()
+
+    first = await day_context_builder.get(db, DAY)
+    assert await day_context_builder.get(db, DAY) is first
+    version = await crud.get_daily_summary_version(db, DAY)
+
+    # 予定を変更すると日ごとの集計の version が増え、キャッシュを使わずに読み直す
+    await crud.update_event(db, event, schemas.EventUpdate(title="打ち合わせ"))
+    assert await crud.get_daily_summary_version(db, DAY) > version
+    second = await day_context_builder.get(db, DAY)
+    assert second is not first
+    assert [e.title for e in second.events] == ["打ち合わせ"]
+
+    after = day_context_builder.snapshot()
+    assert after["misses"] - before["misses"] == 2
+    assert after["hits"] - before["hits"] == 1
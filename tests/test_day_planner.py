@@ -0,0 +1,134 @@
+# tests/test_day_planner.py
+
+import json
+import time
+import asyncio
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app import crud, schemas, service
+from app.cassettes import cassette_recorder
+from app.rate_limit import estimate_prompt_tokens
+from app.service import DayPlannerAgent, MasterPlannerAgent, MobilityAgent, PlannerPipeline
+
+# 上流APIの1回の呼び出しにかかる時間（秒）として仮定する値
+UPSTREAM_LATENCY_SECONDS = 0.2
+BENCHMARK_DAY = date(2026, 5, 1)
+
+
+def _request(prev_location: str, next_location: str, hour: int) -> schemas.MobilityRequest:
+    start = datetime(2026, 5, 1, hour, 0)
+    return schemas.MobilityRequest(
+        prev_event_location=prev_location, next_event_location=next_location,
+        prev_event_end_time=start, next_event_start_time=start + timedelta(hours=2),
+        user_preferences="静かな場所が好き",
+    )
+
+
+def _decision(minutes: int = 15) -> schemas.MobilityResponse:
+    return schemas.MobilityResponse(
+        use_public_transport=True, recommended_mode="公共交通機関", reasoning="テスト",
+        estimated_time=minutes, estimated_cost="200円",
+    )
+
+
+async def test_failed_mobility_decision_falls_back_per_slot(monkeypatch):
+    failing = _request("会社", "取引先", 10)
+
+    async def decide_mobility(req, search_cache=None):
+        if req is failing:
+            raise ConnectionError("AI decision-making failed")
+        return _decision(20)
+
+    monkeypatch.setattr(MobilityAgent, "decide_mobility", decide_mobility)
+    reqs = [_request("自宅", "会社", 8), failing, _request("取引先", "自宅", 14)]
+    decisions = await DayPlannerAgent._decide_mobility_for_slots(reqs, {})
+
+    # 失敗した空き時間だけが、ローカル推定による判断で代用される
+    assert [d.estimated_time for d in (decisions[0], decisions[2])] == [20, 20]
+    assert decisions[1] == await MobilityAgent.fallback_decision(failing)
+
+
+class FakeUpstream:
+    """
+    記録済みの呼び出しを再生する代わりに、一定の遅延の後で決まった応答を返す。
+    OpenAIの呼び出しの token 数は、レート制限と同じ見積もり(estimate_prompt_tokens)で数える。
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+
+    async def call(self, kind, request, live_call, *, encode=None, decode=lambda data: data, label=None, context=None):
+        self.calls += 1
+        await asyncio.sleep(UPSTREAM_LATENCY_SECONDS)
+        if kind == "tavily.search":
+            return {"results": [{"url": f"https://example.com/{request['query']}", "content": "おすすめの場所", "score": 1.0}]}
+        self.tokens += estimate_prompt_tokens(request["messages"])
+        if label == "mobility.decide":
+            content = _decision().model_dump_json()
+        elif label == "day_planner.plans":
+            content = json.dumps({"slots": [
+                {"slot_id": slot_id, "plans": self._plans(slot["request"])}
+                for slot_id, slot in enumerate(context["slots"], start=1)
+            ]})
+        else:
+            content = json.dumps({"plans": self._plans(context["request"])})
+        return decode({
+            "id": "fake", "object": "chat.completion", "created": 0, "model": request["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        })
+
+    @staticmethod
+    def _plans(req: dict) -> list[dict]:
+        start, end = req["prev_event_end_time"], req["next_event_start_time"]
+        return [
+            {"pattern_description": f"プラン{i}", "events": [{"title": "散歩", "start_time": start, "end_time": end}]}
+            for i in range(2)
+        ]
+
+
+@pytest.mark.benchmark
+async def test_day_planning_beats_sequential_slot_calls(db, monkeypatch):
+    monkeypatch.setenv("PLAN_REUSE_THRESHOLD", "2")
+    for hour, location in [(8, "自宅"), (11, "会社"), (14, "取引先"), (17, "会社"), (20, "ジム")]:
+        start = datetime(2026, 5, 1, hour, 0)
+        await crud.create_event(db, schemas.EventCreate(
+            title=location, start_time=start, end_time=start + timedelta(hours=1), location=location,
+        ))
+    request = schemas.DayPlannerRequest(date=BENCHMARK_DAY, user_preferences="静かな場所が好き")
+    events = list(await crud.get_events_by_period(db, datetime(2026, 4, 30), datetime(2026, 5, 2)))
+    slot_requests = [
+        schemas.MobilityRequest(
+            prev_event_location=prev_event.location, next_event_location=next_event.location,
+            prev_event_end_time=prev_event.end_time, next_event_start_time=next_event.start_time,
+            user_preferences=request.user_preferences,
+        )
+        for prev_event, next_event in zip(events, events[1:])
+    ]
+
+    async def measure(run):
+        upstream = FakeUpstream()
+        monkeypatch.setattr(cassette_recorder, "call", upstream.call)
+        monkeypatch.setattr(service, "planner_pipeline", PlannerPipeline())
+        started = time.perf_counter()
+        await run()
+        return time.perf_counter() - started, upstream
+
+    async def sequential():
+        # 空き時間ごとに /planner/generate-plans-from-free-time を呼び出す場合
+        for req in slot_requests:
+            await MasterPlannerAgent.generate_plans(req)
+
+    sequential_seconds, sequential_upstream = await measure(sequential)
+    day_seconds, day_upstream = await measure(lambda: DayPlannerAgent.generate_day_plans(db, request))
+
+    print(
+        f"\n{len(slot_requests)} slots: sequential {sequential_seconds:.2f}s / {sequential_upstream.calls} calls / "
+        f"~{sequential_upstream.tokens:.0f} tokens, "
+        f"day planner {day_seconds:.2f}s / {day_upstream.calls} calls / ~{day_upstream.tokens:.0f} tokens"
+    )
+    assert day_seconds < sequential_seconds
+    assert day_upstream.calls < sequential_upstream.calls
+    assert day_upstream.tokens < sequential_upstream.tokens
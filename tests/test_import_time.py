@@ -0,0 +1,45 @@
+# tests/test_import_time.py
+
+import os
+import sys
+import subprocess
+
+# app.main の読み込みで読み込まれてはいけない重いモジュール（最初に使われるまで遅延させている）
+LAZY_MODULES = ("openai", "tavily", "app.agent.search_improved")
+# import app.main にかかる時間の上限（秒）。遅いマシンでは IMPORT_TIME_BUDGET_SECONDS で変更する
+DEFAULT_IMPORT_TIME_BUDGET_SECONDS = 3.0
+
+
+def _import_times(module: str) -> dict[str, int]:
+    """python -X importtime の出力から、モジュールごとの累積の読み込み時間（マイクロ秒）を返す"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.getcwd(),
+        env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__)))},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_app_main_does_not_import_upstream_clients():
+    times = _import_times("app.main")
+    assert "app.main" in times
+    loaded = [name for name in times if name.split(".")[0] in LAZY_MODULES or name in LAZY_MODULES]
+    assert loaded == []
+
+
+def test_app_main_import_time_within_budget():
+    times = _import_times("app.main")
+    seconds = times["app.main"] / 1_000_000
+    budget = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", DEFAULT_IMPORT_TIME_BUDGET_SECONDS))
+    print(f"import app.main: {seconds:.3f}s (budget {budget:.1f}s)")
+    assert seconds < budget
@@ -0,0 +1,81 @@
+# tests/test_jobs.py
+
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app import crud, models, schemas
+from app.jobs import PlanJobQueue, public_error_message
+from app.rate_limit import RateLimitError
+from app.timezones import utc_now
+
+
+def _request(hour: int = 13) -> schemas.ConveniencePlannerRequest:
+    start = datetime(2026, 5, 1, hour, 0)
+    return schemas.ConveniencePlannerRequest(
+        free_time_start=start, free_time_end=start + timedelta(hours=2), user_preferences="カフェ"
+    )
+
+
+async def test_concurrent_submissions_create_one_job(db):
+    from app.database import AsyncSessionLocal
+
+    queue = PlanJobQueue(concurrency=1)
+    sessions = [AsyncSessionLocal() for _ in range(4)]
+    try:
+        jobs = await asyncio.gather(*(queue.submit(session, "master", _request()) for session in sessions))
+    finally:
+        for session in sessions:
+            await session.close()
+    assert len({job.id for job in jobs}) == 1
+    rows = (await db.execute(select(models.PlanJob))).scalars().all()
+    assert len(rows) == 1
+
+
+async def test_finished_job_allows_resubmission(db):
+    queue = PlanJobQueue(concurrency=1)
+    first = await queue.submit(db, "master", _request())
+    await crud.finish_plan_job(db, first.id, error="Failed to generate plans.")
+    second = await queue.submit(db, "master", _request())
+    assert second.id != first.id
+
+
+async def test_wait_does_not_leak_events(db):
+    queue = PlanJobQueue(concurrency=1)
+    job = await queue.submit(db, "master", _request())
+    await crud.finish_plan_job(db, job.id, error="Failed to generate plans.")
+    waited = await queue.wait(db, job.id, timeout=0.1)
+    assert waited.status == "failed"
+    assert queue._finished == {} and not queue._waiting
+
+
+async def test_sweep_deletes_only_expired_finished_jobs(db, monkeypatch):
+    queue = PlanJobQueue(concurrency=1)
+    old_id = (await queue.submit(db, "master", _request(10))).id
+    active_id = (await queue.submit(db, "master", _request(15))).id
+    await crud.finish_plan_job(db, old_id, error="Failed to generate plans.")
+    monkeypatch.setenv("PLAN_JOB_TTL_MINUTES", "0")
+    assert await queue.sweep() == 1
+    db.expire_all()
+    assert await crud.get_plan_job(db, old_id) is None
+    assert await crud.get_plan_job(db, active_id) is not None
+
+
+def test_public_error_message_hides_details():
+    message = public_error_message(RuntimeError("sk-secret upstream body"))
+    assert "secret" not in message
+    assert "busy" in public_error_message(RateLimitError("limited", retry_after=1.0))
+
+
+async def test_job_timestamps_are_stored_in_utc(db):
+    queue = PlanJobQueue(concurrency=1)
+    job_id = (await queue.submit(db, "master", _request())).id
+    assert await crud.claim_plan_job(db, job_id)
+    await crud.finish_plan_job(db, job_id, error="Failed to generate plans.")
+    db.expire_all()
+    finished = await crud.get_plan_job(db, job_id)
+    # 予定・生成済みプランと同じく、UTCの時刻として読み書きする
+    for value in (finished.created_at, finished.updated_at, finished.finished_at):
+        assert value.tzinfo is not None
+        assert abs(utc_now() - value) < timedelta(minutes=1)
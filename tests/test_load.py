@@ -0,0 +1,122 @@
+# tests/test_load.py
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+import pytest
+
+# 比較するワーカー数。LOAD_TEST_WORKERS で変更できる
+DEFAULT_LOAD_TEST_WORKERS = 4
+# 1ワーカーの場合に対する、N ワーカーのスループットの最低の比率（N 倍 × この値）
+DEFAULT_SCALING_EFFICIENCY = 0.7
+LOAD_SECONDS = 5.0
+CONCURRENCY_PER_CLIENT = 16
+SEED_EVENTS = 200
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY = {"start": "2026-05-01T00:00:00+09:00", "end": "2026-05-08T00:00:00+09:00"}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(workers: int, work_dir: str) -> tuple[subprocess.Popen, str]:
+    """本番モードと同じく、共有ストア(COORDINATION_BACKEND=sqlite)を使う複数ワーカーで起動する"""
+    port = _free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": PROJECT_ROOT,
+        "COORDINATION_BACKEND": "sqlite",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{work_dir}/calendar.db",
+        # 受付制御で負荷試験のリクエストを断らないようにする
+        "ADMISSION_CONTROL": "0",
+        "COMPRESSION": "0",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=work_dir, env=env, stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/").status_code == 200:
+                return process, base_url
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The server did not start.")
+
+
+def _stop_server(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def _generate_load(base_url: str, seconds: float, concurrency: int) -> int:
+    completed = 0
+    deadline = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def loop():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                response = await client.get("/events/", params=QUERY)
+                response.raise_for_status()
+                completed += 1
+
+        await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return completed
+
+
+def _client_process(base_url: str, seconds: float, concurrency: int) -> int:
+    return asyncio.run(_generate_load(base_url, seconds, concurrency))
+
+
+def _throughput(workers: int, clients: int) -> float:
+    """GET /events/ を clients 個のプロセスから並行して呼び出し、1秒あたりの完了数を返す"""
+    with tempfile.TemporaryDirectory() as work_dir:
+        process, base_url = _start_server(workers, work_dir)
+        try:
+            with httpx.Client(base_url=base_url) as client:
+                for i in range(SEED_EVENTS):
+                    start = f"2026-05-0{1 + i % 7}T{8 + i % 12:02d}:00:00+09:00"
+                    end = f"2026-05-0{1 + i % 7}T{8 + i % 12:02d}:30:00+09:00"
+                    client.post("/events/", json={"title": f"予定{i}", "start_time": start, "end_time": end}).raise_for_status()
+            # 各ワーカーの接続・キャッシュを温めてから計測する
+            _client_process(base_url, 1.0, CONCURRENCY_PER_CLIENT)
+            with ProcessPoolExecutor(max_workers=clients) as pool:
+                futures = [
+                    pool.submit(_client_process, base_url, LOAD_SECONDS, CONCURRENCY_PER_CLIENT) for _ in range(clients)
+                ]
+                completed = sum(future.result() for future in futures)
+        finally:
+            _stop_server(process)
+    return completed / LOAD_SECONDS
+
+
+@pytest.mark.benchmark
+def test_events_throughput_scales_with_workers():
+    workers = int(os.getenv("LOAD_TEST_WORKERS", DEFAULT_LOAD_TEST_WORKERS))
+    efficiency = float(os.getenv("SCALING_EFFICIENCY", DEFAULT_SCALING_EFFICIENCY))
+    # 負荷をかける側のプロセスにもCPUが必要なため、ワーカー数の2倍のCPUが無ければ比較できない
+    if (os.cpu_count() or 1) < workers * 2:
+        pytest.skip(f"Needs at least {workers * 2} CPUs to compare 1 and {workers} workers.")
+
+    single = _throughput(1, clients=workers)
+    multi = _throughput(workers, clients=workers)
+    print(f"GET /events/: 1 worker {single:.0f} req/s, {workers} workers {multi:.0f} req/s ({multi / single:.2f}x)")
+    assert multi >= single * workers * efficiency
@@ -0,0 +1,38 @@
+# tests/test_negotiation.py
+
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+from app import crud, negotiation, schemas
+from app.main import app
+from app.negotiation import MSGPACK_MEDIA_TYPE, merge_vary
+
+ORIGIN = "http://localhost:3000"
+PERIOD = {"start": "2026-05-01T00:00:00+09:00", "end": "2026-05-02T00:00:00+09:00"}
+
+
+def test_merge_vary_keeps_existing_values():
+    assert merge_vary(None, "Accept") == "Accept"
+    assert merge_vary("Origin", "Accept") == "Origin, Accept"
+    assert merge_vary("origin, accept", "Accept") == "origin, accept"
+    assert merge_vary("*", "Accept") == "*"
+
+
+@pytest.mark.parametrize("accept", ["application/json", MSGPACK_MEDIA_TYPE])
+async def test_both_representations_vary_on_accept(db, accept):
+    if accept == MSGPACK_MEDIA_TYPE and negotiation.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    start = datetime(2026, 5, 1, 10, 0)
+    await crud.create_event(db, schemas.EventCreate(title="会議", start_time=start, end_time=start + timedelta(hours=1)))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+        response = await client.get("/events/", params=PERIOD, headers={"Accept": accept, "Origin": ORIGIN})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith(accept)
+    body = negotiation.msgpack.unpackb(response.content) if accept == MSGPACK_MEDIA_TYPE else response.json()
+    assert [event["title"] for event in body] == ["会議"]
+    # 共有キャッシュが別の形式の本文を返さないよう、CORS などの値を残したまま Accept を加える
+    vary, = response.headers.get_list("vary")
+    assert {"accept", "origin", "accept-encoding"} <= {value.strip().lower() for value in vary.split(",")}
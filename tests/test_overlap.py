@@ -0,0 +1,55 @@
+# tests/test_overlap.py
+
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException, Response
+
+from app import crud, schemas
+from app.routers import events as events_router
+
+
+def _event(hour: int, title: str = "予定") -> schemas.EventCreate:
+    start = datetime(2026, 5, 1, hour, 0)
+    return schemas.EventCreate(title=title, start_time=start, end_time=start + timedelta(hours=1))
+
+
+async def _create(db, event: schemas.EventCreate, allow_overlap: bool | None):
+    response = Response()
+    created = await events_router.create_new_event(
+        event, BackgroundTasks(), response, allow_overlap=allow_overlap, db=db
+    )
+    return created, response
+
+
+async def test_allowed_overlap_is_still_reported(db):
+    existing, _ = await _create(db, _event(10), allow_overlap=None)
+    # 終了と開始が同時刻の予定は重なりとみなさない
+    _, adjacent = await _create(db, _event(11), allow_overlap=True)
+    assert events_router.CONFLICTS_HEADER not in adjacent.headers
+
+    _, response = await _create(db, _event(10), allow_overlap=True)
+    assert response.headers[events_router.CONFLICTS_HEADER] == str(existing.id)
+
+
+async def test_enforced_overlap_is_rejected_with_conflicts(db):
+    existing, _ = await _create(db, _event(10), allow_overlap=None)
+    with pytest.raises(HTTPException) as excinfo:
+        await _create(db, _event(10), allow_overlap=False)
+    assert excinfo.value.status_code == 409
+    assert [e["id"] for e in excinfo.value.detail["conflicts"]] == [existing.id]
+
+
+async def test_bulk_writes_report_conflicts_under_either_policy(db):
+    existing, _ = await _create(db, _event(10), allow_overlap=None)
+    mutation = schemas.EventMutation(
+        ref="a", operation="create", event=schemas.EventUpdate(**_event(10, "重なる予定").model_dump())
+    )
+
+    allowed, = await crud.apply_event_mutations(db, [mutation], enforce_overlap=False)
+    assert allowed.status == "applied"
+    assert [e.id for e in allowed.conflicts] == [existing.id]
+
+    rejected, = await crud.apply_event_mutations(db, [mutation], enforce_overlap=True)
+    assert rejected.status == "conflict"
+    assert {e.id for e in rejected.conflicts} == {existing.id, allowed.event_id}
@@ -0,0 +1,105 @@
+# tests/test_plan_index.py
+
+import json
+import asyncio
+import multiprocessing
+from datetime import datetime, timedelta
+
+from app import schemas
+from app.plan_index import PlanIndex, normalize
+
+APPENDERS = 3
+APPENDS_PER_WORKER = 100
+COMPACTIONS = 50
+
+
+def _request(prev_location: str = "渋谷駅", next_location: str = "新宿駅", hour: int = 13) -> schemas.MobilityRequest:
+    start = datetime(2026, 5, 1, hour, 0)
+    return schemas.MobilityRequest(
+        prev_event_location=prev_location, next_event_location=next_location,
+        prev_event_end_time=start, next_event_start_time=start + timedelta(hours=2),
+        user_preferences="静かな場所が好き",
+    )
+
+
+def _response(req: schemas.MobilityRequest, use_public_transport: bool = True) -> schemas.PlannerResponse:
+    plan = schemas.PlanPattern(pattern_description="散歩", events=[schemas.EventCreate(
+        title="散歩", start_time=req.prev_event_end_time, end_time=req.next_event_start_time,
+    )])
+    return schemas.PlannerResponse(
+        mobility_decision=schemas.MobilityResponse(
+            use_public_transport=use_public_transport, recommended_mode="公共交通機関" if use_public_transport else "徒歩",
+            reasoning="テスト", estimated_time=15, estimated_cost="200円",
+        ),
+        plans=[plan, plan],
+    )
+
+
+def _decision(use_public_transport: bool) -> schemas.MobilityResponse:
+    return _response(_request(), use_public_transport).mobility_decision
+
+
+VECTOR = normalize([1.0, 0.0, 0.0, 0.0])
+
+
+async def test_lookup_filters_on_route_and_mode_before_scoring(tmp_path):
+    index = PlanIndex(str(tmp_path / "plan_index.jsonl"))
+    req = _request()
+    await index.add("master", VECTOR, req, "好み", _response(req))
+    await index.add("master", VECTOR, _request("池袋駅"), "好み", _response(_request("池袋駅")))
+
+    # 表記ゆれ（全角・空白）は同じ場所とみなす
+    match = await index.lookup("master", VECTOR, _request("渋谷 駅", "新宿駅"))
+    assert match is not None and match.entry["route"] == "渋谷駅|新宿駅"
+    # 好みのベクトルが同じでも、出発地・移動手段・人格が違えば再利用しない
+    assert await index.lookup("master", VECTOR, _request("上野駅")) is None
+    assert await index.lookup("master", VECTOR, req, _decision(use_public_transport=False)) is None
+    assert await index.lookup("masculine", VECTOR, req) is None
+    # 好みが似ていなければ再利用しない
+    assert await index.lookup("master", normalize([0.0, 1.0, 0.0, 0.0]), req) is None
+
+
+async def test_lookup_requires_the_same_day_context(tmp_path):
+    index = PlanIndex(str(tmp_path / "plan_index.jsonl"))
+    req = _request()
+    await index.add("master", VECTOR, req, "好み", _response(req), day_context="- この日の予定: 1件")
+
+    assert await index.lookup("master", VECTOR, req, day_context="- この日の予定: 1件") is not None
+    # 後に控えている予定などが変わった日には、同じ条件でも再利用しない
+    assert await index.lookup("master", VECTOR, req, day_context="- この日の予定: 2件") is None
+    assert await index.lookup("master", VECTOR, req) is None
+
+
+def _append_entries(path: str, worker: int) -> None:
+    index = PlanIndex(path)
+    req = _request(f"場所{worker}")
+
+    async def append() -> None:
+        for _ in range(APPENDS_PER_WORKER):
+            await index.add("master", VECTOR, req, "好み", _response(req))
+
+    asyncio.run(append())
+
+
+def _compact(path: str) -> None:
+    # 上限に余裕があるため削除はせず、ファイルの書き直しだけを繰り返す
+    index = PlanIndex(path)
+    for _ in range(COMPACTIONS):
+        with index._lock:
+            index._evict()
+
+
+def test_compaction_does_not_lose_concurrent_appends(tmp_path):
+    path = str(tmp_path / "plan_index.jsonl")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_append_entries, args=(path, worker)) for worker in range(APPENDERS)]
+    processes.append(context.Process(target=_compact, args=(path,)))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    with open(path, encoding="utf-8") as f:
+        ids = [json.loads(line)["id"] for line in f]
+    assert len(ids) == len(set(ids)) == APPENDERS * APPENDS_PER_WORKER
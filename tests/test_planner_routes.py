@@ -0,0 +1,51 @@
+# tests/test_planner_routes.py
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.cassettes import cassette_recorder
+from app.latency import latency_tracker
+from app.main import app
+
+# 上流APIの遅延より十分に短い、リクエスト全体の期限（秒）
+REQUEST_TIMEOUT_SECONDS = 0.3
+UPSTREAM_LATENCY_SECONDS = 5.0
+FREE_TIME = {
+    "free_time_start": "2026-05-01T13:00:00+09:00",
+    "free_time_end": "2026-05-01T15:00:00+09:00",
+    "user_preferences": "カフェ",
+}
+
+
+async def _live_call(kind, request, live_call, **kwargs):
+    # 記録を再生せず、実際の呼び出し（期限で打ち切られる）を行う
+    return await live_call()
+
+
+async def _slow_upstream(key, call):
+    await asyncio.sleep(UPSTREAM_LATENCY_SECONDS)
+    raise AssertionError("The request deadline should have cut this call short.")
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/planner/generate-plans-from-free-time", FREE_TIME),
+    ("/planner/generate-day-plans", {
+        "date": "2026-05-01", "user_preferences": "カフェ", "day_start": "13:00", "day_end": "15:00",
+    }),
+    ("/planner/master", FREE_TIME),
+    ("/masculine-planner/generate-plans", FREE_TIME),
+    ("/agent/decide-mobility", {
+        "prev_event_end_time": "2026-05-01T13:00:00+09:00", "prev_event_location": "渋谷駅",
+        "next_event_start_time": "2026-05-01T15:00:00+09:00", "next_event_location": "新宿駅",
+        "user_preferences": "カフェ",
+    }),
+])
+async def test_plan_generation_past_the_deadline_returns_504(db, monkeypatch, path, body):
+    monkeypatch.setattr(cassette_recorder, "call", _live_call)
+    monkeypatch.setattr(latency_tracker, "hedged", _slow_upstream)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+        response = await client.post(path, json=body, headers={"X-Request-Timeout": str(REQUEST_TIMEOUT_SECONDS)})
+    # 500 にまとめず、アプリ共通のハンドラで 504 として返す
+    assert response.status_code == 504
@@ -0,0 +1,51 @@
+# tests/test_rate_limit.py
+
+import asyncio
+
+import pytest
+
+from app.latency import HEDGE_MIN_SAMPLES, LatencyTracker
+from app.rate_limit import UpstreamRateLimiter
+
+ESTIMATED_USD = 0.01
+ACTUAL_PROMPT_TOKENS = 1000
+
+
+async def _spent(limiter: UpstreamRateLimiter) -> float:
+    return round(await limiter.budget.spent_usd(), 6)
+
+
+async def test_cancelled_hedge_loser_is_charged_its_estimate():
+    limiter = UpstreamRateLimiter()
+    tracker = LatencyTracker()
+    for _ in range(HEDGE_MIN_SAMPLES):
+        tracker.record("openai:gpt-4o:test", 0.01)
+    attempts = []
+
+    async def call():
+        slot = await limiter.acquire("openai", "gpt-4o", estimated_tokens=2000, estimated_usd=ESTIMATED_USD)
+        attempts.append(slot)
+        # 最初の呼び出しは遅く、ヘッジした呼び出しが先に終わる
+        await asyncio.sleep(10 if len(attempts) == 1 else 0)
+        await slot.record_usage(ACTUAL_PROMPT_TOKENS, 0)
+
+    await tracker.hedged("openai:gpt-4o:test", call)
+    assert len(attempts) == 2
+    # 打ち切った呼び出しは見積もりの額、終わった呼び出しは実際の額で計上される
+    assert await _spent(limiter) == round(ESTIMATED_USD + ACTUAL_PROMPT_TOKENS * 2.5 / 1_000_000, 6)
+
+
+async def test_timed_out_call_keeps_estimate_and_rate_limited_call_is_refunded():
+    limiter = UpstreamRateLimiter()
+
+    async def slow_call():
+        await limiter.acquire("openai", "gpt-4o", estimated_usd=ESTIMATED_USD)
+        await asyncio.sleep(10)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(slow_call(), timeout=0.05)
+    assert await _spent(limiter) == ESTIMATED_USD
+
+    slot = await limiter.acquire("tavily", "search", estimated_usd=ESTIMATED_USD)
+    await slot.upstream_rate_limited(1.0)
+    assert await _spent(limiter) == ESTIMATED_USD
@@ -0,0 +1,107 @@
+# tests/test_search.py
+
+import time
+import random
+import statistics
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import insert, text
+
+from app import crud, models, schemas
+
+BENCHMARK_EVENTS = 100_000
+BENCHMARK_REPEATS = 20
+
+
+async def _create(db, title: str, location: str | None = None, description: str | None = None, hour: int = 10):
+    start = datetime(2026, 5, 1, hour, 0)
+    return await crud.create_event(db, schemas.EventCreate(
+        title=title, start_time=start, end_time=start + timedelta(hours=1), location=location, description=description,
+    ))
+
+
+async def test_search_ranks_title_matches_first(db):
+    await _create(db, "打ち合わせ", location="会議室A")
+    await _create(db, "ランチ", description="打ち合わせの後に")
+    results = await crud.search_events(db, "打ち合わせ")
+    assert [event.title for event in results] == ["打ち合わせ", "ランチ"]
+
+
+async def test_short_terms_escape_like_wildcards(db):
+    await _create(db, "100%達成")
+    await _create(db, "1000件")
+    await _create(db, "a_b")
+    await _create(db, "axb")
+    assert [event.title for event in await crud.search_events(db, "0%")] == ["100%達成"]
+    assert [event.title for event in await crud.search_events(db, "a_")] == ["a_b"]
+
+
+async def test_prefix_query_matches_title_or_location_start(db):
+    await _create(db, "京都観光", hour=9)
+    await _create(db, "夕食", location="京都駅", hour=18)
+    await _create(db, "東京都庁見学", hour=13)
+    results = await crud.search_events(db, "京都*")
+    assert [event.title for event in results] == ["京都観光", "夕食"]
+
+
+@pytest.mark.benchmark
+async def test_search_benchmark_100k_events(db):
+    """10万件の予定で、種類ごとの検索の所要時間（中央値）を計測する"""
+    rng = random.Random(0)
+    places = ["京都駅", "四条烏丸", "渋谷", "新宿", "梅田", "会議室A", "会議室B", "カフェ"]
+    words = ["打ち合わせ", "ランチ", "定例", "レビュー", "面談", "移動", "買い物", "ジム"]
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(BENCHMARK_EVENTS):
+        start = base + timedelta(minutes=30 * i)
+        rows.append({
+            "title": f"{rng.choice(words)}{i}",
+            "start_time": start,
+            "end_time": start + timedelta(minutes=rng.choice([30, 60, 90])),
+            "location": rng.choice(places),
+            "description": f"{rng.choice(words)}の予定 #{i}",
+        })
+    started = time.perf_counter()
+    await db.execute(insert(models.Event), rows)
+    await db.commit()
+    print(f"\ninserted {BENCHMARK_EVENTS} events with FTS triggers: {time.perf_counter() - started:.1f}s")
+
+    window = (base + timedelta(days=100), base + timedelta(days=107))
+    cases = {
+        "3+ chars": ("打ち合わせ", None),
+        "two terms": ("打ち合わせ 京都駅", None),
+        "prefix (short)": ("京都*", None),
+        "short substring + range": ("定例", window),
+        "short substring only (full scan)": ("移動", None),
+    }
+    for name, (query, period) in cases.items():
+        start, end = period or (None, None)
+        timings = []
+        for _ in range(BENCHMARK_REPEATS):
+            began = time.perf_counter()
+            results = await crud.search_events(db, query, start=start, end=end)
+            timings.append(time.perf_counter() - began)
+        print(f"{name:34s} {statistics.median(timings) * 1000:8.2f} ms  ({len(results)} results)")
+
+    plan = (await db.execute(text(
+        "EXPLAIN QUERY PLAN SELECT * FROM events WHERE (title >= '京都' AND title < '京都\U0010ffff')"
+        " OR (location >= '京都' AND location < '京都\U0010ffff')"
+    ))).all()
+    assert any("ix_events_title" in row[-1] for row in plan)
+    assert any("ix_events_location" in row[-1] for row in plan)
+
+
+async def test_search_time_filters_compare_in_utc(db):
+    # 10:00〜11:00 (JST) の予定
+    await crud.create_event(db, schemas.EventCreate(
+        title="打ち合わせ",
+        start_time=datetime.fromisoformat("2026-05-01T10:00:00+09:00"),
+        end_time=datetime.fromisoformat("2026-05-01T11:00:00+09:00"),
+    ))
+    inside = datetime.fromisoformat("2026-05-01T10:30:00+09:00")
+    before = datetime.fromisoformat("2026-05-01T09:30:00+09:00")
+    assert len(await crud.search_events(db, "打ち合わせ", start=inside)) == 1
+    assert len(await crud.search_events(db, "打ち合わせ", end=inside)) == 1
+    assert await crud.search_events(db, "打ち合わせ", end=before) == []
+    assert await crud.search_events(db, "打ち", start=datetime.fromisoformat("2026-05-01T11:00:00+09:00")) == []
@@ -0,0 +1,39 @@
+# tests/test_travel_time.py
+
+import pytest
+
+from app import schemas
+from app.travel_time import JsonFileGazetteer, TravelTimeEstimator
+
+
+@pytest.fixture(scope="module")
+def gazetteer():
+    return JsonFileGazetteer()
+
+
+@pytest.mark.parametrize("name", ["京都駅", "京都", "Kyoto Station", "京都駅前のカフェ", "京都駅周辺"])
+def test_lookup_resolves_kyoto_station(gazetteer, name):
+    assert gazetteer.lookup(name) == gazetteer.lookup("京都駅") is not None
+
+
+@pytest.mark.parametrize("name", ["東京都庁", "東京都渋谷区のカフェ", "京都府庁", "京都大学病院の売店"])
+def test_lookup_does_not_match_inside_other_names(gazetteer, name):
+    assert gazetteer.lookup(name) != gazetteer.lookup("京都駅")
+
+
+def test_lookup_accepts_suffix_forms(gazetteer):
+    assert gazetteer.lookup("東京都") == gazetteer.lookup("東京駅")
+    assert gazetteer.lookup("二条城前") == gazetteer.lookup("二条城")
+
+
+def test_lookup_returns_none_when_ambiguous(gazetteer):
+    assert gazetteer.lookup("渋谷・新宿") is None
+
+
+def test_format_for_prompt_excludes_transit_only_for_short_distances():
+    near = schemas.TravelTimeEstimate(distance_km=0.5, walk_minutes=8, transit_minutes=None, learned_samples=0)
+    assert "距離が近いため候補外" in TravelTimeEstimator.format_for_prompt(near)
+
+    # 座標が分からず、学習済みの徒歩の所要時間しかない場合
+    learned_only = schemas.TravelTimeEstimate(distance_km=None, walk_minutes=20, transit_minutes=None, learned_samples=3)
+    assert "候補外" not in TravelTimeEstimator.format_for_prompt(learned_only)